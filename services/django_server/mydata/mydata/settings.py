@@ -207,11 +207,48 @@ LOGGING = {
 
 
 TRACK = {
-    "FILE_DIR": FILE_DIR / "track"
+    "FILE_DIR": FILE_DIR / "track",
+    # Tracksegs are split when there are more than MAXTIME seconds between trackpoints or LIMIT trackpoints
+    "TRACKSEG_MAXTIME": 120,
+    "TRACKSEG_LIMIT": 1000,
+    # Filter applied to parsed trackpoints before saving them, see track.utils.TrackpointFilter.
+    # None disables a filter, e.g. {"MAX_SPEED": 300, "MAX_HDOP": 10, "MIN_INTERVAL": 5, "MIN_DISTANCE": 5}
+    "INGEST_FILTER": {
+        "MAX_SPEED": None,  # m/s
+        "MAX_HDOP": None,
+        "MIN_INTERVAL": None,  # seconds
+        "MIN_DISTANCE": None,  # meters
+    },
+    # Trackpoints posted to HTTP ingest endpoint are saved after this many points or seconds
+    "INGEST_BUFFER_SIZE": 1000,
+    "INGEST_BUFFER_SECONDS": 30,
+    # Trackstats computed for every Trackseg and Trackfile, see track.utils.track_statistics
+    "STATS": {
+        "MOVING_SPEED": 0.5,  # m/s, slower steps don't count in moving time
+        "SPEED_INTERVAL": 10,  # seconds, max speed is averaged over at least this time
+        "PROFILE_POINTS": 100,  # max number of points in elevation profile
+    },
+    # Position at a time is interpolated between Trackpoints max this many seconds apart
+    "RESOLVE_MAX_GAP": 300,
+    # Visit is a stay within VISIT_MAX_DISTANCE meters for at least VISIT_MIN_DURATION seconds
+    "VISIT_MAX_DISTANCE": 200,
+    "VISIT_MIN_DURATION": 600,
+    # Similar routes must start and end within TOLERANCE meters and have Fréchet distance max MAX_DISTANCE meters
+    "SIMILAR_ROUTE_TOLERANCE": 200,
+    "SIMILAR_ROUTE_MAX_DISTANCE": 500,
+    # Zoom levels of precomputed heatmap cells, tiles are served from a level 6-8 zoom levels deeper
+    "HEATMAP_ZOOMS": [8, 10, 12, 14, 16, 18],
+    # archive_trackfiles moves Trackpoints of Trackfiles older than this into archive files
+    "ARCHIVE_AFTER_DAYS": 730,
 }
 
 TIMELINE = {
-    "FILE_DIR": FILE_DIR / "timeline"
+    "FILE_DIR": FILE_DIR / "timeline",
+    # Calendar feeds synced with sync_calendars command, e.g.
+    # {"slug": "foursquare", "url": "https://feeds.foursquare.com/history/....ics", "username": "user"}
+    "SOURCES": [],
+    "SYNC_WORKERS": 4,
+    "SYNC_TIMEOUT": 60,
 }
 
 LOGBOOK = {
@@ -41,6 +41,15 @@ if "track" in settings.INSTALLED_APPS:
     router.register(r"track/trackpoints", views.TrackpointViewSet)
     router.register(r"track/tracksegs", views.TracksegViewSet)
     router.register(r"track/trackfiles", views.TrackfileViewSet)
+    router.register(r"track/visits", views.VisitViewSet)
+    router.register(r"track/days", views.DailySummaryViewSet)
+    urlpatterns += [
+        path("api/track/ingest/", views.TrackpointIngestView.as_view(), name="track-ingest"),
+        path("api/track/series/", views.TrackpointSeriesView.as_view(), name="track-series"),
+        path("api/track/near/", views.TrackNearView.as_view(), name="track-near"),
+        path("api/track/export/gpx/", views.GpxExportView.as_view(), name="track-export-gpx"),
+        path("api/track/heatmap/<int:z>/<int:x>/<int:y>/", views.HeatmapTileView.as_view(), name="track-heatmap"),
+    ]
 
 if "logbook" in settings.INSTALLED_APPS:
     from logbook import views
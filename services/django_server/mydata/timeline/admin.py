@@ -14,7 +14,8 @@ starttime_iso.short_description = "Start time"
 
 
 class SourceAdmin(admin.ModelAdmin):
-    pass
+    list_display = ["name", "slug", "synced_at"]
+    readonly_fields = ["etag", "last_modified", "synced_at", "created_at", "updated_at"]
 
 
 admin.site.register(Source, SourceAdmin)
@@ -1,85 +1,144 @@
+import datetime
 import logging
 import os
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List
 
+import icalendar
 import requests
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
-from icalendar import Calendar
+from django.utils import timezone
 
 from timeline.models import Event, Source
+from timeline.utils import iter_response_lines, iter_vevents, serialize_vevent, serialized_hash, vevent_to_object
 
-
-def read_url(url: str) -> str:
-    """
-    Return url contents.
-    :param url: URL for request
-    :return: return response content string
-    """
-    cal_data = requests.get(url).text
-    return cal_data
+# Event fields which are (re)set from VEVENT data and their values when VEVENT doesn't have them.
+# Event.geo is not reset, because it may have been filled in from Trackpoints (see backfill_locations),
+# so it is updated only when VEVENT has a location.
+EVENT_FIELD_DEFAULTS = {
+    "starttime": None,
+    "endtime": None,
+    "timestamp": None,
+    "last_modified": None,
+    "created": None,
+    "description": "",
+    "summary": "",
+}
 
 
-def read_file(path: str) -> str:
-    """
-    Return file contents.
-    :param path: path to file
-    :return: return file content string
-    """
-    with open(path, "rt") as f:
-        cal_data = f.read()
-    return cal_data
+def event_days(*timestamps) -> List[datetime.date]:
+    """Return local dates of timestamps (datetimes or dates of all-day events), ignoring empty ones."""
+    days = []
+    for t in timestamps:
+        if isinstance(t, datetime.datetime):
+            days.append(timezone.localtime(t).date() if timezone.is_aware(t) else t.date())
+        elif isinstance(t, datetime.date):
+            days.append(t)
+    return days
 
 
-def read_cal(uri: str) -> Optional[Calendar]:
+def iter_lines(uri: str) -> Iterator[str]:
     """
-    Read .ics file from uri and return a Calendar object.
+    Read .ics file or URL line by line.
     :param uri: URL or path to ical file
-    :return: iCalendar object
+    :return: iterator of lines
     """
     if os.path.isfile(uri):
-        with open(uri, "rt") as f:
-            cal = Calendar.from_ical(f.read())
+        with open(uri, "rt", encoding="utf-8", newline="") as f:
+            yield from f
     elif uri.startswith("http"):
-        cal = Calendar.from_ical(requests.get(uri).text)
+        with requests.get(uri, stream=True) as response:
+            response.raise_for_status()
+            yield from iter_response_lines(response)
     else:
-        return None
-    return cal
+        raise ValueError(f"{uri} is not a file or an URL")
+
+
+def read_vevents(uri: str) -> Iterator[icalendar.cal.Event]:
+    """
+    Read VEVENTs from .ics file or URL one at a time, so that huge calendars can be processed in constant memory.
+    :param uri: URL or path to ical file
+    :return: iterator of VEVENT components
+    """
+    return iter_vevents(iter_lines(uri))
 
 
-def process_cal(cal: Calendar, user: User, source: str, limit=0) -> None:
+def process_cal(vevents: Iterable, user: User, source: Source, limit=0, batch_size=1000) -> Dict[str, int]:
     """
-    Loop all timeline events and save a new or update an existing Event object.
+    Save new and update changed VEVENTs as Event objects in batches.
+    Existing events are prefetched in one query and unchanged events are skipped by comparing sha1 hashes.
+    :param vevents: iterable of icalendar VEVENT components, e.g. cal.walk("vevent")
+    :return: dict containing counts of inserted, updated, unchanged and skipped events,
+             events whose UID already belongs to another user or source are skipped
     """
-    i = 0
-    for ev in cal.walk("vevent"):
-        serialized = ev.to_ical().decode("utf-8").replace("\r\n", "\n").replace(r"\,", ",").strip()
-        uid = ev.get("uid")
-        to_save = False
-        try:
-            e = Event.objects.get(uid=uid, user=user, source=source)
-            if e.serialized != serialized:
-                e.serialized = serialized
-                e.parse_serialized()
-                to_save = True
-        except Event.DoesNotExist:
-            e = Event(uid=uid, user=user, source=source, serialized=serialized)
-            e.parse_serialized()
-            to_save = True
-        # if geo:
-        #     try:
-        #         coords = [float(x) for x in geo.split(';')]
-        #         e.geo = Point(coords[1], coords[0])
-        #     except Exception:
-        #         raise
-        #     print(geo, coords, e.geo)
-        # if to_save:
-        #     e.serialized = ev.to_ical().decode("utf-8").replace('\r\n', '\n').strip()
-        #     e.save()
-        print(to_save, e.uid, e.summary, e.starttime, e.endtime, e.location.encode("utf8") if e.location else None)
-        i += 1
+    existing = {
+        uid: (pk, sha1, starttime)
+        for uid, pk, sha1, starttime in Event.objects.filter(user=user, source=source).values_list(
+            "uid", "id", "sha1", "starttime"
+        )
+    }
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    to_create, to_update, days = [], [], set()
+
+    def flush():
+        Event.objects.bulk_create(to_create, batch_size=batch_size, ignore_conflicts=True)
+        Event.objects.bulk_update(
+            to_update, list(EVENT_FIELD_DEFAULTS) + ["serialized", "sha1", "updated_at"], batch_size=batch_size
+        )
+        Event.objects.bulk_update([ev for ev in to_update if ev.geo is not None], ["geo"], batch_size=batch_size)
+        # Event.uid is unique over all users and sources, so ignored conflicts are found by re-querying the uids
+        uids = [ev.uid for ev in to_create]
+        inserted = set(Event.objects.filter(user=user, source=source, uid__in=uids).values_list("uid", flat=True))
+        for ev in to_create:
+            if ev.uid in inserted:
+                days.update(event_days(ev.starttime))
+            else:
+                logging.warning(f"Skipping event whose UID is already used by another user or source: {ev.uid}")
+                counts["skipped"] += 1
+        counts["inserted"] += len(inserted)
+        counts["updated"] += len(to_update)
+        logging.info(f"Saved {len(inserted)} new and {len(to_update)} changed events")
+        to_create.clear()
+        to_update.clear()
+
+    seen = set()
+    for i, ev in enumerate(vevents, start=1):
+        uid = str(ev.get("uid", ""))
+        serialized = serialize_vevent(ev)
+        sha1 = serialized_hash(serialized)
+        if uid == "" or uid in seen:
+            logging.warning(f"Skipping event with {'a duplicate' if uid else 'no'} UID: {uid}")
+            counts["skipped"] += 1
+        elif uid in existing and existing[uid][1] == sha1:
+            counts["unchanged"] += 1
+        else:
+            values = EVENT_FIELD_DEFAULTS.copy()
+            values.update(vevent_to_object(ev))
+            values.pop("uid", None)
+            if values["starttime"] is None:
+                logging.warning(f"Skipping event without DTSTART: {uid}")
+                counts["skipped"] += 1
+            elif uid in existing:
+                pk, _, old_starttime = existing[uid]
+                to_update.append(
+                    Event(pk=pk, serialized=serialized, sha1=sha1, updated_at=timezone.now(), **values)
+                )
+                days.update(event_days(old_starttime, values["starttime"]))
+            else:
+                to_create.append(Event(uid=uid, user=user, source=source, serialized=serialized, sha1=sha1, **values))
+        seen.add(uid)
+        if len(to_create) + len(to_update) >= batch_size:
+            flush()
         if 0 < limit <= i:
-            return
+            break
+    flush()
+    # Bulk operations don't send signals, so refresh DailySummaries of the changed days here
+    if days and "track" in settings.INSTALLED_APPS:
+        from track.models import refresh_daily_summaries
+
+        refresh_daily_summaries(user.id, days)
+    return counts
 
 
 class Command(BaseCommand):
@@ -93,6 +152,9 @@ class Command(BaseCommand):
         parser.add_argument("--uri", action="store", dest="uri", required=True, help="URI for ics")
         parser.add_argument("--source", action="store", dest="source", required=True, help="Source for ics")
         parser.add_argument("--username", action="store", dest="username", required=True, help="username")
+        parser.add_argument(
+            "--batch-size", action="store", dest="batch_size", type=int, default=1000, help="Events per database write"
+        )
 
     def handle(self, *args, **options):
         logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level=getattr(logging, options["log"]))
@@ -103,6 +165,12 @@ class Command(BaseCommand):
         if uri is None:
             print("Nothing to do. You must give at least --uri parameter")
             exit()
-        cal = read_cal(uri)
         user = User.objects.get(username=options["username"])
-        process_cal(cal, user, src, limit)
+        counts = process_cal(read_vevents(uri), user, src, limit, options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Inserted {inserted}, updated {updated}, unchanged {unchanged} and skipped {skipped} events".format(
+                    **counts
+                )
+            )
+        )
@@ -0,0 +1,143 @@
+import collections
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import icalendar
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from timeline.management.commands.process_ics import EVENT_FIELD_DEFAULTS, event_days
+from timeline.models import Event
+from timeline.utils import serialized_hash, vevent_to_object
+
+FIELDS = list(EVENT_FIELD_DEFAULTS) + ["sha1"]  # Event.geo is saved only when VEVENT has a location
+
+
+def parse_events(rows: List[Tuple[int, str]]) -> List[Tuple[int, Optional[dict]]]:
+    """
+    Parse serialized VEVENTs into Event field values. This runs in a worker process and doesn't touch the database.
+    Event.serialized doesn't contain VTIMEZONE components, so VEVENTs having custom TZIDs fail to parse.
+    :param rows: list of (id, serialized) tuples
+    :return: list of (id, values) tuples, values is None if VEVENT is invalid
+    """
+    results = []
+    for pk, serialized in rows:
+        try:
+            vevent = icalendar.Calendar.from_ical(serialized)
+            for key in ["dtstart", "dtend"]:
+                prop = vevent.get(key)
+                if prop is not None and "TZID" in prop.params and getattr(prop.dt, "tzinfo", True) is None:
+                    raise ValueError(f"Unknown TZID {prop.params['TZID']}")
+            values = EVENT_FIELD_DEFAULTS.copy()
+            values.update(vevent_to_object(vevent))
+        except ValueError as err:
+            logging.warning(f"Failed to parse event {pk}: {err}")
+            results.append((pk, None))
+            continue
+        values.pop("uid", None)
+        if values["starttime"] is None:
+            logging.warning(f"Event {pk} has no DTSTART")
+            results.append((pk, None))
+            continue
+        if values.get("geo") is not None and values["geo"].srid is None:
+            values["geo"].srid = 4326  # Make Points comparable with values read from the database
+        values["sha1"] = serialized_hash(serialized)
+        results.append((pk, values))
+    return results
+
+
+class Command(BaseCommand):
+    help = "Re-parse Event.serialized in parallel and save changed fields, e.g. after vevent_to_object has changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-w", "--workers", type=int, default=None, help="Number of processes (default: CPUs)")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Events per chunk")
+        parser.add_argument("--after-id", type=int, default=0, help="Resume after Event with this id")
+        parser.add_argument("-u", "--username", help="Re-parse only events of this user")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def iter_chunks(self, events, after_id: int, chunk_size: int):
+        """Yield lists of Event values ordered by id, reading only one chunk at a time."""
+        while True:
+            chunk = events.filter(id__gt=after_id).order_by("id").values("id", "user_id", "serialized", "geo", *FIELDS)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            after_id = chunk[-1]["id"]
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level=getattr(logging, options["log"]))
+        events = Event.objects.exclude(serialized="")
+        if options["username"]:
+            events = events.filter(user__username=options["username"])
+        total = events.filter(id__gt=options["after_id"]).count()
+        workers = options["workers"] or os.cpu_count()
+        counts = {"processed": 0, "changed": 0, "failed": 0}
+        days = collections.defaultdict(set)  # user_id -> dates of changed starttimes
+        started = time.monotonic()
+        # Chunks are saved in id order, so the last reported id is a safe point to resume from
+        pending = collections.deque()
+
+        def save_next():
+            chunk, future = pending.popleft()
+            changed, failed = self.save_chunk(chunk, future.result(), days)
+            counts["processed"] += len(chunk)
+            counts["changed"] += changed
+            counts["failed"] += failed
+            self.stdout.write(
+                "Processed {}/{} events, {} changed, {:.0f} events/s, last id {}".format(
+                    counts["processed"],
+                    total,
+                    counts["changed"],
+                    counts["processed"] / (time.monotonic() - started),
+                    chunk[-1]["id"],
+                )
+            )
+
+        connection.close()  # Don't share the database connection with forked worker processes
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            # All workers are forked on the first submit, so do it before iter_chunks() opens a new connection
+            executor.submit(int).result()
+            for chunk in self.iter_chunks(events, options["after_id"], options["chunk_size"]):
+                pending.append((chunk, executor.submit(parse_events, [(e["id"], e["serialized"]) for e in chunk])))
+                if len(pending) >= 2 * workers:
+                    save_next()
+            while pending:
+                save_next()
+        if "track" in settings.INSTALLED_APPS:
+            from track.models import refresh_daily_summaries
+
+            for user_id, user_days in days.items():
+                refresh_daily_summaries(user_id, user_days)
+        message = "Re-parsed {processed} events: {changed} changed and {failed} failed to parse".format(**counts)
+        self.stdout.write(self.style.SUCCESS(message))
+
+    def save_chunk(self, chunk: List[dict], results: List[Tuple[int, Optional[dict]]], days: dict) -> Tuple[int, int]:
+        """Save events whose parsed values differ from the stored ones. Return numbers of changed and failed events."""
+        current = {e["id"]: e for e in chunk}
+        to_update, failed = [], 0
+        for pk, values in results:
+            if values is None:
+                failed += 1
+                continue
+            old = current[pk]
+            if all(old[field] == values[field] for field in values):
+                continue
+            to_update.append(Event(pk=pk, updated_at=timezone.now(), **values))
+            if old["starttime"] != values["starttime"]:
+                days[old["user_id"]].update(event_days(old["starttime"], values["starttime"]))
+        Event.objects.bulk_update(to_update, FIELDS + ["updated_at"])
+        Event.objects.bulk_update([ev for ev in to_update if ev.geo is not None], ["geo"])
+        return len(to_update), failed
@@ -0,0 +1,118 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Optional
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from timeline.management.commands.process_ics import process_cal
+from timeline.models import Source
+from timeline.utils import iter_response_lines, iter_vevents
+
+
+def fetch_feed(url: str, etag: str = "", last_modified: str = "", timeout: float = 60) -> Optional[requests.Response]:
+    """
+    Request calendar feed conditionally using validators of the previous response.
+    :param url: URL of the feed
+    :param etag: ETag header of the previous response
+    :param last_modified: Last-Modified header of the previous response
+    :return: streaming response or None if the feed has not been modified
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code == 304:
+        response.close()
+        return None
+    response.raise_for_status()
+    response.encoding = response.encoding or "utf-8"
+    return response
+
+
+def sync_source(conf: dict, force: bool = False, timeout: float = 60) -> Dict[str, int]:
+    """
+    Fetch one configured calendar feed and save its events, if the feed has changed since the previous sync.
+    :param conf: dict containing slug, url and username of the source
+    :return: dict containing counts of processed events, empty if the feed was not modified
+    """
+    close_old_connections()
+    try:
+        user = User.objects.get(username=conf["username"])
+        source, created = Source.objects.get_or_create(slug=conf["slug"], defaults={"name": conf.get("name", "")})
+        if force:
+            response = fetch_feed(conf["url"], timeout=timeout)
+        else:
+            response = fetch_feed(conf["url"], source.etag, source.last_modified, timeout)
+        if response is None:
+            logging.info(f"{source.slug} has not been modified")
+            return {}
+        with response:
+            counts = process_cal(iter_vevents(iter_response_lines(response)), user, source)
+        # Validators are saved only after successful processing, so a failed sync is retried next time
+        source.etag = response.headers.get("ETag", "")
+        source.last_modified = response.headers.get("Last-Modified", "")
+        source.synced_at = timezone.now()
+        source.save(update_fields=["etag", "last_modified", "synced_at", "updated_at"])
+        return counts
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Fetch configured calendar feeds concurrently and save new and changed events"
+
+    def add_arguments(self, parser):
+        parser.add_argument("sources", nargs="*", type=str, help="Slugs of sources to sync (default: all)")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=settings.TIMELINE.get("SYNC_WORKERS", 4), help="Number of workers"
+        )
+        parser.add_argument("--force", action="store_true", help="Fetch feeds even if they have not been modified")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(threadName)s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        confs = settings.TIMELINE.get("SOURCES", [])
+        if options["sources"]:
+            confs = [c for c in confs if c["slug"] in options["sources"]]
+            unknown = set(options["sources"]) - {c["slug"] for c in confs}
+            if unknown:
+                raise CommandError(f"Unknown sources: {', '.join(sorted(unknown))}")
+        if not confs:
+            raise CommandError("No sources to sync, add them to TIMELINE['SOURCES'] setting")
+        timeout = settings.TIMELINE.get("SYNC_TIMEOUT", 60)
+        failed = 0
+        with ThreadPoolExecutor(max_workers=options["workers"], thread_name_prefix="sync") as executor:
+            futures = {executor.submit(sync_source, conf, options["force"], timeout): conf for conf in confs}
+            for future in as_completed(futures):
+                slug = futures[future]["slug"]
+                try:
+                    counts = future.result()
+                except Exception as err:
+                    failed += 1
+                    logging.exception(f"Failed to sync {slug}: {err}")
+                    self.stderr.write(f"{slug}: failed: {err}")
+                    continue
+                if counts:
+                    self.stdout.write(
+                        "{}: inserted {inserted}, updated {updated}, unchanged {unchanged}, skipped {skipped}".format(
+                            slug, **counts
+                        )
+                    )
+                else:
+                    self.stdout.write(f"{slug}: not modified")
+        self.stdout.write(self.style.SUCCESS(f"Synced {len(confs) - failed}/{len(confs)} sources"))
@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-19 09:07
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def compute_sha1(apps, schema_editor):
+    Event = apps.get_model("timeline", "Event")
+    batch = []
+    for event in Event.objects.only("id", "serialized").iterator(chunk_size=2000):
+        event.sha1 = hashlib.sha1(event.serialized.encode("utf-8")).hexdigest()
+        batch.append(event)
+        if len(batch) >= 2000:
+            Event.objects.bulk_update(batch, ["sha1"])
+            batch = []
+    Event.objects.bulk_update(batch, ["sha1"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeline', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='sha1',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.RunPython(compute_sha1, migrations.RunPython.noop),
+    ]
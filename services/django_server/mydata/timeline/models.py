@@ -79,12 +79,16 @@ import icalendar
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
 
-from timeline.utils import vevent_to_object
+from timeline.utils import serialized_hash, vevent_to_object
 
 
 class Source(models.Model):
     name = models.CharField(max_length=512, blank=True, editable=True)
     slug = models.SlugField(max_length=512, editable=True)
+    # HTTP validators of the latest synced feed, used for conditional requests
+    etag = models.CharField(max_length=512, blank=True, editable=False)
+    last_modified = models.CharField(max_length=100, blank=True, editable=False)
+    synced_at = models.DateTimeField(blank=True, null=True, editable=False)
     # Django fields
     created_at = models.DateTimeField(auto_now_add=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
@@ -123,6 +127,8 @@ class Event(models.Model):
     created = models.DateTimeField(blank=True, null=True)
     last_modified = models.DateTimeField(blank=True, null=True)
     serialized = models.TextField(blank=True)
+    # SHA1 hash of serialized in hex-format, used to skip unchanged events in imports
+    sha1 = models.CharField(max_length=40, blank=True, editable=False)
     # Django fields
     created_at = models.DateTimeField(auto_now_add=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
@@ -136,6 +142,7 @@ class Event(models.Model):
             return None
         # This raises ValueError (as intended) if value is not a valid VEVENT
         ev_data = vevent_to_object(icalendar.Calendar.from_ical(self.serialized))
+        ev_data["sha1"] = serialized_hash(self.serialized)
         changed_fields = dict()  # Contains all changed fields and their original value
         for key, val in ev_data.items():
             if getattr(self, key) != val:
@@ -1,3 +1,219 @@
-from django.test import TestCase
+import datetime
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+import icalendar
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.test import SimpleTestCase, TestCase
+
+from timeline.management.commands.process_ics import event_days, process_cal, read_vevents
+from timeline.management.commands.reparse_events import parse_events
+from timeline.management.commands.sync_calendars import fetch_feed
+from timeline.models import Event, Source
+from timeline.utils import iter_response_lines, iter_vevents, serialize_vevent, serialized_hash
+
+VCALENDAR = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:event-1
+DTSTART:20190825T090000Z
+DTEND:20190825T100000Z
+SUMMARY:Kauppatori - Isosaari vene
+LOCATION:Kauppatori\\, Helsinki
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class SerializedHashTestCase(SimpleTestCase):
+    def test_hash_is_stable(self):
+        vevent = icalendar.Calendar.from_ical(VCALENDAR).walk("vevent")[0]
+        serialized = serialize_vevent(vevent)
+        self.assertIn("LOCATION:Kauppatori, Helsinki", serialized)
+        self.assertNotIn("\r\n", serialized)
+        again = serialize_vevent(icalendar.Calendar.from_ical(VCALENDAR).walk("vevent")[0])
+        self.assertEqual(serialized_hash(serialized), serialized_hash(again))
+        self.assertEqual(len(serialized_hash(serialized)), 40)
+
+    def test_event_days(self):
+        start = datetime.datetime(2019, 8, 25, 9, tzinfo=datetime.timezone.utc)
+        days = event_days(start, None, datetime.date(2019, 8, 26))
+        self.assertEqual(days, [datetime.date(2019, 8, 25), datetime.date(2019, 8, 26)])
+
+
+class IterVeventsTestCase(SimpleTestCase):
+    def test_split_folded_calendar(self):
+        folded = VCALENDAR.replace("SUMMARY:Kauppatori - Isosaari vene", "SUMMARY:Kauppatori - Is\r\n osaari vene")
+        second = "\n".join(
+            ["BEGIN:VEVENT", "UID:event-2", "DTSTART:20190826T090000Z", "BEGIN:VALARM", "END:VALARM", "END:VEVENT"]
+        )
+        data = folded.replace("END:VCALENDAR", second + "\nEND:VCALENDAR")
+        vevents = list(iter_vevents(io.StringIO(data)))
+        self.assertEqual([str(ev["uid"]) for ev in vevents], ["event-1", "event-2"])
+        self.assertEqual(str(vevents[0]["summary"]), "Kauppatori - Isosaari vene")
+        self.assertEqual(len(vevents[1].walk("valarm")), 1)
+        expected = icalendar.Calendar.from_ical(VCALENDAR).walk("vevent")[0]
+        self.assertEqual(serialize_vevent(vevents[0]), serialize_vevent(expected))
+
+    def test_custom_tzid(self):
+        """Test that VEVENT times in a custom VTIMEZONE are parsed like in the whole Calendar"""
+        vtimezone = "\n".join(
+            [
+                "BEGIN:VTIMEZONE",
+                "TZID:MyData Test Zone",
+                "BEGIN:STANDARD",
+                "DTSTART:19700101T000000",
+                "TZOFFSETFROM:+0530",
+                "TZOFFSETTO:+0530",
+                "END:STANDARD",
+                "END:VTIMEZONE",
+            ]
+        )
+        data = VCALENDAR.replace("VERSION:2.0", "VERSION:2.0\n" + vtimezone).replace(
+            "DTSTART:20190825T090000Z", "DTSTART;TZID=MyData Test Zone:20190825T143000"
+        )
+        vevents = list(iter_vevents(io.StringIO(data)))
+        self.assertEqual([str(ev["uid"]) for ev in vevents], ["event-1"])
+        starttime = vevents[0]["dtstart"].dt
+        self.assertEqual(starttime, datetime.datetime(2019, 8, 25, 9, tzinfo=datetime.timezone.utc))
+        self.assertEqual(starttime, icalendar.Calendar.from_ical(data).walk("vevent")[0]["dtstart"].dt)
+
+
+class ParseEventsTestCase(SimpleTestCase):
+    def test_parse_events(self):
+        serialized = serialize_vevent(icalendar.Calendar.from_ical(VCALENDAR).walk("vevent")[0])
+        unknown_tzid = serialized.replace("DTSTART:20190825T090000Z", "DTSTART;TZID=Unknown Zone:20190825T120000")
+        results = parse_events(
+            [(1, serialized), (2, "BEGIN:VEVENT\nUID:event-2\nEND:VEVENT"), (3, "not ical"), (4, unknown_tzid)]
+        )
+        self.assertEqual([pk for pk, values in results], [1, 2, 3, 4])
+        values = results[0][1]
+        self.assertEqual(values["summary"], "Kauppatori - Isosaari vene")
+        self.assertEqual(values["starttime"], datetime.datetime(2019, 8, 25, 9, tzinfo=values["starttime"].tzinfo))
+        self.assertEqual(values["description"], "")
+        self.assertEqual(values["sha1"], serialized_hash(serialized))
+        self.assertNotIn("uid", values)
+        self.assertIsNone(results[1][1])
+        self.assertIsNone(results[2][1])
+        self.assertIsNone(results[3][1])
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    last_modified = "Sun, 25 Aug 2019 14:18:27 GMT"
+
+    def do_GET(self):
+        if self.path == "/folded.ics":
+            # Split the body between CR and LF of the folded SUMMARY line
+            body = VCALENDAR.replace("\n", "\r\n").replace("Isosaari", "Is\r\n osaari").encode("utf-8")
+            split = body.index(b"\r\n ") + 1
+            self.send_chunks([body[:split], body[split:]])
+            return
+        validators = (self.headers.get("If-None-Match"), self.headers.get("If-Modified-Since"))
+        if self.etag in validators or self.last_modified in validators:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = VCALENDAR.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.etag)
+        self.send_header("Last-Modified", self.last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunks(self, chunks: list):
+        """Send body using chunked transfer encoding, so the client receives it in the same pieces."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks + [b""]:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchFeedTestCase(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+        cls.url = "http://127.0.0.1:{}/calendar.ics".format(cls.server.server_address[1])
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_conditional_requests(self):
+        with fetch_feed(self.url) as response:
+            vevents = list(iter_vevents(iter_response_lines(response)))
+        self.assertEqual([str(ev["uid"]) for ev in vevents], ["event-1"])
+        self.assertEqual(response.headers["ETag"], FeedHandler.etag)
+        self.assertIsNone(fetch_feed(self.url, etag=FeedHandler.etag))
+        self.assertIsNone(fetch_feed(self.url, last_modified=FeedHandler.last_modified))
+        with fetch_feed(self.url, etag='"v0"') as response:
+            self.assertEqual(response.status_code, 200)
+
+    def test_crlf_split_between_chunks(self):
+        """Test that a CRLF split between received chunks doesn't break unfolding of a folded line"""
+        url = self.url.replace("calendar.ics", "folded.ics")
+        vevents = list(read_vevents(url))
+        self.assertEqual([str(ev["uid"]) for ev in vevents], ["event-1"])
+        self.assertEqual(str(vevents[0]["summary"]), "Kauppatori - Isosaari vene")
+        with fetch_feed(url) as response:  # Feeds are read like this in sync_calendars
+            vevents = list(iter_vevents(iter_response_lines(response)))
+        self.assertEqual(str(vevents[0]["summary"]), "Kauppatori - Isosaari vene")
+
+
+class ProcessCalTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="test")
+        self.source = Source.objects.create(slug="test")
+        second = "\n".join(["BEGIN:VEVENT", "UID:event-2", "DTSTART:20190826T090000Z", "SUMMARY:Sauna", "END:VEVENT"])
+        self.data = VCALENDAR.replace("END:VCALENDAR", second + "\nEND:VCALENDAR")
+
+    def process(self, data: str, user: User = None, source: Source = None) -> dict:
+        return process_cal(iter_vevents(io.StringIO(data)), user or self.user, source or self.source)
+
+    def test_insert_skip_and_update(self):
+        """Test that new events are inserted, unchanged ones skipped and changed ones updated"""
+        counts = self.process(self.data)
+        self.assertEqual(counts, {"inserted": 2, "updated": 0, "unchanged": 0, "skipped": 0})
+        self.assertEqual(Event.objects.get(uid="event-1").summary, "Kauppatori - Isosaari vene")
+        self.assertEqual(self.process(self.data), {"inserted": 0, "updated": 0, "unchanged": 2, "skipped": 0})
+        sha1 = Event.objects.get(uid="event-2").sha1
+        counts = self.process(self.data.replace("SUMMARY:Sauna", "SUMMARY:Savusauna"))
+        self.assertEqual(counts, {"inserted": 0, "updated": 1, "unchanged": 1, "skipped": 0})
+        event = Event.objects.get(uid="event-2")
+        self.assertEqual(event.summary, "Savusauna")
+        self.assertNotEqual(event.sha1, sha1)
+
+    def test_keep_backfilled_location(self):
+        """Test that updating an event keeps its location filled in from Trackpoints, unless VEVENT has one"""
+        self.process(self.data)
+        Event.objects.filter(uid="event-2").update(geo=Point(24.9, 60.1))
+        self.process(self.data.replace("SUMMARY:Sauna", "SUMMARY:Savusauna"))
+        self.assertEqual(Event.objects.get(uid="event-2").geo.coords, (24.9, 60.1))
+        location = "SUMMARY:Sauna\nX-APPLE-STRUCTURED-LOCATION;VALUE=URI:geo:60.2,25.0"
+        self.process(self.data.replace("SUMMARY:Sauna", location))
+        self.assertEqual(Event.objects.get(uid="event-2").geo.coords, (25.0, 60.2))
+
+    def test_uid_conflict(self):
+        """Test that events whose UID belongs to another user are not counted as inserted"""
+        self.process(self.data)
+        other = User.objects.create(username="other")
+        with self.assertLogs(level="WARNING") as logs:
+            counts = self.process(self.data, other, Source.objects.create(slug="other"))
+        self.assertEqual(counts, {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 2})
+        self.assertIn("event-1", logs.output[0])
+        self.assertEqual(Event.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Event.objects.filter(user=other).count(), 0)
@@ -1,4 +1,7 @@
+import hashlib
+import io
 import re
+from typing import Iterable, Iterator
 
 import icalendar
 from django.contrib.gis.geos import Point
@@ -39,3 +42,78 @@ def vevent_to_object(vevent_data) -> dict:
     if m:
         ev_data["geo"] = Point(float(m[2]), float(m[1]))
     return ev_data
+
+
+def serialize_vevent(vevent: icalendar.cal.Event) -> str:
+    """Return VEVENT component as a string, which is saved into Event.serialized."""
+    return vevent.to_ical().decode("utf-8").replace("\r\n", "\n").replace(r"\,", ",").strip()
+
+
+def serialized_hash(serialized: str) -> str:
+    """Return SHA1 hash of serialized VEVENT data in hex-format."""
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def iter_response_lines(response, chunk_size: int = 65536) -> Iterator[str]:
+    """
+    Read a streaming HTTP response line by line.
+    requests' Response.iter_lines() yields an extra empty line when CRLF is split between chunks,
+    and that breaks unfolding, so the last line of every chunk is kept until the next chunk is read.
+    :param response: requests Response, requested with stream=True
+    :return: physical lines with line endings
+    """
+    response.encoding = response.encoding or "utf-8"
+    pending = ""
+    for chunk in response.iter_content(chunk_size, decode_unicode=True):
+        lines = list(io.StringIO(pending + chunk, newline=""))  # Split at CRLF, CR or LF only
+        pending = lines.pop() if lines else ""
+        yield from lines
+    if pending:
+        yield pending
+
+
+def unfold_lines(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Join folded iCalendar content lines (RFC 5545 3.1), which continue with a space or a tab.
+    :param lines: physical lines of an ics file or HTTP response, with or without line endings
+    :return: logical content lines without line endings
+    """
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def iter_vevents(lines: Iterable[str]) -> Iterator[icalendar.cal.Event]:
+    """
+    Split iCalendar data into VEVENT components without building the whole Calendar in memory.
+    Nested components (e.g. VALARM) are kept inside their VEVENT. VTIMEZONE components are parsed,
+    so that icalendar knows custom TZIDs of the following VEVENTs like it does when parsing the whole Calendar.
+    All other components are ignored.
+    :param lines: physical lines of an ics file or HTTP response
+    :return: VEVENT components, one at a time
+    """
+    block, depth = [], 0
+    for line in unfold_lines(lines):
+        name = line.upper()
+        if depth == 0:
+            if name in ["BEGIN:VEVENT", "BEGIN:VTIMEZONE"]:
+                block, depth = [line], 1
+            continue
+        block.append(line)
+        if name.startswith("BEGIN:"):
+            depth += 1
+        elif name.startswith("END:"):
+            depth -= 1
+            if depth == 0:
+                if block[0].upper() == "BEGIN:VTIMEZONE":
+                    icalendar.Timezone.from_ical("\r\n".join(block))  # icalendar caches the timezone
+                else:
+                    yield icalendar.Event.from_ical("\r\n".join(block))
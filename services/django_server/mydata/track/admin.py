@@ -1,6 +1,17 @@
 from django.contrib.gis import admin
 
-from track.models import Tracksource, Trackfile, Trackseg, Trackpoint
+from track.models import (
+    DailySummary,
+    HeatmapCell,
+    ImportJournal,
+    Tracksource,
+    Trackfile,
+    Trackseg,
+    Trackpoint,
+    Trackstats,
+    Visit,
+    delete_trackfiles_in_background,
+)
 
 TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S %z"
 
@@ -21,14 +32,27 @@ endtime_iso.admin_order_field = "endtime"
 endtime_iso.short_description = "Start time"
 
 
+def delete_in_background(modeladmin, request, queryset):
+    trackfile_ids = list(queryset.values_list("id", flat=True))
+    delete_trackfiles_in_background(trackfile_ids)
+    modeladmin.message_user(request, f"Deleting {len(trackfile_ids)} track files in background")
+
+
+delete_in_background.short_description = "Delete selected track files in background"
+
+
 class TracksourceAdmin(admin.ModelAdmin):
     pass
 
 
 class TrackfileAdmin(admin.OSMGeoAdmin):
-    list_display = ["filename", "filesize", starttime_iso, endtime_iso]
+    actions = [delete_in_background]
+    list_display = ["filename", "filesize", starttime_iso, endtime_iso, "trackpoint_cnt", "duplicate_cnt"]
     search_fields = ["filename", "starttime", "endtime"]
-    readonly_fields = ["filename", "filesize", "trackpoint_cnt", "starttime", "endtime"]
+    readonly_fields = [
+        "filename", "filesize", "trackpoint_cnt", "starttime", "endtime", "duplicate_cnt", "duplicate_sources",
+        "filter_stats", "archived_at", "deleting_at",
+    ]
 
 
 class TracksegAdmin(admin.OSMGeoAdmin):
@@ -39,7 +63,39 @@ class TrackpointAdmin(admin.OSMGeoAdmin):
     list_display = ["pk", "lat", "lon", "time"]
 
 
+class TrackstatsAdmin(admin.ModelAdmin):
+    list_display = ["__str__", "distance", "moving_time", "max_speed", "ascent", "updated_at"]
+    raw_id_fields = ["trackfile", "trackseg"]
+
+
+class VisitAdmin(admin.OSMGeoAdmin):
+    list_display = ["__str__", "arrival", "departure", "duration", "trackpoint_cnt"]
+    raw_id_fields = ["trackfile"]
+
+
+class HeatmapCellAdmin(admin.ModelAdmin):
+    list_display = ["user", "zoom", "x", "y", "count"]
+    list_filter = ["zoom"]
+
+
+class DailySummaryAdmin(admin.OSMGeoAdmin):
+    list_display = ["date", "user", "distance", "moving_time", "visit_cnt", "event_cnt", "record_cnt"]
+    date_hierarchy = "date"
+
+
+class ImportJournalAdmin(admin.ModelAdmin):
+    list_display = ["path", "status", "filesize", "duration", "started_at"]
+    list_filter = ["status"]
+    search_fields = ["path", "sha1"]
+    ordering = ["-duration"]
+
+
 admin.site.register(Tracksource, TracksourceAdmin)
 admin.site.register(Trackfile, TrackfileAdmin)
 admin.site.register(Trackseg, TracksegAdmin)
 admin.site.register(Trackpoint, TrackpointAdmin)
+admin.site.register(Trackstats, TrackstatsAdmin)
+admin.site.register(Visit, VisitAdmin)
+admin.site.register(HeatmapCell, HeatmapCellAdmin)
+admin.site.register(DailySummary, DailySummaryAdmin)
+admin.site.register(ImportJournal, ImportJournalAdmin)
@@ -0,0 +1,59 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from track.models import Trackfile
+
+
+class Command(BaseCommand):
+    help = "Move trackpoints of old track files from the database into compressed archive files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Trackfile ids, default is all old enough track files")
+        parser.add_argument("-u", "--username", help="Archive only track files of this user")
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.TRACK.get("ARCHIVE_AFTER_DAYS", 730),
+            help="Archive track files which ended more than this many days ago",
+        )
+        parser.add_argument("--restore", action="store_true", help="Move archived trackpoints back to the database")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="Number of rows deleted in a transaction")
+        parser.add_argument("--dry-run", action="store_true", help="Only list track files to archive or restore")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        trackfiles = Trackfile.objects.filter(archived_at__isnull=not options["restore"]).order_by("starttime")
+        if options["ids"]:
+            trackfiles = trackfiles.filter(pk__in=options["ids"])
+        elif not options["restore"]:
+            trackfiles = trackfiles.filter(endtime__lt=timezone.now() - datetime.timedelta(days=options["days"]))
+        if options["username"]:
+            trackfiles = trackfiles.filter(user__username=options["username"])
+        cnt = 0
+        for trackfile in trackfiles:
+            if options["dry_run"]:
+                self.stdout.write(f"{trackfile.id} {trackfile} {trackfile.trackpoint_cnt} trackpoints")
+                continue
+            if options["restore"]:
+                logging.info(f"Restoring {trackfile}")
+                trackfile.restore_trackpoints(chunk_size=options["chunk_size"])
+            else:
+                logging.info(f"Archiving {trackfile}")
+                trackfile.archive_trackpoints(chunk_size=options["chunk_size"])
+            cnt += 1
+        if not options["dry_run"]:
+            action = "Restored" if options["restore"] else "Archived"
+            self.stdout.write(self.style.SUCCESS(f"{action} {cnt} track files"))
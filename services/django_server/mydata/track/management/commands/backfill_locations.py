@@ -0,0 +1,86 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+
+from track.models import resolve_positions
+
+
+def backfill(queryset, time_field: str, set_position, fields: list, batch_size: int, max_gap: float) -> int:
+    """
+    Resolve positions for objects in queryset in batches ordered by time and save them with bulk_update.
+    Return the number of updated objects.
+    """
+    cnt = 0
+    last_id = 0
+    while True:
+        # Unresolved objects stay in the queryset, so paginate by id to not fetch them again
+        objects = list(queryset.filter(id__gt=last_id).order_by("id")[:batch_size])
+        if not objects:
+            return cnt
+        last_id = objects[-1].id
+        positions = resolve_positions(objects[0].user, [getattr(obj, time_field) for obj in objects], max_gap)
+        resolved = []
+        for obj, position in zip(objects, positions):
+            if position is not None:
+                set_position(obj, *position)
+                resolved.append(obj)
+        queryset.model.objects.bulk_update(resolved, fields)
+        cnt += len(resolved)
+        logging.info(f"Resolved {len(resolved)}/{len(objects)} {queryset.model.__name__} locations")
+
+
+def set_record_position(record, lat: float, lon: float):
+    record.lat, record.lon = lat, lon
+    record.geometry = Point(lon, lat)
+
+
+def set_event_position(event, lat: float, lon: float):
+    event.geo = Point(lon, lat)
+
+
+class Command(BaseCommand):
+    help = "Fill in missing locations of logbook Records and timeline Events from GPS tracks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-u", "--username", help="Backfill only this user's data")
+        parser.add_argument(
+            "--max-gap",
+            type=float,
+            default=settings.TRACK.get("RESOLVE_MAX_GAP", 300),
+            help="Max seconds between trackpoints to interpolate a location from",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000, help="Number of objects resolved at once")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        users = User.objects.all()
+        if options["username"]:
+            users = users.filter(username=options["username"])
+            if not users.exists():
+                raise CommandError("User '{}' does not exist.".format(options["username"]))
+        targets = []
+        if "logbook" in settings.INSTALLED_APPS:
+            from logbook.models import Record
+
+            targets.append((Record, "time", "geometry", set_record_position, ["lat", "lon", "geometry"]))
+        if "timeline" in settings.INSTALLED_APPS:
+            from timeline.models import Event
+
+            targets.append((Event, "starttime", "geo", set_event_position, ["geo"]))
+        for user in users:
+            for model, time_field, geometry_field, set_position, fields in targets:
+                queryset = model.objects.filter(user=user, **{f"{geometry_field}__isnull": True}).select_related("user")
+                cnt = backfill(queryset, time_field, set_position, fields, options["batch_size"], options["max_gap"])
+                self.stdout.write(self.style.SUCCESS(f"{user}: filled in {cnt} {model.__name__} locations"))
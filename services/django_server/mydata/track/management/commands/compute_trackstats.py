@@ -0,0 +1,39 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from track.models import Trackfile, compute_trackstats
+
+
+class Command(BaseCommand):
+    help = "Recompute statistics (distance, moving time, speed, elevation) of track files and their tracksegs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Trackfile ids, default is all track files")
+        parser.add_argument("-u", "--username", help="Recompute only track files of this user")
+        parser.add_argument("--missing", action="store_true", help="Compute only track files without statistics")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        trackfiles = Trackfile.objects.filter(trackpoint_cnt__gt=0).order_by("starttime")
+        if options["ids"]:
+            trackfiles = trackfiles.filter(pk__in=options["ids"])
+        if options["username"]:
+            trackfiles = trackfiles.filter(user__username=options["username"])
+        if options["missing"]:
+            trackfiles = trackfiles.filter(stats__isnull=True)
+        cnt = 0
+        for trackfile in trackfiles.iterator():
+            stats = compute_trackstats(trackfile)
+            logging.info(f"{trackfile}: {stats.distance / 1000:.2f} km, {stats.moving_time / 60:.0f} min moving")
+            cnt += 1
+        self.stdout.write(self.style.SUCCESS(f"Computed statistics of {cnt} track files"))
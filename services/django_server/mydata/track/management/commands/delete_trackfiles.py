@@ -0,0 +1,55 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from track.models import Trackfile, delete_trackfiles
+
+
+class Command(BaseCommand):
+    help = "Delete track files and their trackpoints in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Trackfile ids")
+        parser.add_argument("-u", "--username", help="Delete track files of this user")
+        parser.add_argument("--start", help="Delete track files starting at or after this time (ISO 8601)")
+        parser.add_argument("--end", help="Delete track files ending before this time (ISO 8601)")
+        parser.add_argument(
+            "--pending", action="store_true", help="Delete track files, whose deletion in background was interrupted"
+        )
+        parser.add_argument("--chunk-size", type=int, default=10000, help="Number of rows deleted in a transaction")
+        parser.add_argument("--dry-run", action="store_true", help="Only list track files to delete")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        if not (options["ids"] or options["username"] or options["pending"]):
+            raise CommandError("Give Trackfile ids, --username or --pending")
+        trackfiles = Trackfile.objects.all()
+        if options["pending"]:
+            trackfiles = trackfiles.filter(deleting_at__isnull=False)
+        if options["ids"]:
+            trackfiles = trackfiles.filter(pk__in=options["ids"])
+        if options["username"]:
+            trackfiles = trackfiles.filter(user__username=options["username"])
+        for key, lookup in [("start", "starttime__gte"), ("end", "endtime__lt")]:
+            if options[key]:
+                timestamp = parse_datetime(options[key])
+                if timestamp is None:
+                    raise CommandError(f"Invalid --{key} value {options[key]}")
+                trackfiles = trackfiles.filter(**{lookup: timestamp})
+        trackfile_ids = list(trackfiles.values_list("id", flat=True))
+        if options["dry_run"]:
+            for trackfile in trackfiles.order_by("starttime"):
+                self.stdout.write(f"{trackfile.id} {trackfile} {trackfile.trackpoint_cnt} trackpoints")
+            return
+        cnt = delete_trackfiles(trackfile_ids, chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {cnt} track files"))
@@ -0,0 +1,39 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from track.models import Trackfile, detect_visits
+
+
+class Command(BaseCommand):
+    help = "Detect visits (places where user stayed for a while) from track files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Trackfile ids, default is all track files")
+        parser.add_argument("-u", "--username", help="Detect visits only from track files of this user")
+        parser.add_argument("--missing", action="store_true", help="Process only track files without visits")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        trackfiles = Trackfile.objects.filter(trackpoint_cnt__gt=0).order_by("starttime")
+        if options["ids"]:
+            trackfiles = trackfiles.filter(pk__in=options["ids"])
+        if options["username"]:
+            trackfiles = trackfiles.filter(user__username=options["username"])
+        if options["missing"]:
+            trackfiles = trackfiles.filter(visits__isnull=True)
+        cnt = 0
+        for trackfile in trackfiles.iterator():
+            visits = detect_visits(trackfile)
+            logging.info(f"{trackfile}: {len(visits)} visits")
+            cnt += len(visits)
+        self.stdout.write(self.style.SUCCESS(f"Detected {cnt} visits"))
@@ -0,0 +1,59 @@
+import logging
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from track.models import export_gpx
+from track.utils import gzip_stream
+
+
+class Command(BaseCommand):
+    help = "Export user's trackpoints in a time range into one GPX file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-u", "--username", required=True)
+        parser.add_argument("--start", required=True, help="Start time (ISO 8601)")
+        parser.add_argument("--end", required=True, help="End time (ISO 8601)")
+        parser.add_argument("-o", "--output", help="Output file, default is stdout")
+        parser.add_argument("--gzip", action="store_true", help="Compress output with gzip")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError("User '{}' does not exist.".format(options["username"]))
+        time_range = []
+        for key in ["start", "end"]:
+            timestamp = parse_datetime(options[key])
+            if timestamp is None:
+                raise CommandError(f"Invalid --{key} value {options[key]}")
+            if timezone.is_naive(timestamp):
+                timestamp = timezone.make_aware(timestamp)
+            time_range.append(timestamp)
+        chunks = export_gpx(user, *time_range)
+        if options["gzip"]:
+            chunks = gzip_stream(chunks)
+        else:
+            chunks = (chunk.encode("utf-8") for chunk in chunks)
+        out = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if options["output"]:
+                out.close()
+        if options["output"]:
+            self.stdout.write(self.style.SUCCESS(f"Exported GPX to {options['output']}"))
@@ -1,33 +1,98 @@
 import logging
+import os
 from typing import Optional
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
 from django.db import IntegrityError
 
-from track.models import Trackfile, save_trackfile
+from track.models import ImportJournal, Trackfile, delete_trackfile
+from track.utils import detect_datatype
 
 
-def handle_file(fname: str, options: dict) -> Optional[Trackfile]:
+def handle_file(fname: str, options: dict, datatype: Optional[str] = None) -> Optional[Trackfile]:
+    """
+    Save and parse a track file and record the result in the ImportJournal.
+    If datatype is not given, it is detected from file's content or filename extension.
+    Files which are already journaled as finished are skipped without opening them.
+    """
     try:
         user = User.objects.get(username=options["username"])
     except User.DoesNotExist:
         raise CommandError("User '{}' does not exist.".format(options["username"]))
-    if fname.endswith('.gpx') is False:
-        logging.warning(f"{fname} not processed (doesn't have .gpx filename extension)")
+    stat = os.stat(fname)
+    journal, created = ImportJournal.objects.get_or_create(
+        user=user, path=os.path.abspath(fname), filesize=stat.st_size, mtime=stat.st_mtime
+    )
+    if journal.finished and options["override"] is False:
+        logging.info(f"{fname} already processed ({journal.status})")
         return
+    if datatype is None:
+        with open(fname, "rb") as f:
+            datatype = detect_datatype(fname, f.read(4096))
+        if datatype is None:
+            logging.warning(f"{fname} not processed (unknown file format)")
+            # Journal the file, so reruns and watchers skip it without opening it again
+            journal.start()
+            journal.finish("SKIPPED", error="unknown file format")
+            return
+    if not created and journal.trackfile_id is not None and not journal.finished:
+        # Previous run was interrupted after the Trackfile was saved, remove it and parse the file again
+        logging.info(f"Removing incomplete {journal.trackfile} of {fname}")
+        delete_trackfile(journal.trackfile)
+        journal.trackfile = None
+    journal.start()
+    trackfile = Trackfile(user=user, datatype=datatype)
     try:
-        trackfile = save_trackfile(fname, user, options["override"])
-        if trackfile:
-            trackfile.parse_trackfile()
-            return trackfile
-    except IntegrityError as err:
-        logging.error(f"{err}")
-        raise
+        saved = trackfile.set_file(fname, fname, override=options["override"])
+        if saved is False and not created and delete_incomplete_trackfiles(user, trackfile.sha1):
+            # Previous run was interrupted before the Trackfile was journaled
+            saved = trackfile.set_file(fname, fname)
+        if saved is False:
+            journal.finish("DUPLICATE", trackfile)
+            return
+        journal.trackfile = trackfile
+        journal.save(update_fields=["trackfile", "updated_at"])
+        trackfile.parse_trackfile()
+    except Exception as err:
+        logging.error(f"Failed to process {fname}: {err}")
+        # Remove partially saved Trackfile, so the file can be retried later
+        if trackfile.pk is not None:
+            delete_trackfile(trackfile)
+        journal.finish("FAILED", trackfile, error=repr(err))
+        if isinstance(err, IntegrityError):
+            raise
+        return
+    journal.finish("DONE", trackfile)
+    return trackfile
+
+
+def delete_incomplete_trackfiles(user: User, sha1: str) -> int:
+    """
+    Delete user's Trackfiles with given sha1, whose parsing has never finished, and return their number.
+    parse_trackfile() sets trackpoint_cnt in the same transaction with Trackpoints, so it is NULL only
+    if the process died between saving the file and parsing it.
+    """
+    cnt = 0
+    for trackfile in Trackfile.objects.filter(user=user, sha1=sha1, trackpoint_cnt__isnull=True):
+        logging.info(f"Removing incomplete {trackfile}")
+        delete_trackfile(trackfile)
+        cnt += 1
+    return cnt
+
+
+def format_duplicate_sources(trackfile: Trackfile) -> str:
+    """Return a string listing Trackfiles, which already contained this Trackfile's duplicate trackpoints."""
+    if not trackfile.duplicate_sources:
+        return ""
+    sources = Trackfile.objects.in_bulk([int(pk) for pk in trackfile.duplicate_sources.keys()])
+    return "(found in {})".format(
+        ", ".join(f"{sources.get(int(pk), pk)}: {cnt}" for pk, cnt in trackfile.duplicate_sources.items())
+    )
 
 
 class Command(BaseCommand):
-    help = "Parse GPS track files and save tracks into the database"
+    help = "Parse GPS track files (GPX, TCX, FIT, GeoJSON, NMEA, Google Takeout) and save tracks into the database"
 
     def add_arguments(self, parser):
         parser.add_argument("files", nargs="+", type=str)
@@ -45,17 +110,26 @@ class Command(BaseCommand):
             format="%(asctime)s %(levelname)-8s %(message)s",
             level=getattr(logging, options["log"]),
         )
-        success = ignore = 0
+        success = ignore = duplicates = 0
         for fname in options["files"]:
             trackfile = handle_file(fname, options)
             if trackfile:
                 logging.info(
-                    "Saved {}: {} trackpoints, {} simplified trackpoints".format(
-                        trackfile.filename, trackfile.trackpoint_cnt, trackfile.geometry.num_points
+                    "Saved {}: {} trackpoints, {} simplified trackpoints, {} duplicate trackpoints {}".format(
+                        trackfile.filename,
+                        trackfile.trackpoint_cnt,
+                        trackfile.geometry.num_points if trackfile.geometry else 0,
+                        trackfile.duplicate_cnt,
+                        format_duplicate_sources(trackfile),
                     )
                 )
                 success += 1
+                duplicates += trackfile.duplicate_cnt or 0
             else:
                 logging.info(f"Ignored {fname}")
                 ignore += 1
-        self.stdout.write(self.style.SUCCESS(f"Saved {success} and ignored {ignore} track files"))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Saved {success} and ignored {ignore} track files, skipped {duplicates} duplicate trackpoints"
+            )
+        )
@@ -0,0 +1,45 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from track.management.commands.parse_gpxfiles import format_duplicate_sources, handle_file
+
+
+class Command(BaseCommand):
+    help = "Parse Google Takeout Location History files (Records.json) and save tracks into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", type=str)
+        parser.add_argument("-u", "--username", required=True)
+        parser.add_argument("-o", "--override", action="store_true", help="Delete previously saved identical file")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        success = ignore = 0
+        for fname in options["files"]:
+            trackfile = handle_file(fname, options, datatype="GOOGLE_TAKEOUT_JSON")
+            if trackfile:
+                logging.info(
+                    "Saved {}: {} trackpoints ({} - {}), {} duplicate trackpoints {}".format(
+                        trackfile.filename,
+                        trackfile.trackpoint_cnt,
+                        trackfile.starttime,
+                        trackfile.endtime,
+                        trackfile.duplicate_cnt,
+                        format_duplicate_sources(trackfile),
+                    )
+                )
+                success += 1
+            else:
+                logging.info(f"Ignored {fname}")
+                ignore += 1
+        self.stdout.write(self.style.SUCCESS(f"Saved {success} and ignored {ignore} Location History files"))
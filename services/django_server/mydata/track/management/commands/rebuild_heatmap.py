@@ -0,0 +1,38 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from track.models import HeatmapCell, Trackfile, update_heatmap
+
+
+class Command(BaseCommand):
+    help = "Rebuild users' precomputed trackpoint heatmaps from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-u", "--username", help="Rebuild only this user's heatmap")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        users = User.objects.all()
+        if options["username"]:
+            users = users.filter(username=options["username"])
+            if not users.exists():
+                raise CommandError("User '{}' does not exist.".format(options["username"]))
+        for user in users:
+            HeatmapCell.objects.filter(user=user).delete()
+            trackfiles = Trackfile.objects.filter(user=user, trackpoint_cnt__gt=0).order_by("starttime")
+            for trackfile in trackfiles.iterator():
+                logging.info(f"Adding {trackfile} to heatmap")
+                update_heatmap(trackfile)
+            cnt = HeatmapCell.objects.filter(user=user).count()
+            self.stdout.write(self.style.SUCCESS(f"{user}: {cnt} heatmap cells from {trackfiles.count()} track files"))
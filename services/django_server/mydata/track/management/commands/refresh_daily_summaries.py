@@ -0,0 +1,58 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils.dateparse import parse_date
+
+from track.models import Trackseg, days_between, refresh_daily_summaries
+
+
+class Command(BaseCommand):
+    help = "Recompute daily summaries of users' movement, visits, events and records"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-u", "--username", help="Refresh only this user's summaries")
+        parser.add_argument("--start", help="First date to refresh (YYYY-MM-DD), default is the first day with data")
+        parser.add_argument("--end", help="Last date to refresh (YYYY-MM-DD), default is the last day with data")
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        users = User.objects.all()
+        if options["username"]:
+            users = users.filter(username=options["username"])
+            if not users.exists():
+                raise CommandError("User '{}' does not exist.".format(options["username"]))
+        for key in ["start", "end"]:
+            if options[key] and parse_date(options[key]) is None:
+                raise CommandError(f"Invalid --{key} value {options[key]}")
+        for user in users:
+            spans = [Trackseg.objects.filter(user=user).aggregate(start=Min("starttime"), end=Max("endtime"))]
+            if "timeline" in settings.INSTALLED_APPS:
+                from timeline.models import Event
+
+                spans.append(Event.objects.filter(user=user).aggregate(start=Min("starttime"), end=Max("starttime")))
+            if "logbook" in settings.INSTALLED_APPS:
+                from logbook.models import Record
+
+                spans.append(Record.objects.filter(user=user).aggregate(start=Min("time"), end=Max("time")))
+            starts = [span["start"] for span in spans if span["start"]]
+            ends = [span["end"] for span in spans if span["end"]]
+            days = days_between(min(starts, default=None), max(ends, default=None))
+            if options["start"]:
+                days = [day for day in days if day >= parse_date(options["start"])]
+            if options["end"]:
+                days = [day for day in days if day <= parse_date(options["end"])]
+            logging.info(f"{user}: refreshing {len(days)} days")
+            refresh_daily_summaries(user.id, days)
+            self.stdout.write(self.style.SUCCESS(f"{user}: refreshed {len(days)} daily summaries"))
@@ -0,0 +1,234 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from track.management.commands.parse_gpxfiles import handle_file
+
+try:
+    import inotify_simple
+except ImportError:  # inotify is available only in Linux, use polling elsewhere
+    inotify_simple = None
+
+
+def walk_files(directories: List[str]) -> Iterator[str]:
+    """Yield full paths of all (non-hidden) files in directories and their subdirectories."""
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in files:
+                if not name.startswith("."):
+                    yield os.path.join(root, name)
+
+
+def file_signature(path: str) -> Tuple[int, float]:
+    """Return file's size and modification time or raise OSError if it has disappeared."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class InotifyWatcher:
+    """Report changed files in watched directories using Linux inotify."""
+
+    def __init__(self, directories: List[str]):
+        self.inotify = inotify_simple.INotify()
+        self.mask = (
+            inotify_simple.flags.CLOSE_WRITE
+            | inotify_simple.flags.MOVED_TO
+            | inotify_simple.flags.MODIFY
+            | inotify_simple.flags.CREATE
+        )
+        self.watches = {}  # watch descriptor -> directory
+        for directory in directories:
+            self.add_tree(directory)
+
+    def add_tree(self, directory: str):
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            self.watches[self.inotify.add_watch(root, self.mask)] = root
+
+    def changed_files(self, timeout: float) -> List[str]:
+        paths = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.wd not in self.watches or event.name.startswith("."):
+                continue
+            path = os.path.join(self.watches[event.wd], event.name)
+            if event.mask & inotify_simple.flags.ISDIR:
+                if event.mask & (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO):
+                    self.add_tree(path)
+                    paths += list(walk_files([path]))  # Files may have been created before the watch
+            else:
+                paths.append(path)
+        return paths
+
+
+class PollingWatcher:
+    """Report changed files in watched directories by comparing file sizes and modification times."""
+
+    def __init__(self, directories: List[str], interval: float):
+        self.directories = directories
+        self.interval = interval
+        self.known = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, float]]:
+        known = {}
+        for path in walk_files(self.directories):
+            try:
+                known[path] = file_signature(path)
+            except OSError:
+                pass
+        return known
+
+    def changed_files(self, timeout: float) -> List[str]:
+        time.sleep(max(timeout, self.interval))
+        current = self.scan()
+        paths = [path for path, signature in current.items() if self.known.get(path) != signature]
+        self.known = current
+        return paths
+
+
+class PendingFiles:
+    """
+    Debounce changed files: a file is ready to be processed when its size and modification time
+    haven't changed in 'settle' seconds. A file is never handed out again while it is being processed,
+    so two workers never handle the same path at once.
+    """
+
+    def __init__(self, settle: float):
+        self.settle = settle
+        self.pending = {}  # path -> (signature, time of last change)
+        self.active = set()  # paths queued or being processed
+        self.lock = threading.Lock()
+
+    def add(self, paths: List[str], now: float):
+        for path in paths:
+            self.pending[path] = (None, now)
+
+    def ready(self, now: float) -> List[str]:
+        """Return paths which have settled and mark them active."""
+        paths = []
+        for path, (signature, changed_at) in list(self.pending.items()):
+            try:
+                current = file_signature(path)
+            except OSError:  # File was removed or renamed
+                del self.pending[path]
+                continue
+            if current != signature:
+                self.pending[path] = (current, now)
+            elif now - changed_at >= self.settle:
+                with self.lock:
+                    if path in self.active:  # Check again after the running worker has finished
+                        continue
+                    self.active.add(path)
+                del self.pending[path]
+                paths.append(path)
+        return paths
+
+    def done(self, path: str):
+        with self.lock:
+            self.active.discard(path)
+
+
+def create_watcher(directories: List[str], poll: float):
+    """Return InotifyWatcher or PollingWatcher, if polling is requested or inotify is not available."""
+    if poll > 0 or inotify_simple is None:
+        watcher = PollingWatcher(directories, poll or 10.0)
+        logging.info(f"Polling {', '.join(directories)} every {watcher.interval} seconds")
+    else:
+        watcher = InotifyWatcher(directories)
+        logging.info(f"Watching {', '.join(directories)} using inotify")
+    return watcher
+
+
+def worker(tasks: queue.Queue, pending: PendingFiles, options: dict):
+    """Process files from the queue until None is received."""
+    while True:
+        path = tasks.get()
+        try:
+            if path is None:
+                return
+            close_old_connections()
+            trackfile = handle_file(path, options)
+            if trackfile:
+                logging.info(f"Saved {path}: {trackfile.trackpoint_cnt} trackpoints")
+        except Exception as err:
+            logging.exception(f"Failed to process {path}: {err}")
+        finally:
+            tasks.task_done()
+            if path is None:
+                connection.close()
+            else:
+                pending.done(path)
+
+
+class Command(BaseCommand):
+    help = "Watch directories for new GPS track files and save tracks into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directories", nargs="+", type=str)
+        parser.add_argument("-u", "--username", required=True)
+        parser.add_argument("-w", "--workers", type=int, default=2, help="Number of ingestion workers")
+        parser.add_argument("--queue-size", type=int, default=100, help="Max number of files waiting for a worker")
+        parser.add_argument(
+            "--settle",
+            type=float,
+            default=5.0,
+            help="Seconds a file's size and modification time must stay unchanged before it is processed",
+        )
+        parser.add_argument(
+            "--poll", type=float, default=0, help="Poll directories every n seconds instead of using inotify"
+        )
+        parser.add_argument(
+            "--initial-scan", action="store_true", help="Process also files which exist already at startup"
+        )
+        parser.add_argument(
+            "--log",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="ERROR",
+            help="Set the logging level",
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-8s %(threadName)s %(message)s",
+            level=getattr(logging, options["log"]),
+        )
+        if not User.objects.filter(username=options["username"]).exists():
+            raise CommandError("User '{}' does not exist.".format(options["username"]))
+        directories = [os.path.abspath(d) for d in options["directories"]]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                raise CommandError(f"{directory} is not a directory")
+        options["override"] = False
+        watcher = create_watcher(directories, options["poll"])
+
+        # Files are queued only after their size and mtime haven't changed in 'settle' seconds
+        pending = PendingFiles(options["settle"])
+        tasks = queue.Queue(maxsize=options["queue_size"])
+        threads = [
+            threading.Thread(target=worker, args=(tasks, pending, options), name=f"worker-{i}")
+            for i in range(options["workers"])
+        ]
+        for t in threads:
+            t.start()
+
+        if options["initial_scan"]:
+            pending.add(list(walk_files(directories)), time.monotonic())
+        try:
+            while True:
+                pending.add(watcher.changed_files(timeout=1.0), time.monotonic())
+                for path in pending.ready(time.monotonic()):
+                    tasks.put(path)  # Blocks when workers are busy and queue is full
+        except KeyboardInterrupt:
+            logging.info("Stopping, waiting for workers to finish")
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for t in threads:
+                t.join()
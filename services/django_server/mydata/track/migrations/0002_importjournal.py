@@ -0,0 +1,38 @@
+# Generated by Django 3.2 on 2026-10-19 08:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('track', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJournal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(editable=False, max_length=1024)),
+                ('filesize', models.BigIntegerField(db_index=True, editable=False)),
+                ('mtime', models.FloatField(editable=False)),
+                ('status', models.CharField(choices=[('STARTED', 'Started'), ('DONE', 'Done'), ('DUPLICATE', 'Duplicate'), ('FAILED', 'Failed')], default='STARTED', max_length=40)),
+                ('sha1', models.CharField(blank=True, editable=False, max_length=40)),
+                ('started_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('duration', models.FloatField(blank=True, db_index=True, editable=False, null=True)),
+                ('error', models.TextField(blank=True, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('trackfile', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='journal', to='track.trackfile')),
+                ('user', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'path', 'filesize', 'mtime')},
+            },
+        ),
+    ]
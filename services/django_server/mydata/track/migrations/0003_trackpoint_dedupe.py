@@ -0,0 +1,44 @@
+# Generated by Django 3.2 on 2026-10-19 08:44
+
+from django.db import migrations, models
+
+# Mark already saved duplicates (all but the first saved one) with status 2
+# so the unique index can be created
+MARK_DUPLICATES_SQL = """
+UPDATE track_trackpoint SET status = 2 WHERE id IN (
+    SELECT id FROM (
+        SELECT id, row_number() OVER (
+            PARTITION BY user_id, time, round(lat::numeric, 5), round(lon::numeric, 5) ORDER BY id
+        ) AS rn
+        FROM track_trackpoint WHERE status = 1
+    ) AS t WHERE rn > 1
+)
+"""
+
+CREATE_INDEX_SQL = """
+CREATE UNIQUE INDEX track_trackpoint_dedupe
+ON track_trackpoint (user_id, time, round(lat::numeric, 5), round(lon::numeric, 5))
+WHERE status = 1
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0002_importjournal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackfile',
+            name='duplicate_cnt',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='trackfile',
+            name='duplicate_sources',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(MARK_DUPLICATES_SQL, reverse_sql="UPDATE track_trackpoint SET status = 1 WHERE status = 2"),
+        migrations.RunSQL(CREATE_INDEX_SQL, reverse_sql="DROP INDEX track_trackpoint_dedupe"),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0003_trackpoint_dedupe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackfile',
+            name='filter_stats',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-19 08:53
+
+import django.core.files.storage
+from django.db import migrations, models
+import track.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0004_trackfile_filter_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackfile',
+            name='archive',
+            field=models.FileField(blank=True, editable=False, storage=django.core.files.storage.FileSystemStorage(location='/tmp'), upload_to=track.models.get_trackfile_upload_to),
+        ),
+        migrations.AddField(
+            model_name='trackfile',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
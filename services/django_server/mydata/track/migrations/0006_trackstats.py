@@ -0,0 +1,36 @@
+# Generated by Django 3.2 on 2026-10-19 08:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0005_trackfile_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trackstats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('distance', models.FloatField(default=0)),
+                ('duration', models.FloatField(default=0)),
+                ('moving_time', models.FloatField(default=0)),
+                ('avg_speed', models.FloatField(blank=True, null=True)),
+                ('max_speed', models.FloatField(blank=True, null=True)),
+                ('ascent', models.FloatField(blank=True, null=True)),
+                ('descent', models.FloatField(blank=True, null=True)),
+                ('min_ele', models.FloatField(blank=True, null=True)),
+                ('max_ele', models.FloatField(blank=True, null=True)),
+                ('elevation_profile', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('trackfile', models.OneToOneField(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='track.trackfile')),
+                ('trackseg', models.OneToOneField(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='track.trackseg')),
+            ],
+            options={
+                'verbose_name_plural': 'trackstats',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-19 09:01
+
+from django.conf import settings
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('track', '0006_trackstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Visit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('arrival', models.DateTimeField(db_index=True, editable=False)),
+                ('departure', models.DateTimeField(db_index=True, editable=False)),
+                ('duration', models.FloatField(editable=False)),
+                ('trackpoint_cnt', models.IntegerField(editable=False)),
+                ('lat', models.FloatField(editable=False)),
+                ('lon', models.FloatField(editable=False)),
+                ('geometry', django.contrib.gis.db.models.fields.PointField(db_index=True, editable=False, geography=True, srid=4326)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('trackfile', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='visits', to='track.trackfile')),
+                ('user', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
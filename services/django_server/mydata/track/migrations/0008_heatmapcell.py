@@ -0,0 +1,30 @@
+# Generated by Django 3.2 on 2026-10-19 09:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('track', '0007_visit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeatmapCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.SmallIntegerField(editable=False)),
+                ('x', models.IntegerField(editable=False)),
+                ('y', models.IntegerField(editable=False)),
+                ('count', models.IntegerField(default=0, editable=False)),
+                ('user', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'zoom', 'x', 'y')},
+            },
+        ),
+    ]
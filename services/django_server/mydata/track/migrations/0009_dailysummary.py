@@ -0,0 +1,41 @@
+# Generated by Django 3.2 on 2026-10-19 09:04
+
+from django.conf import settings
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('track', '0008_heatmapcell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(editable=False)),
+                ('distance', models.FloatField(default=0)),
+                ('moving_time', models.FloatField(default=0)),
+                ('trackpoint_cnt', models.IntegerField(default=0)),
+                ('min_lat', models.FloatField(blank=True, null=True)),
+                ('min_lon', models.FloatField(blank=True, null=True)),
+                ('max_lat', models.FloatField(blank=True, null=True)),
+                ('max_lon', models.FloatField(blank=True, null=True)),
+                ('geometry', django.contrib.gis.db.models.fields.MultiLineStringField(blank=True, editable=False, geography=True, null=True, srid=4326)),
+                ('visit_cnt', models.IntegerField(default=0)),
+                ('event_cnt', models.IntegerField(default=0)),
+                ('record_cnt', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'daily summaries',
+                'unique_together': {('user', 'date')},
+            },
+        ),
+    ]
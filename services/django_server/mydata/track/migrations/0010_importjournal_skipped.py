@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0009_dailysummary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importjournal',
+            name='status',
+            field=models.CharField(choices=[('STARTED', 'Started'), ('DONE', 'Done'), ('DUPLICATE', 'Duplicate'), ('SKIPPED', 'Skipped'), ('FAILED', 'Failed')], default='STARTED', max_length=40),
+        ),
+    ]
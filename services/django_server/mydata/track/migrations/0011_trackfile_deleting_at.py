@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 09:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0010_importjournal_skipped'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackfile',
+            name='deleting_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
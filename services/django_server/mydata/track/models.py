@@ -1,26 +1,70 @@
+import atexit
+import datetime
 import gzip
 import hashlib
+import heapq
 import io
+import itertools
+import logging
 import os
-from typing import List, Optional
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import gpxpy
+import numpy as np
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
-from django.contrib.gis.geos import Point, LineString, MultiLineString
+from django.contrib.gis.geos import Point, LineString, MultiLineString, Polygon
+from django.contrib.gis.measure import D
+from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
-from django.db import transaction
-from django.db.models.signals import post_delete
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 
-from track.utils import simplify, parse_gpxfile
+from track.utils import (
+    ARCHIVE_FIELDS,
+    TrackpointFilter,
+    detect_stay_points,
+    discrete_frechet,
+    downsample_coordinates,
+    filter_trackpoint_arrays,
+    from_microseconds,
+    heatmap_cells,
+    interpolate_positions,
+    iter_gpx,
+    nan_to_none,
+    merge_track_statistics,
+    parse_trackpoint_batches,
+    parsers,
+    project_coordinates,
+    render_track_thumbnail,
+    runs_within_radius,
+    simplify,
+    to_microseconds,
+    track_statistics,
+    trackpoint_rows_to_arrays,
+)
 
 trackfile_storage = FileSystemStorage(location=settings.TRACK.get("FILE_DIR"))
 
 TIMEFORMAT = "%Y-%m-%dT%H:%M:%S%Z"
+FILE_CHUNK_SIZE = 1 << 20
+# Trackpoints posted to the HTTP ingest endpoint are saved into one Trackfile per user and local day
+LIVE_TRACKFILE_NAME = "live-{}.json"
+# resolve_positions() fetches Trackpoints once for timestamps, which are max GAP seconds apart
+# and span max SPAN seconds
+RESOLVE_CLUSTER_GAP = 6 * 3600
+RESOLVE_CLUSTER_SPAN = 7 * 24 * 3600
 
 
 def get_trackfile_upload_to(obj, filename):
@@ -66,6 +110,20 @@ class Trackfile(models.Model):
     endtime = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
     # Total number of valid and unique trackpoints found
     trackpoint_cnt = models.IntegerField(blank=True, null=True)
+    # Number of trackpoints skipped because they already existed
+    # and Trackfiles where they were found ({"trackfile id": count})
+    duplicate_cnt = models.IntegerField(blank=True, null=True, editable=False)
+    duplicate_sources = models.JSONField(blank=True, null=True, editable=False)
+    # Number of trackpoints dropped by TrackpointFilter, by reason
+    filter_stats = models.JSONField(blank=True, null=True, editable=False)
+    # Trackpoints moved from the database into a compressed NumPy .npz file, see archive_trackpoints()
+    archive = models.FileField(
+        storage=trackfile_storage, upload_to=get_trackfile_upload_to, blank=True, editable=False
+    )
+    archived_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
+    # Set when deletion is started in background, so that an interrupted deletion can be resumed
+    # with "manage.py delete_trackfiles --pending"
+    deleting_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
     geometry = models.MultiLineStringField(geography=True, blank=True, null=True, db_index=True, editable=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
@@ -76,58 +134,77 @@ class Trackfile(models.Model):
         unique_together = ("user", "sha1")
 
     def set_trackpoint_fields(self):
-        """Precalculated values for trackpoint count and first/last timestamps."""
-        trackpoints = self.trackpoints.order_by("time")
+        """Precalculated values for valid trackpoint count and first/last timestamps."""
+        trackpoints = self.trackpoints.filter(status=1).order_by("time")
         self.trackpoint_cnt = trackpoints.count()
         if self.trackpoint_cnt > 0:
-            self.starttime = trackpoints[0].time
-            self.endtime = trackpoints[self.trackpoint_cnt - 1].time
+            self.starttime = trackpoints.first().time
+            self.endtime = trackpoints.last().time
         self.save()
 
-    def set_file(self, originalfilename: str, filecontent, override=False):
+    def set_file(self, originalfilename: str, filecontent, override=False, sha1: Optional[str] = None):
         """
         Set Trackpoint.file and all it's related fields.
         filecontent may be
         - open file handle (opened in "rb"-mode)
         - existing file name (full path)
-        NOTE: this reads all file content into memory
+        File content is read in chunks, so also huge files can be saved.
+        If sha1 is given, it identifies the file instead of the hash of its content.
         """
         if hasattr(filecontent, "read"):
-            filecontent.seek(0)
-            filedata = filecontent.read()
-            filecontent.close()
+            f = filecontent
         elif len(filecontent) < 1000 and os.path.isfile(filecontent):
-            with open(filecontent, "rb") as f:
-                filedata = f.read()
+            f = open(filecontent, "rb")
         else:
             raise ValueError(f"Expecting a file handle or path to existing file, got {filecontent}")
+        with f:
+            return self._set_file(originalfilename, f, override, sha1)
+
+    def _set_file(self, originalfilename: str, f, override=False, sha1: Optional[str] = None):
         if originalfilename:
             self.filename = os.path.basename(originalfilename)
         else:  # Dummy name for nameless data (e.g. AJAX POSTs)
             self.filename = "http.post"
         root, ext = os.path.splitext(self.filename)
-        self.filesize = len(filedata)
-        self.sha1 = hashlib.sha1(filedata).hexdigest()
-        exists = Trackfile.objects.filter(sha1=self.sha1)
+        f.seek(0)
+        content_sha1 = hashlib.sha1()
+        self.filesize = 0
+        for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b""):
+            content_sha1.update(chunk)
+            self.filesize += len(chunk)
+        self.sha1 = sha1 or content_sha1.hexdigest()
+        exists = Trackfile.objects.filter(user=self.user, sha1=self.sha1)
         if exists.count() > 0:
             if override:
-                exists.delete()
+                for trackfile in exists:
+                    delete_trackfile(trackfile)
             else:
                 return False
         self.save()
         filename = "{:09}-{}{}.gz".format(self.id, slugify(root), ext.lower())
         # Compress filedata to preserve disk space
-        file_out = io.BytesIO()
-        gzipper = gzip.GzipFile(fileobj=file_out, mode="wb")
-        gzipper.write(filedata)
-        gzipper.flush()
-        gzipper.close()
-        file_out.flush()
-        self.file.save(filename, ContentFile(file_out.getvalue()))
+        f.seek(0)
+        with tempfile.TemporaryFile() as file_out:
+            with gzip.GzipFile(fileobj=file_out, mode="wb") as gzipper:
+                shutil.copyfileobj(f, gzipper, FILE_CHUNK_SIZE)
+            file_out.seek(0)
+            self.file.save(filename, File(file_out))
         self.compression = "gzip"
         self.save()
         return True
 
+    def append_file(self, data: bytes):
+        """
+        Append data to the original file as a new gzip member and update filesize.
+        Used for live Trackfiles, whose data arrives in parts. gzip readers decompress concatenated
+        members as one stream. Live Trackfiles are identified by their name (see live_trackfile_sha1()),
+        so the file is not read again to rehash it.
+        """
+        with open(self.file.path, "ab") as f:
+            f.write(gzip.compress(data))
+        self.filesize = (self.filesize or 0) + len(data)
+        self.save(update_fields=["filesize", "updated_at"])
+
     def generate_tracksegments(self):
         """
         Deletes old Trackseg objects between given range from the database.
@@ -136,46 +213,265 @@ class Trackfile(models.Model):
         # First delete all Tracksegments of this Trackfile
         self.tracksegs.all().delete()
         # Then recreate
-        trackpoints = self.trackpoints.order_by("time")
-        points = []
-        tracksegs = []
-        # TODO: configurable options
-        maxtime = 120  # seconds
-        limit = 1000
-        for tp in trackpoints:  # Loop all Trackpoints (max 'limit')
-            timediff = (tp.time - points[-1].time).seconds if points else 0  # Seconds between 2 last points
-            if timediff > maxtime or len(points) >= limit:
-                trackseg = trackpointlist_to_trackseg(self, points)  # Create new Trackseg
-                tracksegs.append(trackseg)
-                # if track was split because of limit then reuse the last point
-                if len(points) >= limit:
-                    points = [points[-1]]
-                else:
-                    points = []
-            points.append(tp)
-        trackseg = trackpointlist_to_trackseg(self, points)  # Create last new Trackseg
-        tracksegs.append(trackseg)
-        simplified_linestrings = []
-        for trackseg in tracksegs:
-            simplified_linestrings.append(simplify(trackseg.geometry, 30))
-        self.geometry = MultiLineString(simplified_linestrings)
+        tracksegs = create_tracksegs(self, self.trackpoints.filter(status=1).order_by("time"))
+        self.geometry = MultiLineString([simplify(trackseg.geometry, 30) for trackseg in tracksegs])
         self.save()
 
+    def append_tracksegments(self) -> int:
+        """
+        Incrementally add Trackpoints, which are newer than current endtime, to Tracksegs.
+        Only the last Trackseg gets rebuilt, if new Trackpoints continue it,
+        and trackpoint_cnt, starttime, endtime and geometry are updated without
+        rescanning older Trackpoints.
+        :return: number of new Trackpoints
+        """
+        new_trackpoints = self.trackpoints.filter(status=1).order_by("time")
+        if self.endtime is not None:
+            new_trackpoints = new_trackpoints.filter(time__gt=self.endtime)
+        new_cnt = new_trackpoints.count()
+        if new_cnt == 0:
+            return 0
+        trackpoints = new_trackpoints
+        linestrings = list(self.geometry) if self.geometry else []
+        last_trackseg = self.tracksegs.order_by("starttime").last() if self.endtime is not None else None
+        if last_trackseg is not None:
+            # Rebuild the last Trackseg, because new Trackpoints may continue it
+            trackpoints = self.trackpoints.filter(status=1, time__gte=last_trackseg.starttime).order_by("time")
+            last_trackseg.delete()
+            linestrings = linestrings[:-1]
+        tracksegs = create_tracksegs(self, trackpoints)
+        linestrings += [simplify(trackseg.geometry, 30) for trackseg in tracksegs]
+        self.geometry = MultiLineString(linestrings)
+        self.trackpoint_cnt = (self.trackpoint_cnt or 0) + new_cnt
+        self.starttime = self.starttime or tracksegs[0].starttime
+        self.endtime = tracksegs[-1].endtime
+        self.save()
+        return new_cnt
+
+    def process_trackpoints(self, append: bool = False):
+        """
+        Set trackpoint fields and generate track segment objects from saved Trackpoints.
+        If append is True, only Trackpoints newer than current endtime are processed.
+        """
+        if append:
+            previous_endtime = self.endtime
+            self.append_tracksegments()
+            self.delete_thumbnails()
+            compute_trackstats(self, self.tracksegs.filter(stats__isnull=True))
+            update_heatmap(self, after=previous_endtime)
+            refresh_daily_summaries(self.user_id, days_between(previous_endtime or self.starttime, self.endtime))
+            if previous_endtime is not None:
+                # A stay shorter than min duration at the end of old Trackpoints may continue in new ones
+                min_duration = settings.TRACK.get("VISIT_MIN_DURATION", 600)
+                detect_visits(self, start=previous_endtime - datetime.timedelta(seconds=min_duration))
+            else:
+                detect_visits(self)
+            return
+        self.set_trackpoint_fields()
+        if self.trackpoint_cnt > 0:
+            self.generate_tracksegments()
+            self.delete_thumbnails()
+            compute_trackstats(self)
+            detect_visits(self)
+            update_heatmap(self)
+            refresh_daily_summaries(self.user_id, days_between(self.starttime, self.endtime))
+
+    def save_ingest_stats(self, received_cnt: int, filter_stats: Optional[dict] = None):
+        """
+        Save the number of trackpoints, which were not saved because they were duplicates,
+        and TrackpointFilter's statistics.
+        """
+        self.duplicate_cnt = received_cnt - (self.trackpoint_cnt or 0)
+        self.filter_stats = filter_stats
+        self.save(update_fields=["duplicate_cnt", "duplicate_sources", "filter_stats"])
+
+    def get_thumbnail_name(self, size: int) -> str:
+        """Return the name of cached thumbnail image in trackfile_storage, next to the original file."""
+        directory = os.path.dirname(self.file.name) if self.file else os.path.dirname(get_trackfile_upload_to(self, ""))
+        return os.path.join(directory, "{:09}-thumbnail-{}.png".format(self.id, size))
+
+    def get_thumbnail(self, size: int = 128) -> Optional[str]:
+        """
+        Return the path of a PNG preview image of Trackfile's geometry.
+        The image is rendered on first request and cached on disk.
+        """
+        if not self.geometry:
+            return None
+        name = self.get_thumbnail_name(size)
+        if not trackfile_storage.exists(name):
+            png = render_track_thumbnail(self.geometry.coords, size=size)
+            name = trackfile_storage.save(name, ContentFile(png))
+        return trackfile_storage.path(name)
+
+    def delete_thumbnails(self):
+        """Delete cached thumbnails, e.g. when geometry has changed."""
+        directory = os.path.dirname(self.get_thumbnail_name(0))
+        prefix = "{:09}-thumbnail-".format(self.id)
+        if trackfile_storage.exists(directory):
+            for filename in trackfile_storage.listdir(directory)[1]:
+                if filename.startswith(prefix):
+                    trackfile_storage.delete(os.path.join(directory, filename))
+
+    def iter_trackpoint_batches(self) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+        """Parse original file according to datatype and yield its trackpoints in batches."""
+        with self.get_file_handle() as f:
+            # Files saved before datatype was set are GPX files
+            yield from parse_trackpoint_batches(f, self.datatype or "GPX_FILE")
+
     def parse_trackfile(self):
         """
-        Parse GPX file, create Trackpoints for all trackpoints found in it,
+        Parse original file, create Trackpoints for all trackpoints found in it,
         set start and end times and finally generate track segment objects
         related to this Trackfile.
         """
         with transaction.atomic():
-            with self.get_file_handle() as f:
-                gpx = gpxpy.parse(f)
-            points = parse_gpxfile(gpx)
-            if points is None:
-                return None
+            trackpoint_filter = TrackpointFilter.from_settings()
+            saved_cnt = 0
+            # Parsing again finds the same duplicates, see restore_duplicates()
+            self.duplicate_sources = {}
+            for points in self.iter_trackpoint_batches():
+                points = trackpoint_filter(points)
+                save_trackpoints(points, self)
+                saved_cnt += len(points)
+            points = trackpoint_filter.finish()
             save_trackpoints(points, self)
-            self.set_trackpoint_fields()
-            self.generate_tracksegments()
+            saved_cnt += len(points)
+            self.process_trackpoints()
+            self.save_ingest_stats(saved_cnt, trackpoint_filter.stats)
+
+    def archive_trackpoints(self, chunk_size: int = 10000):
+        """
+        Move Trackpoints into a compressed columnar archive file and delete them from the database.
+        Tracksegs and geometry are kept for maps and archived Trackpoints
+        can still be read using get_archived_trackpoints().
+        """
+        if not self.archive:
+            rows = self.trackpoints.order_by("time").values_list(*ARCHIVE_FIELDS).iterator(chunk_size=chunk_size)
+            arrays = trackpoint_rows_to_arrays(rows)
+            with tempfile.TemporaryFile() as file_out:
+                np.savez_compressed(file_out, **arrays)
+                file_out.seek(0)
+                self.archive.save("{:09}-trackpoints.npz".format(self.id), File(file_out), save=False)
+            self.archived_at = timezone.now()
+            self.save()
+        # Archive file exists now, so rerunning after an interrupted delete just continues it
+        delete_rows_in_chunks("track_trackpoint", self.pk, chunk_size)
+
+    def restore_trackpoints(self, chunk_size: int = 10000):
+        """Move archived Trackpoints back into the database and remove the archive file."""
+        if not self.archive:
+            return
+        trackpoints = self.get_archived_trackpoints(valid_only=False)
+        with transaction.atomic():
+            for i in range(0, len(trackpoints), chunk_size):
+                Trackpoint.objects.bulk_create(trackpoints[i: i + chunk_size], ignore_conflicts=True)
+            self.archive.delete(save=False)
+            self.archived_at = None
+            self.save()
+
+    def get_trackpoint_arrays(
+        self,
+        start=None,
+        end=None,
+        bbox: Optional[List[float]] = None,
+        fields: List[str] = ARCHIVE_FIELDS,
+        valid_only: bool = True,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Return Trackpoints ordered by time as columns, optionally filtered by time range and bbox.
+        Trackpoints are read from the archive file, if the Trackfile is archived.
+        Duplicate Trackpoints (status != 1) are left out, unless valid_only is False.
+        """
+        columns = list(dict.fromkeys(["time", "status", "lat", "lon"] + list(fields)))
+        if self.archive:
+            with self.archive.open("rb") as f, np.load(f) as data:
+                arrays = {field: data[field] for field in columns}
+            if valid_only:
+                valid = arrays["status"] == 1
+                arrays = {field: values[valid] for field, values in arrays.items()}
+        else:
+            trackpoints = self.trackpoints.order_by("time")
+            if valid_only:
+                trackpoints = trackpoints.filter(status=1)
+            if start is not None:
+                trackpoints = trackpoints.filter(time__gte=start)
+            if end is not None:
+                trackpoints = trackpoints.filter(time__lte=end)
+            arrays = trackpoint_rows_to_arrays(trackpoints.values_list(*columns).iterator(), columns)
+        arrays = filter_trackpoint_arrays(arrays, start, end, bbox)
+        return {field: arrays[field] for field in fields}
+
+    def iter_trackpoint_array_chunks(
+        self, start=None, fields: List[str] = ARCHIVE_FIELDS, chunk_size: int = 100000
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Yield valid Trackpoints ordered by time as columns in chunks of chunk_size Trackpoints,
+        so that Trackpoints of a huge Trackfile are not all read into memory at once.
+        """
+        if self.archive:
+            arrays = self.get_trackpoint_arrays(start, fields=fields)
+            for i in range(0, len(arrays[fields[0]]), chunk_size):
+                yield {field: values[i: i + chunk_size] for field, values in arrays.items()}
+            return
+        trackpoints = self.trackpoints.filter(status=1).order_by("time")
+        if start is not None:
+            trackpoints = trackpoints.filter(time__gte=start)
+        rows = trackpoints.values_list(*fields).iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield trackpoint_rows_to_arrays(chunk, fields)
+
+    def iter_archived_trackpoint_rows(
+        self, start=None, end=None, fields: List[str] = ARCHIVE_FIELDS
+    ) -> Iterator[tuple]:
+        """Yield archived valid Trackpoints as tuples of fields, like values_list() would."""
+        arrays = self.get_trackpoint_arrays(start, end, fields=list(dict.fromkeys(list(fields) + ["status"])))
+        valid = arrays["status"] == 1
+        columns = []
+        for field in fields:
+            values = arrays[field][valid]
+            if field in ["time", "created_at"]:
+                columns.append(from_microseconds(values))
+            elif field in ["sat", "satavail"]:
+                columns.append([None if v is None else int(v) for v in nan_to_none(values)])
+            elif values.dtype.kind == "f":
+                columns.append(nan_to_none(values))
+            else:
+                columns.append(values.tolist())
+        yield from zip(*columns)
+
+    def get_archived_trackpoints(
+        self, start=None, end=None, bbox: Optional[List[float]] = None, valid_only: bool = True
+    ) -> List["Trackpoint"]:
+        """Return archived Trackpoints as unsaved Trackpoint instances, ordered by time."""
+        if not self.archive:
+            return []
+        arrays = self.get_trackpoint_arrays(start, end, bbox, valid_only=valid_only)
+        columns = {}
+        for field, values in arrays.items():
+            if field in ["time", "created_at"]:
+                columns[field] = from_microseconds(values)
+            elif values.dtype.kind == "f":
+                columns[field] = nan_to_none(values)
+            else:
+                columns[field] = values.tolist()
+        trackpoints = []
+        for row in zip(*[columns[field] for field in ARCHIVE_FIELDS]):
+            data = dict(zip(ARCHIVE_FIELDS, row))
+            for field in ["sat", "satavail"]:
+                if data[field] is not None:
+                    data[field] = int(data[field])
+            trackpoints.append(
+                Trackpoint(
+                    user_id=self.user_id,
+                    trackfile_id=self.id,
+                    geometry=Point(data["lon"], data["lat"]),
+                    **data,
+                )
+            )
+        return trackpoints
 
     def get_file_handle(self):
         """
@@ -201,7 +497,73 @@ class Trackfile(models.Model):
 @receiver(post_delete, sender=Trackfile)
 def submission_delete(sender, instance, **kwargs):
     """Add .deleted postfix to files related to deleted Trackfile records"""
-    os.rename(instance.file.path, f"{instance.file.path}.deleted")
+    for f in [instance.file, instance.archive]:
+        if f and os.path.isfile(f.path):
+            os.rename(f.path, f"{f.path}.deleted")
+    instance.delete_thumbnails()
+
+
+class ImportJournal(models.Model):
+    """
+    Journal of track files processed by batch imports.
+    Entries are keyed by path, size and modification time,
+    so reruns can skip finished files without opening them.
+    """
+
+    user = models.ForeignKey(User, db_index=True, editable=False, on_delete=models.CASCADE)
+    trackfile = models.ForeignKey(
+        Trackfile, blank=True, null=True, editable=False, on_delete=models.SET_NULL, related_name="journal"
+    )
+    # Absolute path, size in bytes and modification time (os.stat().st_mtime) of the input file
+    path = models.CharField(max_length=1024, editable=False)
+    filesize = models.BigIntegerField(db_index=True, editable=False)
+    mtime = models.FloatField(editable=False)
+    status = models.CharField(
+        max_length=40,
+        default="STARTED",
+        choices=(
+            ("STARTED", "Started"),
+            ("DONE", "Done"),
+            ("DUPLICATE", "Duplicate"),
+            ("SKIPPED", "Skipped"),
+            ("FAILED", "Failed"),
+        ),
+    )
+    sha1 = models.CharField(max_length=40, blank=True, editable=False)
+    started_at = models.DateTimeField(blank=True, null=True, editable=False)
+    finished_at = models.DateTimeField(blank=True, null=True, editable=False)
+    duration = models.FloatField(blank=True, null=True, db_index=True, editable=False)  # seconds
+    error = models.TextField(blank=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("user", "path", "filesize", "mtime")
+
+    @property
+    def finished(self) -> bool:
+        """Return True if file needs not to be processed again."""
+        return self.status in ["DONE", "DUPLICATE", "SKIPPED"]
+
+    def start(self):
+        self.status = "STARTED"
+        self.started_at = timezone.now()
+        self.finished_at = self.duration = None
+        self.error = ""
+        self.save()
+
+    def finish(self, status: str, trackfile: Optional[Trackfile] = None, error: str = ""):
+        self.status = status
+        if trackfile is not None:
+            self.sha1 = trackfile.sha1
+        self.trackfile = trackfile if trackfile and trackfile.pk else None
+        self.error = error
+        self.finished_at = timezone.now()
+        self.duration = (self.finished_at - self.started_at).total_seconds()
+        self.save()
+
+    def __str__(self):
+        return "{} ({})".format(self.path, self.status)
 
 
 class Trackpoint(models.Model):
@@ -214,6 +576,9 @@ class Trackpoint(models.Model):
     trackfile = models.ForeignKey(
         Trackfile, db_index=True, blank=True, null=True, on_delete=models.CASCADE, related_name="trackpoints"
     )
+    # 1 = valid, 2 = duplicate (saved before deduplication was in use)
+    # Valid trackpoints are unique by user, time and position rounded to 5 decimals,
+    # see migrations/0003_trackpoint_dedupe.py
     status = models.IntegerField(default=1)
     time = models.DateTimeField(db_index=True)  # See ./sql/Trackpoint.sql
     # For convenience, lat and lon in numeric form too
@@ -290,6 +655,513 @@ class Trackseg(models.Model):
         return "{} ({} pnts, {} km)".format(self.starttime.strftime(TIMEFORMAT), self.trackpoint_cnt, self.length_km)
 
 
+class Trackstats(models.Model):
+    """
+    Precomputed statistics of a Trackseg or a Trackfile, see compute_trackstats().
+    Trackfile's statistics are combined from its Tracksegs' statistics,
+    so gaps between Tracksegs are not counted in distance or durations.
+    """
+
+    trackfile = models.OneToOneField(
+        Trackfile, blank=True, null=True, editable=False, on_delete=models.CASCADE, related_name="stats"
+    )
+    trackseg = models.OneToOneField(
+        Trackseg, blank=True, null=True, editable=False, on_delete=models.CASCADE, related_name="stats"
+    )
+    distance = models.FloatField(default=0)  # meters
+    duration = models.FloatField(default=0)  # seconds
+    moving_time = models.FloatField(default=0)  # seconds
+    avg_speed = models.FloatField(blank=True, null=True)  # m/s, while moving
+    max_speed = models.FloatField(blank=True, null=True)  # m/s
+    ascent = models.FloatField(blank=True, null=True)  # meters
+    descent = models.FloatField(blank=True, null=True)  # meters
+    min_ele = models.FloatField(blank=True, null=True)  # meters
+    max_ele = models.FloatField(blank=True, null=True)  # meters
+    # [[distance (m), elevation (m)], ...]
+    elevation_profile = models.JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "trackstats"
+
+    def __str__(self):
+        return "{} ({} km)".format(self.trackfile or self.trackseg, round(self.distance / 1000.0, 2))
+
+
+TRACKSTATS_FIELDS = [
+    "distance",
+    "duration",
+    "moving_time",
+    "avg_speed",
+    "max_speed",
+    "ascent",
+    "descent",
+    "min_ele",
+    "max_ele",
+    "elevation_profile",
+]
+
+
+class Visit(models.Model):
+    """
+    A place where the user stayed for a while, detected from a Trackfile's Trackpoints,
+    see detect_visits().
+    """
+
+    user = models.ForeignKey(User, db_index=True, editable=False, on_delete=models.CASCADE)
+    trackfile = models.ForeignKey(Trackfile, editable=False, on_delete=models.CASCADE, related_name="visits")
+    arrival = models.DateTimeField(db_index=True, editable=False)
+    departure = models.DateTimeField(db_index=True, editable=False)
+    duration = models.FloatField(editable=False)  # seconds
+    trackpoint_cnt = models.IntegerField(editable=False)
+    # Centroid of the Trackpoints of the stay
+    lat = models.FloatField(editable=False)
+    lon = models.FloatField(editable=False)
+    geometry = models.PointField(geography=True, db_index=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{},{} {} ({} min)".format(
+            round(self.lat, 5), round(self.lon, 5), self.arrival.strftime(TIMEFORMAT), round(self.duration / 60)
+        )
+
+
+class HeatmapCell(models.Model):
+    """
+    Number of user's valid Trackpoints in a Web Mercator tile at a zoom level.
+    Cells are maintained at every zoom level in TRACK["HEATMAP_ZOOMS"], see update_heatmap().
+    """
+
+    user = models.ForeignKey(User, editable=False, on_delete=models.CASCADE)
+    zoom = models.SmallIntegerField(editable=False)
+    x = models.IntegerField(editable=False)
+    y = models.IntegerField(editable=False)
+    count = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        unique_together = ("user", "zoom", "x", "y")
+
+    def __str__(self):
+        return "{}/{}/{} ({})".format(self.zoom, self.x, self.y, self.count)
+
+
+HEATMAP_ADD_SQL = """
+    INSERT INTO track_heatmapcell (user_id, zoom, x, y, count)
+    SELECT %s, unnest(%s::smallint[]), unnest(%s::integer[]), unnest(%s::integer[]), unnest(%s::integer[])
+    ON CONFLICT (user_id, zoom, x, y) DO UPDATE SET count = track_heatmapcell.count + EXCLUDED.count
+"""
+
+HEATMAP_SUBTRACT_SQL = """
+    UPDATE track_heatmapcell AS h SET count = h.count - c.count
+    FROM (SELECT unnest(%s::smallint[]) AS zoom, unnest(%s::integer[]) AS x,
+                 unnest(%s::integer[]) AS y, unnest(%s::integer[]) AS count) AS c
+    WHERE h.user_id = %s AND h.zoom = c.zoom AND h.x = c.x AND h.y = c.y
+"""
+
+
+def update_heatmap(
+    trackfile: Trackfile, after: Optional[datetime.datetime] = None, subtract: bool = False, chunk_size: int = 100000
+):
+    """
+    Add Trackfile's valid Trackpoints (only newer than 'after', if given) to user's HeatmapCells,
+    or subtract them, when the Trackfile is going to be deleted.
+    Counts are aggregated in NumPy and upserted with a single query per chunk of chunk_size Trackpoints.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        for arrays in trackfile.iter_trackpoint_array_chunks(after, ["time", "lat", "lon"], chunk_size):
+            valid = np.ones(len(arrays["time"]), dtype=bool)
+            if after is not None:
+                valid &= arrays["time"] > to_microseconds(after)
+            upsert_heatmap_cells(cursor, trackfile.user_id, arrays["lat"][valid], arrays["lon"][valid], subtract)
+        if subtract:
+            cursor.execute("DELETE FROM track_heatmapcell WHERE user_id = %s AND count <= 0", [trackfile.user_id])
+
+
+def upsert_heatmap_cells(cursor, user_id: int, lat: np.ndarray, lon: np.ndarray, subtract: bool = False):
+    """Add points to (or subtract them from) user's HeatmapCells at every zoom level in TRACK["HEATMAP_ZOOMS"]."""
+    zooms = settings.TRACK.get("HEATMAP_ZOOMS", [8, 10, 12, 14, 16, 18])
+    cells = heatmap_cells(lat, lon, zooms)
+    if len(cells["count"]) == 0:
+        return
+    columns = [cells[key].tolist() for key in ["zoom", "x", "y", "count"]]
+    if subtract:
+        cursor.execute(HEATMAP_SUBTRACT_SQL, columns + [user_id])
+    else:
+        cursor.execute(HEATMAP_ADD_SQL, [user_id] + columns)
+
+
+def detect_visits(trackfile: Trackfile, start: Optional[datetime.datetime] = None) -> List[Visit]:
+    """
+    Detect stay points from Trackfile's Trackpoints and save them as Visits.
+    If start is given, only Visits after it (and a Visit continuing over it) are detected again.
+    """
+    max_distance = settings.TRACK.get("VISIT_MAX_DISTANCE", 200)
+    min_duration = settings.TRACK.get("VISIT_MIN_DURATION", 600)
+    visits = trackfile.visits.all()
+    if start is not None:
+        overlapping = visits.filter(departure__gte=start).order_by("arrival").first()
+        if overlapping is not None:
+            start = min(start, overlapping.arrival)
+        visits = visits.filter(arrival__gte=start)
+    arrays = trackfile.get_trackpoint_arrays(start=start, fields=["time", "lat", "lon"])
+    times = arrays["time"] / 1e6
+    new_visits = []
+    for lo, hi in detect_stay_points(times, arrays["lat"], arrays["lon"], max_distance, min_duration):
+        lat, lon = float(arrays["lat"][lo:hi].mean()), float(arrays["lon"][lo:hi].mean())
+        arrival, departure = from_microseconds(arrays["time"][[lo, hi - 1]])
+        new_visits.append(
+            Visit(
+                user_id=trackfile.user_id,
+                trackfile=trackfile,
+                arrival=arrival,
+                departure=departure,
+                duration=(departure - arrival).total_seconds(),
+                trackpoint_cnt=hi - lo,
+                lat=lat,
+                lon=lon,
+                geometry=Point(lon, lat),
+            )
+        )
+    with transaction.atomic():
+        visits.delete()
+        return Visit.objects.bulk_create(new_visits)
+
+
+class DailySummary(models.Model):
+    """
+    Summary of user's day: movement from Tracksegs starting that day, visits,
+    timeline events and logbook records. Days are in settings.TIME_ZONE.
+    Summaries are refreshed by refresh_daily_summaries() whenever data of the day changes.
+    """
+
+    user = models.ForeignKey(User, editable=False, on_delete=models.CASCADE)
+    date = models.DateField(editable=False)
+    distance = models.FloatField(default=0)  # meters
+    moving_time = models.FloatField(default=0)  # seconds
+    trackpoint_cnt = models.IntegerField(default=0)
+    # Bounding box of the day's Tracksegs
+    min_lat = models.FloatField(blank=True, null=True)
+    min_lon = models.FloatField(blank=True, null=True)
+    max_lat = models.FloatField(blank=True, null=True)
+    max_lon = models.FloatField(blank=True, null=True)
+    # Simplified Tracksegs of the day
+    geometry = models.MultiLineStringField(geography=True, blank=True, null=True, editable=False)
+    visit_cnt = models.IntegerField(default=0)
+    event_cnt = models.IntegerField(default=0)
+    record_cnt = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("user", "date")
+        verbose_name_plural = "daily summaries"
+
+    def __str__(self):
+        return "{} ({} km)".format(self.date, round(self.distance / 1000.0, 2))
+
+
+def days_between(start: Optional[datetime.datetime], end: Optional[datetime.datetime]) -> List[datetime.date]:
+    """Return local dates from start to end (inclusive)."""
+    if start is None or end is None:
+        return []
+    first, last = timezone.localtime(start).date(), timezone.localtime(end).date()
+    return [first + datetime.timedelta(days=i) for i in range((last - first).days + 1)]
+
+
+def refresh_daily_summaries(user_id: int, days: Iterable[datetime.date]):
+    """Recompute user's DailySummaries of given days. Summaries of days without any data are deleted."""
+    for day in sorted(set(days)):
+        start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+        end = start + datetime.timedelta(days=1)
+        tracksegs = Trackseg.objects.filter(user_id=user_id, starttime__gte=start, starttime__lt=end)
+        totals = tracksegs.aggregate(
+            length=Sum("length"),
+            distance=Sum("stats__distance"),
+            moving_time=Sum("stats__moving_time"),
+            trackpoint_cnt=Sum("trackpoint_cnt"),
+        )
+        values = {
+            "distance": totals["distance"] or totals["length"] or 0,
+            "moving_time": totals["moving_time"] or 0,
+            "trackpoint_cnt": totals["trackpoint_cnt"] or 0,
+            "visit_cnt": Visit.objects.filter(user_id=user_id, arrival__gte=start, arrival__lt=end).count(),
+            "event_cnt": 0,
+            "record_cnt": 0,
+            "geometry": None,
+            "min_lat": None,
+            "min_lon": None,
+            "max_lat": None,
+            "max_lon": None,
+        }
+        if "timeline" in settings.INSTALLED_APPS:
+            from timeline.models import Event
+
+            values["event_cnt"] = Event.objects.filter(user_id=user_id, starttime__gte=start, starttime__lt=end).count()
+        if "logbook" in settings.INSTALLED_APPS:
+            from logbook.models import Record
+
+            values["record_cnt"] = Record.objects.filter(user_id=user_id, time__gte=start, time__lt=end).count()
+        linestrings = [simplify(trackseg.geometry, 30) for trackseg in tracksegs.order_by("starttime").only("geometry")]
+        if linestrings:
+            values["geometry"] = MultiLineString(linestrings)
+            values["min_lon"], values["min_lat"], values["max_lon"], values["max_lat"] = values["geometry"].extent
+        if not (values["trackpoint_cnt"] or values["visit_cnt"] or values["event_cnt"] or values["record_cnt"]):
+            DailySummary.objects.filter(user_id=user_id, date=day).delete()
+            continue
+        DailySummary.objects.update_or_create(user_id=user_id, date=day, defaults=values)
+
+
+def connect_daily_summary_signals(model_label: str, time_field: str):
+    """Refresh DailySummaries of the old and the new day, when an Event or a Record is saved or deleted."""
+
+    def remember_time(sender, instance, **kwargs):
+        if instance.pk is not None:
+            instance._summary_time = sender.objects.filter(pk=instance.pk).values_list(time_field, flat=True).first()
+
+    def refresh(sender, instance, **kwargs):
+        timestamps = [getattr(instance, time_field), getattr(instance, "_summary_time", None)]
+        if instance.user_id is not None:
+            refresh_daily_summaries(instance.user_id, [timezone.localtime(t).date() for t in timestamps if t])
+
+    pre_save.connect(remember_time, sender=model_label, weak=False)
+    post_save.connect(refresh, sender=model_label, weak=False)
+    post_delete.connect(refresh, sender=model_label, weak=False)
+
+
+if "timeline" in settings.INSTALLED_APPS:
+    connect_daily_summary_signals("timeline.Event", "starttime")
+if "logbook" in settings.INSTALLED_APPS:
+    connect_daily_summary_signals("logbook.Record", "time")
+
+
+def get_user_trackpoint_arrays(user: User, start=None, end=None, fields: List[str] = ARCHIVE_FIELDS):
+    """
+    Return user's valid Trackpoints between start and end (inclusive) as columns ordered by time.
+    Trackpoints of archived Trackfiles are read from the archive files.
+    """
+    columns = list(dict.fromkeys(["time", "status"] + list(fields)))
+    trackpoints = Trackpoint.objects.filter(user=user, status=1)
+    archived = Trackfile.objects.filter(user=user, archived_at__isnull=False)
+    if start is not None:
+        trackpoints = trackpoints.filter(time__gte=start)
+        archived = archived.filter(endtime__gte=start)
+    if end is not None:
+        trackpoints = trackpoints.filter(time__lte=end)
+        archived = archived.filter(starttime__lte=end)
+    parts = [trackpoint_rows_to_arrays(trackpoints.order_by("time").values_list(*columns).iterator(), columns)]
+    for trackfile in archived:
+        arrays = trackfile.get_trackpoint_arrays(start, end, fields=columns)
+        parts.append({field: values[arrays["status"] == 1] for field, values in arrays.items()})
+    if len(parts) == 1:
+        return {field: parts[0][field] for field in fields}
+    arrays = {field: np.concatenate([part[field] for part in parts]) for field in columns}
+    order = np.argsort(arrays["time"], kind="stable")
+    return {field: arrays[field][order] for field in fields}
+
+
+def iter_user_trackpoint_rows(user: User, start=None, end=None, fields: List[str] = ARCHIVE_FIELDS) -> Iterator[tuple]:
+    """
+    Yield user's valid Trackpoints between start and end (inclusive) as tuples of fields ordered by time.
+    Database rows are read with a server-side cursor and merged with rows of archived Trackfiles,
+    so huge time ranges can be streamed without loading them into memory.
+    """
+    trackpoints = Trackpoint.objects.filter(user=user, status=1)
+    archived = Trackfile.objects.filter(user=user, archived_at__isnull=False).order_by("starttime")
+    if start is not None:
+        trackpoints = trackpoints.filter(time__gte=start)
+        archived = archived.filter(endtime__gte=start)
+    if end is not None:
+        trackpoints = trackpoints.filter(time__lte=end)
+        archived = archived.filter(starttime__lte=end)
+    time_index = fields.index("time")
+    streams = [trackpoints.order_by("time").values_list(*fields).iterator(chunk_size=2000)]
+    for trackfile in archived:
+        streams.append(trackfile.iter_archived_trackpoint_rows(start, end, fields))
+    return heapq.merge(*streams, key=lambda row: row[time_index])
+
+
+def export_gpx(user: User, start=None, end=None) -> Iterator[str]:
+    """Generate GPX document of user's Trackpoints between start and end incrementally."""
+    fields = ["lat", "lon", "ele", "time", "sat", "hdop", "vdop", "pdop"]  # See track.utils.iter_gpx()
+    rows = iter_user_trackpoint_rows(user, start, end, fields=fields)
+    name = " - ".join(timezone.localtime(t).strftime("%Y-%m-%d %H:%M") for t in [start, end] if t)
+    return iter_gpx(rows, name=name, maxtime=settings.TRACK.get("TRACKSEG_MAXTIME", 120))
+
+
+def resolve_positions(
+    user: User, timestamps: List[datetime.datetime], max_gap: Optional[float] = None
+) -> List[Optional[Tuple[float, float]]]:
+    """
+    Return user's (lat, lon) position at each timestamp, or None if it is unknown.
+    Position is interpolated between surrounding Trackpoints, see interpolate_positions().
+    Timestamps are sorted and grouped into clusters and user's Trackpoints are fetched
+    only once per cluster, so thousands of timestamps can be resolved in a few queries.
+    """
+    if max_gap is None:
+        max_gap = settings.TRACK.get("RESOLVE_MAX_GAP", 300)
+    margin = datetime.timedelta(seconds=max_gap)
+    positions = [None] * len(timestamps)
+    order = sorted(range(len(timestamps)), key=lambda i: timestamps[i])
+    clusters = []
+    for i in order:
+        if (
+            clusters
+            and (timestamps[i] - timestamps[clusters[-1][-1]]).total_seconds() <= RESOLVE_CLUSTER_GAP
+            and (timestamps[i] - timestamps[clusters[-1][0]]).total_seconds() <= RESOLVE_CLUSTER_SPAN
+        ):
+            clusters[-1].append(i)
+        else:
+            clusters.append([i])
+    for cluster in clusters:
+        start, end = timestamps[cluster[0]] - margin, timestamps[cluster[-1]] + margin
+        arrays = get_user_trackpoint_arrays(user, start, end, fields=["time", "lat", "lon"])
+        times = np.array([to_microseconds(timestamps[i]) for i in cluster]) / 1e6
+        resolved = interpolate_positions(arrays["time"] / 1e6, arrays["lat"], arrays["lon"], times, max_gap)
+        for i, (lat, lon) in zip(cluster, resolved.tolist()):
+            if lat == lat:  # not NaN
+                positions[i] = (lat, lon)
+    return positions
+
+
+def resolve_position(
+    user: User, timestamp: datetime.datetime, max_gap: Optional[float] = None
+) -> Optional[Tuple[float, float]]:
+    """Return user's (lat, lon) position at timestamp, or None if it is unknown."""
+    return resolve_positions(user, [timestamp], max_gap)[0]
+
+
+def find_times_near(
+    user: User, lat: float, lon: float, radius: float, start=None, end=None
+) -> List[dict]:
+    """
+    Return time intervals when user was within radius meters from (lat, lon), ordered by time.
+    Candidate Tracksegs are found using the spatial index of Trackseg.geometry and then
+    only their Trackpoints are checked to get exact times.
+    """
+    candidates = Trackseg.objects.filter(
+        user=user, geometry__dwithin=(Point(lon, lat, srid=4326), D(m=radius))
+    ).select_related("trackfile")
+    if start is not None:
+        candidates = candidates.filter(endtime__gte=start)
+    if end is not None:
+        candidates = candidates.filter(starttime__lte=end)
+    tracksegs_by_trackfile = defaultdict(list)
+    for trackseg in candidates.order_by("starttime"):
+        tracksegs_by_trackfile[trackseg.trackfile].append(trackseg)
+    intervals = []
+    for trackfile, tracksegs in tracksegs_by_trackfile.items():
+        if trackfile.archive:
+            groups = [tracksegs]  # Archive file is read at once anyway
+        else:
+            # Trackpoints are read once for consecutive Tracksegs, which were split by TRACKSEG_LIMIT
+            # and share a point, and separately for Tracksegs having a gap between them
+            groups = [[tracksegs[0]]]
+            for trackseg in tracksegs[1:]:
+                if trackseg.starttime <= groups[-1][-1].endtime:
+                    groups[-1].append(trackseg)
+                else:
+                    groups.append([trackseg])
+        for group in groups:
+            arrays = trackfile.get_trackpoint_arrays(
+                start=max(filter(None, [group[0].starttime, start])),
+                end=min(filter(None, [group[-1].endtime, end])),
+                fields=["time", "lat", "lon"],
+            )
+            for trackseg in group:
+                lo = np.searchsorted(arrays["time"], to_microseconds(trackseg.starttime), side="left")
+                hi = np.searchsorted(arrays["time"], to_microseconds(trackseg.endtime), side="right")
+                for run_lo, run_hi, distance in runs_within_radius(
+                    arrays["lat"][lo:hi], arrays["lon"][lo:hi], lat, lon, radius
+                ):
+                    arrival, departure = from_microseconds(arrays["time"][[lo + run_lo, lo + run_hi - 1]])
+                    if intervals and intervals[-1]["trackfile"] == trackfile.id and intervals[-1]["end"] >= arrival:
+                        # Tracksegs split by TRACKSEG_LIMIT share a point, join intervals continuing over it
+                        intervals[-1]["end"] = max(intervals[-1]["end"], departure)
+                        intervals[-1]["min_distance"] = min(intervals[-1]["min_distance"], distance)
+                        continue
+                    intervals.append(
+                        {"start": arrival, "end": departure, "min_distance": distance, "trackfile": trackfile.id}
+                    )
+    intervals.sort(key=lambda interval: interval["start"])
+    return intervals
+
+
+def find_similar_trackfiles(
+    trackfile: Trackfile, tolerance: Optional[float] = None, max_distance: Optional[float] = None, limit: int = 20
+) -> List[Tuple[Trackfile, float]]:
+    """
+    Find user's other Trackfiles, which follow the same route as trackfile.
+    Candidates are prefiltered with the spatial index of Trackfile.geometry: they must intersect
+    trackfile's bounding box and pass within tolerance meters of its start and end points.
+    Then candidates starting and ending within tolerance meters of trackfile's start and end points
+    are ranked by discrete Fréchet distance of their (simplified) geometries.
+    Return max limit (Trackfile, distance in meters) pairs, whose distance is at most max_distance.
+    """
+    tolerance = tolerance or settings.TRACK.get("SIMILAR_ROUTE_TOLERANCE", 200)
+    max_distance = max_distance or settings.TRACK.get("SIMILAR_ROUTE_MAX_DISTANCE", 500)
+    max_points = 200
+    if not trackfile.geometry:
+        return []
+    coords = np.array([c for line in trackfile.geometry.coords for c in line])
+    lon0, lat0 = coords[0]
+    route = downsample_coordinates(project_coordinates(coords[:, 1], coords[:, 0], lat0, lon0), max_points)
+    start_point, end_point = Point(*coords[0], srid=4326), Point(*coords[-1], srid=4326)
+    candidates = (
+        Trackfile.objects.filter(user_id=trackfile.user_id, geometry__isnull=False)
+        .exclude(pk=trackfile.pk)
+        .filter(geometry__intersects=Polygon.from_bbox(trackfile.geometry.extent))
+        .filter(geometry__dwithin=(start_point, D(m=tolerance)))
+        .filter(geometry__dwithin=(end_point, D(m=tolerance)))
+    )
+    results = []
+    for candidate in candidates:
+        candidate_coords = np.array([c for line in candidate.geometry.coords for c in line])
+        candidate_route = project_coordinates(candidate_coords[:, 1], candidate_coords[:, 0], lat0, lon0)
+        ends = np.linalg.norm(candidate_route[[0, -1]] - route[[0, -1]], axis=1)
+        if ends.max() > tolerance:
+            continue
+        distance = discrete_frechet(route, downsample_coordinates(candidate_route, max_points))
+        if distance <= max_distance:
+            results.append((candidate, distance))
+    results.sort(key=lambda result: result[1])
+    return results[:limit]
+
+
+def compute_trackstats(trackfile: Trackfile, tracksegs=None) -> Optional[Trackstats]:
+    """
+    Compute Trackstats of given Tracksegs (default: all Trackfile's Tracksegs) from their Trackpoints
+    and then Trackfile's Trackstats from all its Tracksegs' Trackstats.
+    Trackpoints are read only once as arrays, starting from the first Trackseg to compute.
+    """
+    options = settings.TRACK.get("STATS", {})
+    kwargs = {
+        "moving_speed": options.get("MOVING_SPEED", 0.5),
+        "speed_interval": options.get("SPEED_INTERVAL", 10),
+        "profile_points": options.get("PROFILE_POINTS", 100),
+    }
+    if tracksegs is None:
+        tracksegs = trackfile.tracksegs.all()
+    tracksegs = list(tracksegs.order_by("starttime"))
+    if tracksegs:
+        arrays = trackfile.get_trackpoint_arrays(start=tracksegs[0].starttime, fields=["time", "lat", "lon", "ele"])
+        times = arrays["time"] / 1e6
+        segment_stats = []
+        for trackseg in tracksegs:
+            # Tracksegs split by TRACKSEG_LIMIT share their first and last point
+            lo = np.searchsorted(arrays["time"], to_microseconds(trackseg.starttime), side="left")
+            hi = np.searchsorted(arrays["time"], to_microseconds(trackseg.endtime), side="right")
+            values = track_statistics(
+                times[lo:hi], arrays["lat"][lo:hi], arrays["lon"][lo:hi], arrays["ele"][lo:hi], **kwargs
+            )
+            segment_stats.append(Trackstats(trackseg=trackseg, **values))
+        with transaction.atomic():
+            Trackstats.objects.filter(trackseg__in=tracksegs).delete()
+            Trackstats.objects.bulk_create(segment_stats)
+    segment_stats = Trackstats.objects.filter(trackseg__trackfile=trackfile).order_by("trackseg__starttime")
+    values = merge_track_statistics(list(segment_stats.values(*TRACKSTATS_FIELDS)), kwargs["profile_points"])
+    stats, created = Trackstats.objects.update_or_create(trackfile=trackfile, defaults=values)
+    return stats
+
+
 def save_trackpoints(points: List[gpxpy.gpx.GPXTrackPoint], trackfile: Trackfile) -> List[Trackpoint]:
     tpoints = []
     for pnt in points:
@@ -309,7 +1181,91 @@ def save_trackpoints(points: List[gpxpy.gpx.GPXTrackPoint], trackfile: Trackfile
         p.user = trackfile.user
         p.geometry = Point(pnt.longitude, pnt.latitude)
         tpoints.append(p)
-    return Trackpoint.objects.bulk_create(tpoints)
+    return bulk_save_trackpoints(tpoints, trackfile)
+
+
+def bulk_save_trackpoints(tpoints: List[Trackpoint], trackfile: Trackfile) -> List[Trackpoint]:
+    """
+    Save Trackpoints using INSERT ... ON CONFLICT DO NOTHING, so points which
+    already exist (same user, time and rounded position) are skipped.
+    Points found in user's archived Trackfiles, which the unique index doesn't cover, are skipped too.
+    Trackfiles where the skipped points were found are added to trackfile.duplicate_sources.
+    NOTE: primary keys are not set to saved Trackpoints.
+    """
+    tpoints, archived_sources = skip_archived_duplicates(tpoints, trackfile)
+    Trackpoint.objects.bulk_create(tpoints, ignore_conflicts=True)
+    sources = trackfile.duplicate_sources or {}
+    for trackfile_id, cnt in archived_sources + find_duplicate_sources(tpoints, trackfile):
+        sources[str(trackfile_id)] = sources.get(str(trackfile_id), 0) + cnt
+    trackfile.duplicate_sources = sources
+    return tpoints
+
+
+def find_duplicate_sources(tpoints: List[Trackpoint], trackfile: Trackfile) -> List[tuple]:
+    """
+    Return a list of (trackfile id, count) tuples of other Trackfiles,
+    which contain valid Trackpoints identical to tpoints.
+    The query is answered from the unique index track_trackpoint_dedupe,
+    so archived Trackpoints are not found, see skip_archived_duplicates().
+    """
+    if not tpoints:
+        return []
+    sql = """
+        SELECT tp.trackfile_id, COUNT(*)
+        FROM unnest(%s::timestamptz[], %s::float8[], %s::float8[]) AS p(time, lat, lon)
+        JOIN track_trackpoint tp
+          ON tp.user_id = %s AND tp.status = 1 AND tp.time = p.time
+         AND round(tp.lat::numeric, 5) = round(p.lat::numeric, 5)
+         AND round(tp.lon::numeric, 5) = round(p.lon::numeric, 5)
+        WHERE tp.trackfile_id <> %s
+        GROUP BY tp.trackfile_id
+    """
+    params = [
+        [tp.time for tp in tpoints],
+        [tp.lat for tp in tpoints],
+        [tp.lon for tp in tpoints],
+        trackfile.user_id,
+        trackfile.id,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def skip_archived_duplicates(tpoints: List[Trackpoint], trackfile: Trackfile) -> Tuple[List[Trackpoint], List[tuple]]:
+    """
+    Return tpoints without the points found in user's other archived Trackfiles
+    and a list of (trackfile id, count) tuples of archived Trackfiles, where they were found.
+    Points are compared like in the unique index: by time and position rounded to 5 decimals.
+    """
+    if not tpoints:
+        return tpoints, []
+    start, end = min(tp.time for tp in tpoints), max(tp.time for tp in tpoints)
+    archived = Trackfile.objects.filter(
+        user_id=trackfile.user_id, archived_at__isnull=False, starttime__lte=end, endtime__gte=start
+    ).exclude(pk=trackfile.pk)
+    keys = list(
+        zip(
+            [to_microseconds(tp.time) for tp in tpoints],
+            np.round([tp.lat for tp in tpoints], 5).tolist(),
+            np.round([tp.lon for tp in tpoints], 5).tolist(),
+        )
+    )
+    found = [False] * len(tpoints)
+    sources = []
+    for archived_trackfile in archived.order_by("starttime"):
+        arrays = archived_trackfile.get_trackpoint_arrays(start, end, fields=["time", "lat", "lon"])
+        archived_keys = set(
+            zip(arrays["time"].tolist(), np.round(arrays["lat"], 5).tolist(), np.round(arrays["lon"], 5).tolist())
+        )
+        cnt = 0
+        for i, key in enumerate(keys):
+            if not found[i] and key in archived_keys:
+                found[i] = True
+                cnt += 1
+        if cnt:
+            sources.append((archived_trackfile.pk, cnt))
+    return [tp for tp, is_found in zip(tpoints, found) if not is_found], sources
 
 
 def save_trackfile(fname: str, user: User, override=False) -> Optional[Trackfile]:
@@ -321,6 +1277,178 @@ def save_trackfile(fname: str, user: User, override=False) -> Optional[Trackfile
         return trackfile
 
 
+def delete_trackfile(trackfile: Trackfile, chunk_size: int = 10000):
+    """
+    Delete a Trackfile and its Trackpoints and Tracksegs.
+    Related rows are deleted in chunks with raw SQL, each chunk in its own transaction,
+    so Django doesn't collect millions of rows into memory and no long locks are held.
+    Trackpoints, which other Trackfiles skipped as duplicates of this Trackfile's Trackpoints,
+    are saved again afterwards, see restore_duplicates(). Raise ValueError, if such a Trackfile
+    can't be parsed again.
+    """
+    dependants = list(
+        Trackfile.objects.filter(user_id=trackfile.user_id, duplicate_sources__has_key=str(trackfile.pk)).exclude(
+            pk=trackfile.pk
+        )
+    )
+    unparseable = [str(dependant) for dependant in dependants if (dependant.datatype or "GPX_FILE") not in parsers]
+    if unparseable:
+        raise ValueError(f"{trackfile} can't be deleted, {', '.join(unparseable)} would lose Trackpoints")
+    if trackfile.archive:
+        update_heatmap(trackfile, subtract=True, chunk_size=chunk_size)
+    delete_trackpoints_in_chunks(trackfile, chunk_size)
+    # Trackstats reference Tracksegs, which are deleted with raw SQL
+    Trackstats.objects.filter(trackseg__trackfile=trackfile).delete()
+    delete_rows_in_chunks("track_trackseg", trackfile.pk, chunk_size)
+    user_id, days = trackfile.user_id, days_between(trackfile.starttime, trackfile.endtime)
+    starttime, endtime = trackfile.starttime, trackfile.endtime
+    trackfile.delete()
+    refresh_daily_summaries(user_id, days)
+    restore_duplicates(user_id, starttime, endtime, dependants)
+
+
+PROMOTE_DUPLICATES_SQL = """
+    UPDATE track_trackpoint SET status = 1 WHERE id IN (
+        SELECT DISTINCT ON (tp.time, round(tp.lat::numeric, 5), round(tp.lon::numeric, 5)) tp.id
+        FROM track_trackpoint tp
+        WHERE tp.user_id = %s AND tp.status = 2 AND tp.time BETWEEN %s AND %s AND tp.trackfile_id = ANY(%s)
+          AND NOT EXISTS (
+            SELECT 1 FROM track_trackpoint v
+            WHERE v.user_id = tp.user_id AND v.status = 1 AND v.time = tp.time
+              AND round(v.lat::numeric, 5) = round(tp.lat::numeric, 5)
+              AND round(v.lon::numeric, 5) = round(tp.lon::numeric, 5)
+          )
+        ORDER BY tp.time, round(tp.lat::numeric, 5), round(tp.lon::numeric, 5), tp.id
+    )
+"""
+
+
+def restore_duplicates(user_id: int, start, end, trackfiles: List[Trackfile]):
+    """
+    Make Trackpoints valid again, which were left out as duplicates of a deleted Trackfile's Trackpoints.
+    Legacy duplicates (status 2) between start and end are promoted to valid Trackpoints and
+    'trackfiles', which skipped Trackpoints found in the deleted Trackfile, are parsed again.
+    Archived Trackfiles are restored into the database first.
+    """
+    promoted_ids = []
+    if start is not None:
+        promoted_ids = list(
+            Trackfile.objects.filter(
+                user_id=user_id, trackpoints__status=2, trackpoints__time__range=(start, end)
+            ).values_list("pk", flat=True).distinct()
+        )
+    dependants = {trackfile.pk: trackfile for trackfile in trackfiles}
+    affected = {**Trackfile.objects.in_bulk(promoted_ids), **dependants}
+    for trackfile in affected.values():
+        update_heatmap(trackfile, subtract=True)  # All valid Trackpoints are added again below
+        trackfile.restore_trackpoints()
+    if promoted_ids:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(PROMOTE_DUPLICATES_SQL, [user_id, start, end, promoted_ids])
+    for trackfile in affected.values():
+        logging.info(f"Restoring duplicate Trackpoints of {trackfile}")
+        if trackfile.pk in dependants:
+            trackfile.parse_trackfile()
+        else:
+            trackfile.process_trackpoints()
+
+
+def delete_trackpoints_in_chunks(trackfile: Trackfile, chunk_size: int = 10000) -> int:
+    """
+    Delete Trackfile's Trackpoints in chunks and subtract valid ones from user's HeatmapCells
+    in the same transaction, so an interrupted deletion can be resumed without subtracting them twice.
+    """
+    total = 0
+    deleted = chunk_size
+    while deleted >= chunk_size:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM track_trackpoint WHERE id IN "
+                "(SELECT id FROM track_trackpoint WHERE trackfile_id = %s LIMIT %s) RETURNING status, lat, lon",
+                [trackfile.pk, chunk_size],
+            )
+            rows = np.array(cursor.fetchall(), dtype=float).reshape(-1, 3)
+            deleted = len(rows)
+            valid = rows[:, 0] == 1
+            upsert_heatmap_cells(cursor, trackfile.user_id, rows[valid, 1], rows[valid, 2], subtract=True)
+        total += deleted
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM track_heatmapcell WHERE user_id = %s AND count <= 0", [trackfile.user_id])
+    return total
+
+
+def delete_rows_in_chunks(table: str, trackfile_id: int, chunk_size: int = 10000) -> int:
+    """Delete Trackfile's rows from table in chunks, each chunk in its own transaction."""
+    total = 0
+    deleted = chunk_size
+    while deleted >= chunk_size:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE trackfile_id = %s LIMIT %s)",
+                [trackfile_id, chunk_size],
+            )
+            deleted = cursor.rowcount
+        total += deleted
+    return total
+
+
+def delete_trackfiles(trackfile_ids: List[int], chunk_size: int = 10000) -> int:
+    """Delete Trackfiles one by one using delete_trackfile() and return the number of deleted Trackfiles."""
+    cnt = 0
+    for trackfile in Trackfile.objects.filter(pk__in=trackfile_ids):
+        logging.info(f"Deleting {trackfile}")
+        delete_trackfile(trackfile, chunk_size)
+        cnt += 1
+    return cnt
+
+
+def delete_trackfiles_in_background(trackfile_ids: List[int]) -> threading.Thread:
+    """
+    Run delete_trackfiles() in a background thread, e.g. from admin action.
+    Trackfiles are marked to be deleted first, so that deletion can be resumed with
+    "manage.py delete_trackfiles --pending", if the process is stopped before the thread has finished.
+    """
+    Trackfile.objects.filter(pk__in=trackfile_ids).update(deleting_at=timezone.now())
+
+    def run():
+        try:
+            delete_trackfiles(trackfile_ids)
+        except Exception as err:
+            logging.exception(f"Failed to delete Trackfiles {trackfile_ids}: {err}")
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run, name="delete-trackfiles", daemon=True)
+    thread.start()
+    return thread
+
+
+def create_tracksegs(trackfile: Trackfile, trackpoints) -> List[Trackseg]:
+    """
+    Loop trackpoints (ordered by time) and create Tracksegs for them.
+    A new Trackseg is started when the time between 2 points exceeds TRACKSEG_MAXTIME
+    or the Trackseg has TRACKSEG_LIMIT points.
+    """
+    maxtime = settings.TRACK.get("TRACKSEG_MAXTIME", 120)  # seconds
+    limit = settings.TRACK.get("TRACKSEG_LIMIT", 1000)
+    points = []
+    tracksegs = []
+    for tp in trackpoints.only("time", "geometry").iterator():  # Loop all Trackpoints (max 'limit')
+        timediff = (tp.time - points[-1].time).total_seconds() if points else 0  # Seconds between 2 last points
+        if timediff > maxtime or len(points) >= limit:
+            trackseg = trackpointlist_to_trackseg(trackfile, points)  # Create new Trackseg
+            tracksegs.append(trackseg)
+            # if track was split because of limit then reuse the last point
+            if len(points) >= limit:
+                points = [points[-1]]
+            else:
+                points = []
+        points.append(tp)
+    trackseg = trackpointlist_to_trackseg(trackfile, points)  # Create last new Trackseg
+    tracksegs.append(trackseg)
+    return tracksegs
+
+
 def trackpointlist_to_trackseg(trackfile, points):
     if len(points) == 1:  # Add single point twice, LineString can't have only 1 point
         points.append(points[0])
@@ -339,3 +1467,123 @@ def trackpointlist_to_trackseg(trackfile, points):
     trackseg.length = trackseg_web_mercator.length
     trackseg.save()
     return trackseg
+
+
+def live_trackfile_sha1(filename: str) -> str:
+    """
+    Return sha1 of the name of a live Trackfile, which is used instead of the hash of its growing content.
+    Trackfile's unique (user, sha1) constraint makes sure that a user has only one live Trackfile per day.
+    """
+    return hashlib.sha1(filename.encode("utf-8")).hexdigest()
+
+
+def save_posted_trackpoints(user: User, posts: List[Tuple[bytes, List[dict]]]) -> List[Trackfile]:
+    """
+    Save posted trackpoints into user's live Trackfiles, one per local day of each post's first point.
+    Raw payloads are appended to live Trackfile's original file and its Tracksegs are extended
+    incrementally, unless some posted points are older than Trackfile's endtime.
+    'posts' is a list of (raw payload, list of dicts accepted by Trackpoint.set_data()) tuples.
+    """
+    posts_by_day = defaultdict(list)
+    for payload, points in posts:
+        tpoints = []
+        for data in points:
+            tp = Trackpoint(user=user)
+            if tp.set_data(data):
+                tpoints.append(tp)
+        if tpoints:
+            posts_by_day[timezone.localtime(tpoints[0].time).date()].append((payload, tpoints))
+    trackfiles = []
+    for day, day_posts in sorted(posts_by_day.items()):
+        payload = b"\n".join(payload for payload, tpoints in day_posts)
+        tpoints = [tp for payload, day_tpoints in day_posts for tp in day_tpoints]
+        filename = LIVE_TRACKFILE_NAME.format(day.isoformat())
+        with transaction.atomic():
+            # Lock the user, so that concurrent flushes don't create or extend the same live Trackfile at once
+            User.objects.select_for_update().get(pk=user.pk)
+            trackfile = Trackfile.objects.filter(user=user, datatype="HTTP_POST_TRACKPOINTS", filename=filename).first()
+            if trackfile is None:
+                trackfile = Trackfile(user=user, datatype="HTTP_POST_TRACKPOINTS")
+                sha1 = live_trackfile_sha1(filename)
+                if trackfile.set_file(filename, io.BytesIO(payload), sha1=sha1) is False:
+                    # Live Trackfile was saved with another datatype, append to it instead of losing the points
+                    trackfile = Trackfile.objects.get(user=user, sha1=sha1)
+                    trackfile.append_file(b"\n" + payload)
+            else:
+                trackfile.append_file(b"\n" + payload)
+            received_cnt = (trackfile.trackpoint_cnt or 0) + (trackfile.duplicate_cnt or 0) + len(tpoints)
+            # Incrementally extended Tracksegs would leave out points older than endtime
+            append = trackfile.endtime is not None and min(tp.time for tp in tpoints) > trackfile.endtime
+            if not append and trackfile.trackpoint_cnt:
+                update_heatmap(trackfile, subtract=True)  # All Trackpoints are added again below
+            for tp in tpoints:
+                tp.trackfile = trackfile
+            bulk_save_trackpoints(tpoints, trackfile)
+            trackfile.process_trackpoints(append=append)
+            trackfile.save_ingest_stats(received_cnt)
+        trackfiles.append(trackfile)
+    return trackfiles
+
+
+class TrackpointBuffer:
+    """
+    Collect posted trackpoints in memory and save them in bulk in a background thread,
+    when the buffer contains 'size' trackpoints or the oldest ones have waited 'seconds' seconds.
+    NOTE: buffered trackpoints are lost if the process is killed before they are flushed.
+    """
+
+    def __init__(self, size: int, seconds: float):
+        self.size = size
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.posts = defaultdict(list)  # user -> list of (raw payload, list of trackpoint dicts)
+        self.count = 0
+        self.first_added = None
+        self.full = threading.Event()
+        self.thread = None
+
+    def add(self, user: User, payload: bytes, points: List[dict]):
+        """Add posted trackpoints to the buffer. Saving them never blocks the request."""
+        with self.lock:
+            self.posts[user].append((payload, points))
+            self.count += len(points)
+            if self.first_added is None:
+                self.first_added = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="trackpoint-buffer", daemon=True)
+                self.thread.start()
+            if self.count >= self.size:
+                self.full.set()
+
+    def flush(self) -> int:
+        """Save all buffered trackpoints and return their number."""
+        with self.lock:
+            posts, count = self.posts, self.count
+            self.posts = defaultdict(list)
+            self.count = 0
+            self.first_added = None
+            self.full.clear()
+        for user, user_posts in posts.items():
+            try:
+                save_posted_trackpoints(user, user_posts)
+            except Exception as err:
+                cnt = sum(len(points) for payload, points in user_posts)
+                logging.exception(f"Failed to save {cnt} posted trackpoints of {user}: {err}")
+        return count
+
+    def run(self):
+        """Flush buffer when it is full or periodically, so trackpoints are saved also when posting stops."""
+        while True:
+            full = self.full.wait(timeout=min(self.seconds, 1.0))
+            with self.lock:
+                expired = self.first_added is not None and time.monotonic() - self.first_added >= self.seconds
+            if full or expired:
+                self.flush()
+                connection.close()
+
+
+trackpoint_buffer = TrackpointBuffer(
+    size=settings.TRACK.get("INGEST_BUFFER_SIZE", 1000),
+    seconds=settings.TRACK.get("INGEST_BUFFER_SECONDS", 30),
+)
+atexit.register(trackpoint_buffer.flush)
@@ -1,13 +1,25 @@
 # from rest_framework_gis.serializers import GeoFeatureModelSerializer
 # from django.contrib.gis.db.models import GeometryField, LineStringField
+from typing import Optional
+
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from rest_framework.reverse import reverse
 
-from track.models import Trackseg, Trackfile, Trackpoint
+from track.models import DailySummary, Trackseg, Trackfile, Trackpoint, Trackstats, Visit, TRACKSTATS_FIELDS
 from track.utils import simplify
 
 
+class TrackstatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Trackstats
+        fields = TRACKSTATS_FIELDS
+
+
 class TrackfileSerializer(serializers.HyperlinkedModelSerializer):
+    stats = TrackstatsSerializer(read_only=True, allow_null=True)
+    thumbnail = serializers.SerializerMethodField()
+
     class Meta:
         model = Trackfile
         fields = [
@@ -22,8 +34,27 @@ class TrackfileSerializer(serializers.HyperlinkedModelSerializer):
             "endtime",
             "created_at",
             "geometry",
+            "stats",
+            "thumbnail",
         ]
 
+    def get_fields(self):
+        """Leave out full geometry, if request has parameter geometry=0, e.g. for list views showing thumbnails."""
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is not None and request.query_params.get("geometry") == "0":
+            fields.pop("geometry")
+        return fields
+
+    def get_thumbnail(self, obj) -> Optional[str]:
+        # has_geometry is annotated by TrackfileViewSet, so deferred geometry is not loaded just for this check
+        has_geometry = getattr(obj, "has_geometry", None)
+        if not (obj.geometry if has_geometry is None else has_geometry):
+            return None
+        url = reverse("trackfile-thumbnail", args=[obj.pk])
+        request = self.context.get("request")
+        return request.build_absolute_uri(url) if request is not None else url
+
 
 class TrackpointSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
@@ -31,6 +62,18 @@ class TrackpointSerializer(serializers.HyperlinkedModelSerializer):
         fields = ["id", "time", "ele", "geometry"]
 
 
+class TrackpointBucketSerializer(serializers.Serializer):
+    """Trackpoints aggregated into a time bucket, see TrackpointViewSet."""
+
+    bucket = serializers.DateTimeField()
+    count = serializers.IntegerField()
+    lat = serializers.FloatField()
+    lon = serializers.FloatField()
+    speed = serializers.FloatField(allow_null=True)
+    min_ele = serializers.FloatField(allow_null=True)
+    max_ele = serializers.FloatField(allow_null=True)
+
+
 class TracksegSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Trackseg
@@ -47,3 +90,35 @@ class TracksegSerializer(serializers.HyperlinkedModelSerializer):
             instance.geometry = simplify(instance.geometry, tolerance=tolerance)
         ret = super().to_representation(instance)
         return ret
+
+
+class VisitSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Visit
+        fields = ["id", "trackfile", "arrival", "departure", "duration", "trackpoint_cnt", "lat", "lon"]
+
+
+class DailySummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailySummary
+        fields = [
+            "date",
+            "distance",
+            "moving_time",
+            "trackpoint_cnt",
+            "min_lat",
+            "min_lon",
+            "max_lat",
+            "max_lon",
+            "visit_cnt",
+            "event_cnt",
+            "record_cnt",
+            "geometry",
+        ]
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is not None and request.query_params.get("geometry") == "0":
+            fields.pop("geometry")
+        return fields
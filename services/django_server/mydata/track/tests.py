@@ -0,0 +1,1067 @@
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from unittest import mock
+
+import gpxpy
+import gpxpy.gpx
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from PIL import Image
+from rest_framework.test import APIClient
+
+from track.admin import delete_in_background
+from track.management.commands import watch_trackfiles
+from track.management.commands.parse_gpxfiles import handle_file
+from track.models import (
+    DailySummary,
+    HeatmapCell,
+    ImportJournal,
+    Trackfile,
+    Trackpoint,
+    TrackpointBuffer,
+    Trackseg,
+    Trackstats,
+    days_between,
+    delete_trackfile,
+    live_trackfile_sha1,
+    find_similar_trackfiles,
+    find_times_near,
+    resolve_position,
+    resolve_positions,
+    save_posted_trackpoints,
+    trackfile_storage,
+)
+from track.utils import (
+    ARCHIVE_FIELDS,
+    TrackpointFilter,
+    detect_datatype,
+    detect_stay_points,
+    discrete_frechet,
+    filter_trackpoint_arrays,
+    gzip_stream,
+    from_microseconds,
+    heatmap_cells,
+    interpolate_positions,
+    iter_gpx,
+    lttb,
+    merge_track_statistics,
+    parse_takeout_records,
+    parse_trackpoint_batches,
+    parse_trackpoint_json,
+    render_track_thumbnail,
+    runs_within_radius,
+    tile_indices,
+    track_statistics,
+    trackpoint_rows_to_arrays,
+)
+
+
+def create_points(n: int, step: float = 1e-5) -> list:
+    """Create n points heading north, one per second, with 'step' degrees between them (1e-5 ~ 1.1 m)."""
+    t0 = datetime.datetime(2021, 4, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    return [
+        gpxpy.gpx.GPXTrackPoint(60.0 + i * step, 24.0, time=t0 + datetime.timedelta(seconds=i)) for i in range(n)
+    ]
+
+
+def create_stay_points(stay: int, walk: int) -> list:
+    """Create 'stay' points at the same place and then 'walk' points heading north (~1.1 m/s), one per second."""
+    points = create_points(stay + walk)
+    for i, p in enumerate(points):
+        p.latitude = 60.0 + max(0, i - stay) * 1e-5
+    return points
+
+
+def shift_points(points: list, lat: float = 0, lon: float = 0, seconds: float = 0) -> list:
+    """Move points by given degrees and time."""
+    for p in points:
+        p.latitude += lat
+        p.longitude += lon
+        p.time += datetime.timedelta(seconds=seconds)
+    return points
+
+
+def point_dicts(points: list) -> list:
+    """Convert points into JSON data posted by live GPS loggers."""
+    return [{"lat": p.latitude, "lon": p.longitude, "time": p.time.isoformat()} for p in points]
+
+
+class TrackfileTestMixin:
+    """Helpers for tests saving Trackfiles. Original files are saved into a temporary directory."""
+
+    def setUp(self):
+        self.user = User.objects.create(username="test")
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        storage_dir = os.path.join(self.tmpdir, "storage")
+        patcher = mock.patch.dict(trackfile_storage.__dict__, {"base_location": storage_dir, "location": storage_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_gpx(self, name: str, points: list) -> str:
+        """Write points into a GPX file in temporary directory and return its path."""
+        gpx = gpxpy.gpx.GPX()
+        gpx.tracks.append(gpxpy.gpx.GPXTrack())
+        gpx.tracks[0].segments.append(gpxpy.gpx.GPXTrackSegment(points))
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wt") as f:
+            f.write(gpx.to_xml())
+        return path
+
+    def save_trackfile(self, name: str, points: list) -> Trackfile:
+        """Save points as a GPX Trackfile and parse it."""
+        trackfile = Trackfile(user=self.user, datatype="GPX_FILE")
+        path = self.write_gpx(name, points)
+        trackfile.set_file(path, path)
+        trackfile.parse_trackfile()
+        return trackfile
+
+
+class TrackfileTestCase(TrackfileTestMixin, TestCase):
+    """Base class for tests saving Trackfiles."""
+
+
+class TrackpointFilterTestCase(SimpleTestCase):
+    def test_disabled_filter(self):
+        """Test that filter without any limits accepts all points"""
+        points = create_points(100)
+        self.assertEqual(TrackpointFilter()(points), points)
+
+    def test_spikes_and_hdop(self):
+        """Test that speed spikes and points with high hdop are dropped"""
+        points = create_points(100)
+        points[20].latitude = 61.0
+        points[30].horizontal_dilution = 20
+        points[40].time = None
+        f = TrackpointFilter(max_speed=50, max_hdop=5)
+        kept = f(points) + f.finish()
+        self.assertEqual(len(kept), 97)
+        self.assertNotIn(points[20], kept)
+        self.assertNotIn(points[30], kept)
+        self.assertEqual(f.stats["speed"], 1)
+        self.assertEqual(f.stats["hdop"], 1)
+        self.assertEqual(f.stats["no_time"], 1)
+
+    def test_thinning_in_batches(self):
+        """Test that thinning gives the same result when points are filtered in batches"""
+        points = create_points(100)
+        kept = TrackpointFilter(min_interval=5, min_distance=3)(points)
+        self.assertEqual([(p.time - points[0].time).seconds for p in kept[:4]], [0, 5, 10, 15])
+        f = TrackpointFilter(min_interval=5, min_distance=3)
+        self.assertEqual(f(points[:33]) + f(points[33:66]) + f(points[66:]), kept)
+        self.assertEqual(f.stats["thinned"], 100 - len(kept))
+
+    def test_spikes_at_batch_boundary(self):
+        """Test that spikes at the last and first point of a batch are dropped like in a single batch"""
+        points = create_points(100)
+        points[33].latitude = 61.0
+        points[66].latitude = 61.0
+        f = TrackpointFilter(max_speed=50)
+        kept = f(points) + f.finish()
+        self.assertEqual(len(kept), 98)
+        f = TrackpointFilter(max_speed=50)
+        self.assertEqual(f(points[:34]) + f(points[34:66]) + f(points[66:]) + f.finish(), kept)
+        self.assertEqual(f.stats["speed"], 2)
+
+    def test_thinning_jitter(self):
+        """Test that points jittering around a stationary position are thinned by straight-line distance"""
+        points = create_points(100, step=0)
+        for p in points[1::2]:
+            p.latitude += 3e-5  # About 3 meters
+        kept = TrackpointFilter(min_distance=5)(points)
+        self.assertEqual(kept, points[:1])
+
+
+class TrackpointJsonTestCase(SimpleTestCase):
+    def test_owntracks(self):
+        points = parse_trackpoint_json({"_type": "location", "lat": 60.1, "lon": 24.9, "tst": 1617278400, "vel": 36})
+        self.assertEqual(len(points), 1)
+        self.assertEqual(points[0]["time"], datetime.datetime(2021, 4, 1, 12, 0, tzinfo=datetime.timezone.utc))
+        self.assertEqual(points[0]["speed"], 10.0)
+        self.assertEqual(parse_trackpoint_json({"_type": "transition"}), [])
+
+    def test_invalid_points(self):
+        for data in [{"lat": 60.1, "lon": 24.9}, [{"lat": 60.1, "time": "2021-04-01T12:00:00Z"}], "string"]:
+            with self.assertRaises(ValueError):
+                parse_trackpoint_json(data)
+        point = {"lat": 60.1, "lon": 24.9, "tst": 1617278400}
+        for invalid in [{"ele": "abc"}, {"sat": "x"}, {"vel": [36]}, {"hdop": {}}, {"sat": 7.5e400}]:
+            with self.assertRaises(ValueError):
+                parse_trackpoint_json(dict(point, **invalid))
+        parsed = parse_trackpoint_json(dict(point, vel="36", alt="12.5", sat="7"))[0]
+        self.assertEqual((parsed["speed"], parsed["ele"], parsed["sat"]), (10.0, 12.5, 7))
+
+
+class TakeoutTestCase(SimpleTestCase):
+    def test_stream_records(self):
+        """Test that Records.json is parsed correctly in batches"""
+        records = [
+            {"latitudeE7": 601234567, "longitudeE7": 249876543, "timestampMs": "1617278400000", "accuracy": 20},
+            {"latitudeE7": 601234600, "longitudeE7": 249876600, "timestamp": "2021-04-01T12:00:05.500Z"},
+            {"latitudeE7": 601234600, "timestamp": "2021-04-01T12:00:10Z"},  # Invalid, no longitude
+            {"latitudeE7": 601234700, "longitudeE7": 249876700, "timestamp": "2021-04-01T15:00:15+03:00"},
+        ]
+        f = io.StringIO(json.dumps({"locations": records}, indent=2))
+        batches = list(parse_takeout_records(f, batch_size=2))
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        points = batches[0] + batches[1]
+        self.assertAlmostEqual(points[0].latitude, 60.1234567)
+        self.assertAlmostEqual(points[0].longitude, 24.9876543)
+        self.assertEqual([(p.time - points[0].time).total_seconds() for p in points], [0.0, 5.5, 15.0])
+
+
+GPX_SAMPLE = b"""<?xml version="1.0"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>
+<trkpt lat="60.1" lon="24.9"><ele>12.5</ele><time>2021-04-01T12:00:00Z</time><hdop>1.2</hdop><sat>8</sat></trkpt>
+<trkpt lat="60.2" lon="24.8"><time>2021-04-01T12:00:01Z</time></trkpt>
+<trkpt lat="60.3" lon="24.7"><time>2021-04-01T12:00:02Z</time></trkpt>
+</trkseg></trk></gpx>"""
+
+TCX_SAMPLE = b"""<?xml version="1.0"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+<Activities><Activity><Lap><Track>
+<Trackpoint><Time>2021-04-01T12:00:00.000Z</Time><AltitudeMeters>10</AltitudeMeters>
+<Position><LatitudeDegrees>60.1</LatitudeDegrees><LongitudeDegrees>24.9</LongitudeDegrees></Position></Trackpoint>
+<Trackpoint><Time>2021-04-01T12:00:01.000Z</Time><HeartRateBpm><Value>100</Value></HeartRateBpm></Trackpoint>
+</Track></Lap></Activity></Activities></TrainingCenterDatabase>"""
+
+NMEA_SAMPLE = b"""$GPGGA,120000.00,6006.000,N,02454.000,E,1,08,0.9,12.5,M,17.0,M,,*59
+$GPRMC,120000.00,A,6006.000,N,02454.000,E,10.0,90.0,010421,,,A*54
+$GPRMC,120001.00,V,6006.000,N,02454.000,E,10.0,90.0,010421,,,A*42
+$GPRMC,120002.00,A,6006.000,N,02454.000,E,10.0,90.0,010421,,,A*00
+"""
+
+
+class WatchTrackfilesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name: str, data: str, mode: str = "wt") -> str:
+        path = os.path.join(self.tmpdir, name)
+        with open(path, mode) as f:
+            f.write(data)
+        return path
+
+    def test_pending_files(self):
+        """Test that a file is ready only after it has settled and it is never handed out twice at once"""
+        path = self.write("a.gpx", "<gpx>")
+        pending = watch_trackfiles.PendingFiles(settle=5)
+        pending.add([path], now=0)
+        self.assertEqual(pending.ready(now=0), [])
+        self.assertEqual(pending.ready(now=3), [])
+        self.write("a.gpx", "</gpx>", mode="at")  # File is still being written
+        self.assertEqual(pending.ready(now=4), [])
+        self.assertEqual(pending.ready(now=8), [])
+        self.assertEqual(pending.ready(now=9), [path])
+        pending.add([path], now=10)  # Changed again while a worker is processing it
+        self.assertEqual(pending.ready(now=10), [])
+        self.assertEqual(pending.ready(now=20), [])
+        pending.done(path)
+        self.assertEqual(pending.ready(now=21), [path])
+        removed = self.write("b.gpx", "<gpx>")
+        pending.add([removed], now=30)
+        os.remove(removed)
+        self.assertEqual(pending.ready(now=40), [])
+        self.assertEqual(pending.pending, {})
+
+    def test_polling_watcher(self):
+        """Test that polling reports new and modified files, but not hidden or unchanged ones"""
+        watcher = watch_trackfiles.PollingWatcher([self.tmpdir], interval=0.01)
+        self.assertEqual(watcher.changed_files(timeout=0), [])
+        path = self.write("a.gpx", "<gpx>")
+        self.write(".hidden.gpx", "<gpx>")
+        self.assertEqual(watcher.changed_files(timeout=0), [path])
+        self.assertEqual(watcher.changed_files(timeout=0), [])
+        self.write("a.gpx", "</gpx>", mode="at")
+        self.assertEqual(watcher.changed_files(timeout=0), [path])
+
+    def test_polling_fallback(self):
+        """Test that polling is used when it is requested or inotify is not available"""
+        self.assertEqual(watch_trackfiles.create_watcher([self.tmpdir], poll=2).interval, 2)
+        with mock.patch.object(watch_trackfiles, "inotify_simple", None):
+            watcher = watch_trackfiles.create_watcher([self.tmpdir], poll=0)
+        self.assertIsInstance(watcher, watch_trackfiles.PollingWatcher)
+        self.assertEqual(watcher.interval, 10.0)
+
+
+def create_fit_sample() -> bytes:
+    """Create a FIT file containing 2 record messages, the latter having a compressed timestamp header."""
+    semicircles = lambda degrees: int(degrees * 2 ** 31 / 180)
+    timestamp = 1617278400 - 631065600
+    # Definition of local message 0: record (20) with timestamp, position_lat, position_long and altitude
+    body = bytes([0x40, 0, 0]) + struct.pack("<H", 20) + bytes([4, 253, 4, 0x86, 0, 4, 0x85, 1, 4, 0x85, 2, 2, 0x84])
+    body += bytes([0x00]) + struct.pack("<IiiH", timestamp, semicircles(60.1), semicircles(24.9), (12 + 500) * 5)
+    # Definition of local message 1: record with position only, used with compressed timestamp (+3 seconds)
+    body += bytes([0x41, 0, 0]) + struct.pack("<H", 20) + bytes([2, 0, 4, 0x85, 1, 4, 0x85])
+    compressed_header = 0x80 | (1 << 5) | ((timestamp + 3) & 0x1F)
+    body += bytes([compressed_header]) + struct.pack("<ii", semicircles(60.2), semicircles(24.8))
+    header = bytes([14, 0x10]) + struct.pack("<HI", 2100, len(body)) + b".FIT\0\0"
+    return header + body + b"\0\0"
+
+
+class ParserTestCase(SimpleTestCase):
+    def parse(self, filename: str, data: bytes, datatype: str) -> list:
+        self.assertEqual(detect_datatype(filename, data[:4096]), datatype)
+        return [p for batch in parse_trackpoint_batches(io.BytesIO(data), datatype, batch_size=2) for p in batch]
+
+    def test_gpx(self):
+        points = self.parse("track.xml", GPX_SAMPLE, "GPX_FILE")
+        self.assertEqual([p.latitude for p in points], [60.1, 60.2, 60.3])
+        self.assertEqual((points[0].elevation, points[0].horizontal_dilution, points[0].satellites), (12.5, 1.2, 8))
+
+    def test_tcx(self):
+        points = self.parse("activity.tcx", TCX_SAMPLE, "TCX_FILE")
+        self.assertEqual(len(points), 1)  # Trackpoint without position is ignored
+        self.assertEqual((points[0].latitude, points[0].longitude, points[0].elevation), (60.1, 24.9, 10.0))
+
+    def test_nmea(self):
+        points = self.parse("log.txt", NMEA_SAMPLE, "NMEA_FILE")
+        self.assertEqual(len(points), 1)  # Invalid fix and invalid checksum are ignored
+        self.assertEqual((points[0].latitude, points[0].longitude), (60.1, 24.9))
+        self.assertEqual((points[0].elevation, points[0].satellites), (12.5, 8))
+        self.assertAlmostEqual(points[0].speed, 5.14444)
+
+    def test_geojson(self):
+        data = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [24.9, 60.1, 5]},
+                    "properties": {"time": "2021-04-01T12:00:00Z"},
+                },
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "LineString", "coordinates": [[24.9, 60.1], [24.8, 60.2]]},
+                    "properties": {"coordTimes": ["2021-04-01T12:00:01Z", "2021-04-01T12:00:02Z"]},
+                },
+            ],
+        }
+        points = self.parse("track.geojson", json.dumps(data).encode(), "GEOJSON_FILE")
+        self.assertEqual([p.latitude for p in points], [60.1, 60.1, 60.2])
+
+    def test_fit(self):
+        points = self.parse("activity.fit", create_fit_sample(), "FIT_FILE")
+        self.assertEqual(len(points), 2)
+        self.assertAlmostEqual(points[0].latitude, 60.1, places=6)
+        self.assertAlmostEqual(points[0].elevation, 12.0)
+        self.assertEqual((points[1].time - points[0].time).total_seconds(), 3)
+
+
+class ArchiveTestCase(SimpleTestCase):
+    def test_archive_round_trip(self):
+        """Test that trackpoint rows survive saving to .npz and can be filtered by time and bbox"""
+        points = create_points(10, step=1e-3)
+        rows = []
+        for i, p in enumerate(points):
+            values = dict.fromkeys(ARCHIVE_FIELDS)
+            values.update(id=i + 1, status=1, time=p.time, lat=p.latitude, lon=p.longitude, created_at=p.time)
+            values["ele"] = 10.0 if i % 2 else None
+            rows.append(tuple(values[field] for field in ARCHIVE_FIELDS))
+        f = io.BytesIO()
+        np.savez_compressed(f, **trackpoint_rows_to_arrays(rows))
+        f.seek(0)
+        with np.load(f) as data:
+            arrays = {field: data[field] for field in data.files}
+        self.assertEqual(from_microseconds(arrays["time"]), [p.time for p in points])
+        self.assertEqual(np.isnan(arrays["ele"]).sum(), 5)
+        selected = filter_trackpoint_arrays(arrays, start=points[2].time, end=points[8].time)
+        self.assertEqual(selected["id"].tolist(), [3, 4, 5, 6, 7, 8, 9])
+        selected = filter_trackpoint_arrays(arrays, bbox=[23.9, 60.0035, 24.1, 61.0])
+        self.assertEqual(selected["id"].tolist(), [5, 6, 7, 8, 9, 10])
+        self.assertEqual(len(filter_trackpoint_arrays(trackpoint_rows_to_arrays([]))["time"]), 0)
+
+
+class TrackStatisticsTestCase(SimpleTestCase):
+    def test_track_statistics(self):
+        """Test distance, moving time, speeds and elevation of a track with a 60 second stop in the middle"""
+        times = np.concatenate([np.arange(0, 100), np.arange(160, 260)]).astype(float)
+        lat = np.concatenate([60.0 + np.arange(100) * 1e-4, np.full(100, 60.0099) + np.arange(100) * 1e-4])
+        lon = np.full(200, 24.0)
+        ele = np.concatenate([np.linspace(0, 50, 100), np.linspace(50, 20, 100)])
+        stats = track_statistics(times, lat, lon, ele, profile_points=10)
+        self.assertAlmostEqual(stats["distance"], 198 * 11.12, delta=5)
+        self.assertEqual(stats["duration"], 259)
+        self.assertEqual(stats["moving_time"], 198)  # The stop isn't moving time
+        self.assertAlmostEqual(stats["max_speed"], 11.12, delta=0.1)
+        self.assertAlmostEqual(stats["ascent"], 50, delta=2)  # Smoothing rounds the peak
+        self.assertAlmostEqual(stats["descent"], 30, delta=2)
+        self.assertEqual(len(stats["elevation_profile"]), 10)
+        self.assertEqual(stats["elevation_profile"][0], [0.0, 0.0])
+
+    def test_merge_track_statistics(self):
+        """Test that statistics of two halves combine to the statistics of the whole"""
+        times = np.arange(0, 100, dtype=float)
+        lat = 60.0 + np.arange(100) * 1e-4
+        lon = np.full(100, 24.0)
+        ele = np.full(100, np.nan)
+        first = track_statistics(times[:50], lat[:50], lon[:50], ele[:50])
+        second = track_statistics(times[49:], lat[49:], lon[49:], ele[49:])
+        whole = track_statistics(times, lat, lon, ele)
+        merged = merge_track_statistics([first, second])
+        for key in ["distance", "duration", "moving_time", "avg_speed", "max_speed"]:
+            self.assertAlmostEqual(merged[key], whole[key], places=6)
+        self.assertIsNone(merged["ascent"])
+        self.assertEqual(track_statistics(times[:0], lat[:0], lon[:0], ele[:0])["distance"], 0)
+
+
+class LttbTestCase(SimpleTestCase):
+    def test_lttb(self):
+        """Test that downsampled series keeps endpoints and peaks"""
+        x = np.arange(1000, dtype=float)
+        y = np.sin(x / 50)
+        y[333] = 5
+        indices = lttb(x, y, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 999)
+        self.assertIn(333, indices)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertEqual(lttb(x[:10], y[:10], 50).tolist(), list(range(10)))
+
+
+class InterpolatePositionsTestCase(SimpleTestCase):
+    def test_interpolate_positions(self):
+        """Test interpolation between trackpoints, nearest point fallback and too large gaps"""
+        track_times = np.array([0.0, 10.0, 20.0, 1000.0])
+        lat = np.array([60.0, 60.1, 60.2, 61.0])
+        lon = np.array([24.0, 24.0, 24.5, 25.0])
+        times = np.array([-500.0, -5.0, 0.0, 15.0, 100.0, 600.0, 1100.0])
+        positions = interpolate_positions(track_times, lat, lon, times, max_gap=60)
+        self.assertTrue(np.isnan(positions[0]).all())  # Too far before the track
+        np.testing.assert_allclose(positions[1], [60.0, 24.0])  # The first point is near enough
+        np.testing.assert_allclose(positions[2], [60.0, 24.0])
+        np.testing.assert_allclose(positions[3], [60.15, 24.25])
+        self.assertTrue(np.isnan(positions[4]).all())  # Gap 20 - 1000 is too long
+        self.assertTrue(np.isnan(positions[5]).all())
+        self.assertTrue(np.isnan(positions[6]).all())
+        self.assertEqual(interpolate_positions(track_times[:0], lat[:0], lon[:0], times, 60).shape, (7, 2))
+
+
+class StayPointTestCase(SimpleTestCase):
+    def test_detect_stay_points(self):
+        """Test that a 20 minute stop between two walks is detected"""
+        walk = np.arange(300) * 1e-5  # ~1.1 m/s
+        lat = np.concatenate([60.0 + walk, np.full(1200, 60.003), 60.003 + walk])
+        lat[400] += 5e-4  # GPS noise ~55 m
+        times = np.arange(len(lat), dtype=float)
+        lon = np.full(len(lat), 24.0)
+        stays = detect_stay_points(times, lat, lon, max_distance=100, min_duration=600)
+        self.assertEqual(len(stays), 1)
+        lo, hi = stays[0]
+        self.assertLessEqual(abs(lo - 300), 90)
+        self.assertLessEqual(abs(hi - 1500), 90)
+        self.assertEqual(detect_stay_points(times, lat, lon, max_distance=100, min_duration=1800), [])
+
+
+class RunsWithinRadiusTestCase(SimpleTestCase):
+    def test_runs_within_radius(self):
+        """Test that passing a place twice gives two runs"""
+        lat = np.concatenate([60.0 + np.arange(20) * 1e-4, 60.0019 - np.arange(20) * 1e-4])
+        lon = np.full(40, 24.0)
+        runs = runs_within_radius(lat, lon, 60.001, 24.0, radius=25)
+        self.assertEqual([(lo, hi) for lo, hi, distance in runs], [(8, 13), (27, 32)])
+        self.assertAlmostEqual(runs[0][2], 0, delta=0.1)
+        self.assertEqual(runs_within_radius(lat, lon, 61.0, 24.0, radius=25), [])
+
+
+class FrechetTestCase(SimpleTestCase):
+    def test_discrete_frechet(self):
+        """Test Fréchet distance of parallel, reversed and differently sampled lines"""
+        p = np.column_stack([np.arange(0, 1000, 10.0), np.zeros(100)])
+        q = np.column_stack([np.arange(0, 1000, 25.0), np.full(40, 30.0)])
+        self.assertAlmostEqual(discrete_frechet(p, q), np.hypot(15, 30), delta=1e-6)
+        self.assertAlmostEqual(discrete_frechet(p, p[::-1]), 990)
+        self.assertEqual(discrete_frechet(p, p), 0)
+        self.assertEqual(discrete_frechet(p[:1], q[:1]), 30)
+
+
+class HeatmapTestCase(SimpleTestCase):
+    def test_tile_indices(self):
+        """Test tile numbers against known tiles (Helsinki and Null Island)"""
+        x, y = tile_indices(np.array([60.1699, 0.0]), np.array([24.9384, 0.0]), 10)
+        self.assertEqual(x.tolist(), [582, 512])
+        self.assertEqual(y.tolist(), [296, 512])
+
+    def test_heatmap_cells(self):
+        """Test that every point is counted once per zoom level"""
+        lat = np.array([60.1699, 60.1699, 60.17, 0.0])
+        lon = np.array([24.9384, 24.9384, 24.94, 0.0])
+        cells = heatmap_cells(lat, lon, [4, 18])
+        for zoom in [4, 18]:
+            self.assertEqual(cells["count"][cells["zoom"] == zoom].sum(), 4)
+        self.assertEqual(len(cells["count"][cells["zoom"] == 4]), 2)
+        self.assertEqual(len(heatmap_cells(lat[:0], lon[:0], [4])["count"]), 0)
+
+
+class DaysBetweenTestCase(SimpleTestCase):
+    @override_settings(TIME_ZONE="Europe/Helsinki")
+    def test_days_between(self):
+        """Test that days are local dates"""
+        start = datetime.datetime(2021, 4, 1, 21, 30, tzinfo=datetime.timezone.utc)  # 00:30 on 2nd in Helsinki
+        end = start + datetime.timedelta(days=2)
+        days = [datetime.date(2021, 4, 2), datetime.date(2021, 4, 3), datetime.date(2021, 4, 4)]
+        self.assertEqual(days_between(start, end), days)
+        self.assertEqual(days_between(start, None), [])
+
+
+class GpxExportTestCase(SimpleTestCase):
+    def test_iter_gpx(self):
+        """Test that streamed GPX is valid, split into segments at gaps and survives gzip"""
+        points = create_points(10)
+        points[5:] = create_points(5)
+        for p in points[5:]:
+            p.time += datetime.timedelta(hours=1)
+        rows = [(p.latitude, p.longitude, 10.5, p.time, None, 1.2, None, None) for p in points]
+        xml = "".join(iter_gpx(rows, name="Trip & back", maxtime=120, chunk_size=2))
+        gpx = gpxpy.parse(xml)
+        self.assertEqual(gpx.tracks[0].name, "Trip & back")
+        self.assertEqual([len(s.points) for s in gpx.tracks[0].segments], [5, 5])
+        self.assertEqual(gpx.tracks[0].segments[1].points[0].time, points[5].time)
+        self.assertEqual(gpx.tracks[0].segments[0].points[0].horizontal_dilution, 1.2)
+        compressed = b"".join(gzip_stream(iter_gpx(rows)))
+        self.assertEqual(gzip.decompress(compressed).decode(), "".join(iter_gpx(rows)))
+        self.assertEqual(len(gpxpy.parse("".join(iter_gpx([]))).tracks[0].segments), 0)
+
+
+class ThumbnailTestCase(SimpleTestCase):
+    def test_render_track_thumbnail(self):
+        """Test that thumbnail is a square PNG with the track drawn on transparent background"""
+        lines = [[(24.0, 60.0), (24.01, 60.0), (24.01, 60.01)], [(24.02, 60.02)]]
+        image = Image.open(io.BytesIO(render_track_thumbnail(lines, size=64)))
+        self.assertEqual(image.format, "PNG")
+        self.assertEqual(image.size, (64, 64))
+        alpha = np.array(image)[:, :, 3]
+        self.assertGreater((alpha > 0).sum(), 50)
+        self.assertEqual(alpha[8, 8], 0)  # North-west corner is empty
+        self.assertEqual(reverse("trackfile-thumbnail", args=[1]), "/api/track/trackfiles/1/thumbnail/")
+
+
+class ParseTrackfileTestCase(TrackfileTestCase):
+    def test_parse_trackfile(self):
+        """Test that parsing a file saves Trackpoints and derived Tracksegs, stats, Visits, heatmap and summary"""
+        trackfile = self.save_trackfile("stay.gpx", create_stay_points(700, 200))
+        trackfile.refresh_from_db()
+        self.assertEqual(trackfile.trackpoint_cnt, 900)
+        self.assertEqual(trackfile.trackpoints.count(), 900)
+        self.assertEqual(trackfile.tracksegs.count(), 1)
+        self.assertEqual(trackfile.geometry.num_geom, 1)
+        self.assertAlmostEqual(trackfile.stats.distance, 222, delta=5)
+        visits = list(trackfile.visits.all())
+        self.assertEqual(len(visits), 1)
+        self.assertGreaterEqual(visits[0].duration, 600)
+        self.assertAlmostEqual(visits[0].lat, 60.0, places=3)
+        cells = HeatmapCell.objects.filter(user=self.user, zoom=8)
+        self.assertEqual(sum(cell.count for cell in cells), 900)
+        summary = DailySummary.objects.get(user=self.user)
+        self.assertEqual(summary.date, datetime.date(2021, 4, 1))
+        self.assertEqual((summary.trackpoint_cnt, summary.visit_cnt), (900, 1))
+        self.assertEqual(Trackpoint.objects.filter(user=self.user, status=1).count(), 900)
+
+    def test_reingest_overlapping_file(self):
+        """Test that overlapping Trackpoints are not saved again and only valid Trackpoints are read"""
+        points = create_points(90)
+        first = self.save_trackfile("first.gpx", points[:60])
+        second = self.save_trackfile("second.gpx", points[30:])
+        second.refresh_from_db()
+        self.assertEqual(second.trackpoints.count(), 30)
+        self.assertEqual((second.trackpoint_cnt, second.duplicate_cnt), (30, 30))
+        self.assertEqual(second.duplicate_sources, {str(first.pk): 30})
+        self.assertEqual(second.starttime, points[60].time)
+        # Trackpoints marked as duplicates later are left out from segments, counts and API
+        first.trackpoints.filter(time__gte=points[50].time).update(status=2)
+        first.process_trackpoints()
+        first.refresh_from_db()
+        self.assertEqual((first.trackpoint_cnt, first.endtime), (50, points[49].time))
+        self.assertEqual(first.tracksegs.get().trackpoint_cnt, 50)
+        self.assertEqual(len(first.get_trackpoint_arrays()["time"]), 50)
+        self.assertEqual(len(first.get_trackpoint_arrays(valid_only=False)["time"]), 60)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse("trackpoint-list"), {"trackfile": first.pk})
+        self.assertEqual(response.json()["count"], 50)
+        first.archive_trackpoints()
+        response = client.get(reverse("trackpoint-list"), {"trackfile": first.pk})
+        self.assertEqual(response.json()["count"], 50)
+        first.restore_trackpoints()
+        self.assertEqual(first.trackpoints.count(), 60)
+
+    def test_delete_overlapping_file(self):
+        """Test that Trackpoints skipped as duplicates of a deleted Trackfile are saved again"""
+        points = create_points(90)
+        first = self.save_trackfile("first.gpx", points[:60])
+        second = self.save_trackfile("second.gpx", points[30:])
+        # Trackfile saved before deduplication, having its Trackpoints marked as duplicates
+        legacy = Trackfile.objects.create(user=self.user, filesize=0, datatype="GPX_FILE")
+        Trackpoint.objects.bulk_create(
+            [
+                Trackpoint(
+                    user=self.user,
+                    trackfile=legacy,
+                    status=2,
+                    time=p.time,
+                    lat=p.latitude,
+                    lon=p.longitude,
+                    geometry=Point(p.longitude, p.latitude),
+                )
+                for p in points[:10]
+            ]
+        )
+        delete_trackfile(first)
+        second.refresh_from_db()
+        self.assertEqual(second.trackpoints.count(), 60)
+        self.assertEqual((second.trackpoint_cnt, second.duplicate_cnt), (60, 0))
+        self.assertEqual((second.starttime, second.duplicate_sources), (points[30].time, {}))
+        legacy.refresh_from_db()
+        self.assertEqual((legacy.trackpoint_cnt, legacy.starttime), (10, points[0].time))
+        cells = HeatmapCell.objects.filter(user=self.user, zoom=8)
+        self.assertEqual(sum(cell.count for cell in cells), 70)
+
+    def test_skip_archived_duplicates(self):
+        """Test that Trackpoints found in an archived Trackfile are not saved again"""
+        points = create_points(90)
+        first = self.save_trackfile("first.gpx", points[:60])
+        first.archive_trackpoints()
+        second = self.save_trackfile("second.gpx", points[30:])
+        second.refresh_from_db()
+        self.assertEqual((second.trackpoints.count(), second.duplicate_cnt), (30, 30))
+        self.assertEqual(second.duplicate_sources, {str(first.pk): 30})
+        first.restore_trackpoints()
+        self.assertEqual(Trackpoint.objects.filter(user=self.user, status=1).count(), 90)
+        delete_trackfile(first)
+        second.refresh_from_db()
+        self.assertEqual((second.trackpoints.count(), second.duplicate_sources), (60, {}))
+
+
+class ResolvePositionsTestCase(TrackfileTestCase):
+    def test_resolve_positions(self):
+        """Test that positions are interpolated from saved Trackpoints and unknown outside tracks"""
+        points = create_points(100)
+        self.save_trackfile("walk.gpx", points)
+        t0 = points[0].time
+        timestamps = [t0 + datetime.timedelta(seconds=50.5), t0 - datetime.timedelta(hours=1), t0]
+        positions = resolve_positions(self.user, timestamps)
+        self.assertAlmostEqual(positions[0][0], 60.0 + 50.5e-5, places=7)
+        self.assertAlmostEqual(positions[0][1], 24.0, places=7)
+        self.assertIsNone(positions[1])
+        self.assertAlmostEqual(resolve_position(self.user, t0)[0], 60.0, places=7)
+        self.assertIsNone(resolve_position(self.user, points[-1].time + datetime.timedelta(days=1)))
+
+    def test_backfill_locations(self):
+        """Test that backfill_locations fills in a missing Event location"""
+        from timeline.models import Event, Source
+
+        points = create_points(100)
+        self.save_trackfile("walk.gpx", points)
+        source = Source.objects.create(slug="test")
+        event = Event.objects.create(user=self.user, source=source, uid="event-1", starttime=points[10].time)
+        call_command("backfill_locations", username="test", stdout=io.StringIO())
+        event.refresh_from_db()
+        self.assertAlmostEqual(event.geo.y, 60.0 + 10e-5, places=7)
+
+    def test_reparse_keeps_backfilled_location(self):
+        """Test that re-parsing events doesn't wipe locations filled in by backfill_locations"""
+        from timeline.management.commands.reparse_events import Command, parse_events
+        from timeline.models import Event, Source
+
+        points = create_points(100)
+        self.save_trackfile("walk.gpx", points)
+        source = Source.objects.create(slug="test")
+        serialized = "BEGIN:VEVENT\nUID:event-1\nDTSTART:20210401T120010Z\nSUMMARY:Walk\nEND:VEVENT"
+        event = Event.objects.create(
+            user=self.user, source=source, uid="event-1", starttime=points[10].time, serialized=serialized
+        )
+        call_command("backfill_locations", username="test", stdout=io.StringIO())
+        command = Command()
+        chunk = next(command.iter_chunks(Event.objects.all(), 0, 10))
+        results = parse_events([(e["id"], e["serialized"]) for e in chunk])
+        self.assertEqual(command.save_chunk(chunk, results, {}), (1, 0))
+        event.refresh_from_db()
+        self.assertEqual(event.summary, "Walk")
+        self.assertAlmostEqual(event.geo.y, 60.0 + 10e-5, places=7)
+
+
+class TimesNearTestCase(TrackfileTestCase):
+    @override_settings(TRACK={**settings.TRACK, "TRACKSEG_LIMIT": 50})
+    def test_find_times_near(self):
+        """Test that passes near a place are found from Trackpoints read separately for Tracksegs with a gap"""
+        points = create_points(200, step=1e-4) + shift_points(create_points(200, step=1e-4), seconds=3600)
+        trackfile = self.save_trackfile("twice.gpx", points)
+        with mock.patch.object(
+            Trackfile, "get_trackpoint_arrays", autospec=True, side_effect=Trackfile.get_trackpoint_arrays
+        ) as get_arrays:
+            intervals = find_times_near(self.user, 60.01, 24.0, 30)
+        self.assertEqual(get_arrays.call_count, 2)
+        # The first pass continues over the point shared by 2 Tracksegs
+        passes = [(points[98], points[102]), (points[298], points[302])]
+        self.assertEqual([(i["start"], i["end"]) for i in intervals], [(p.time, q.time) for p, q in passes])
+        self.assertEqual([i["trackfile"] for i in intervals], [trackfile.pk, trackfile.pk])
+        self.assertAlmostEqual(intervals[0]["min_distance"], 0, delta=1)
+        intervals = find_times_near(self.user, 60.01, 24.0, 30, start=points[200].time)
+        self.assertEqual([i["start"] for i in intervals], [points[298].time])
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse("track-near"), {"lat": 60.01, "lon": 24.0, "radius": 30})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["count"], 2)
+        self.assertEqual(data["results"][0]["duration"], 4.0)
+        self.assertEqual(parse_datetime(data["results"][1]["start"]), points[298].time)
+        response = client.get(reverse("track-near"), {"lat": 60.01, "lon": 24.0, "radius": 100000})
+        self.assertEqual(response.status_code, 400)
+
+
+class SimilarTrackfilesTestCase(TrackfileTestCase):
+    def test_find_similar_trackfiles(self):
+        """Test that only the Trackfile following the same route is found, also via API"""
+        route = self.save_trackfile("route.gpx", create_points(300, step=1e-4))
+        same = self.save_trackfile("same.gpx", shift_points(create_points(300, step=1e-4), lon=2e-4, seconds=86400))
+        other = shift_points(create_points(300, step=1e-4), seconds=2 * 86400)
+        for i, p in enumerate(other):  # Head east instead of north
+            p.latitude, p.longitude = 60.0, 24.0 + i * 2e-4
+        self.save_trackfile("other.gpx", other)
+        results = find_similar_trackfiles(route)
+        self.assertEqual([trackfile.pk for trackfile, distance in results], [same.pk])
+        self.assertAlmostEqual(results[0][1], 11, delta=3)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse("trackfile-similar", args=[route.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["id"] for item in response.json()["results"]], [same.pk])
+        self.assertEqual(find_similar_trackfiles(route, max_distance=5), [])
+
+
+class TrackpointListTestCase(TrackfileTestCase):
+    def test_archived_pages(self):
+        """Test that database and archived Trackpoints are merged in time order page by page"""
+        archived = create_points(50)
+        self.save_trackfile("archived.gpx", archived).archive_trackpoints()
+        self.save_trackfile("db.gpx", shift_points(create_points(50), lat=1e-3, seconds=0.5))
+        client = APIClient()
+        client.force_authenticate(self.user)
+        params = {"start": archived[0].time.isoformat(), "end": archived[-1].time.isoformat()}
+        times = []
+        for page in [1, 2, 3]:
+            data = client.get(reverse("trackpoint-list"), dict(params, page=page)).json()
+            self.assertEqual(data["count"], 99)  # The last database point is after end
+            times += [parse_datetime(item["time"]) for item in data["results"]]
+        self.assertEqual(len(set(times)), 99)
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(times[0], archived[0].time)
+
+    def test_buckets(self):
+        """Test that Trackpoints are counted per time bucket and bbox and time filters are applied"""
+        points = create_points(150)
+        self.save_trackfile("walk.gpx", points)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = reverse("trackpoint-list")
+        results = client.get(url, {"bucket": "minute"}).json()["results"]
+        self.assertEqual([item["count"] for item in results], [60, 60, 30])
+        self.assertEqual(parse_datetime(results[1]["bucket"]), points[60].time)
+        self.assertAlmostEqual(results[0]["lat"], 60.0 + 29.5e-5, places=7)
+        self.assertEqual(client.get(url, {"bucket": "hour"}).json()["results"][0]["count"], 150)
+        results = client.get(url, {"bucket": "minute", "bbox": "23.9,59.9,24.1,60.000595"}).json()["results"]
+        self.assertEqual([item["count"] for item in results], [60])
+        params = {"bucket": "minute", "start": points[30].time.isoformat(), "end": points[89].time.isoformat()}
+        results = client.get(url, params).json()["results"]
+        self.assertEqual([item["count"] for item in results], [30, 30])
+        self.assertEqual(client.get(url, {"bucket": "year"}).status_code, 400)
+
+
+class TrackfileListTestCase(TrackfileTestCase):
+    def test_list_without_geometry(self):
+        """Test that geometry=0 leaves out geometries but keeps thumbnails of Trackfiles having geometry"""
+        trackfile = self.save_trackfile("walk.gpx", create_points(60))
+        empty = Trackfile.objects.create(user=self.user, datatype="GPX_FILE", filename="empty.gpx", sha1="0" * 40)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        results = client.get(reverse("trackfile-list")).json()["results"]
+        self.assertTrue(all("geometry" in item for item in results))
+        results = client.get(reverse("trackfile-list"), {"geometry": "0"}).json()["results"]
+        thumbnails = {item["id"]: item["thumbnail"] for item in results}
+        self.assertTrue(thumbnails[trackfile.pk].endswith(f"/trackfiles/{trackfile.pk}/thumbnail/"))
+        self.assertIsNone(thumbnails[empty.pk])
+        self.assertFalse(any("geometry" in item for item in results))
+        response = client.get(reverse("trackfile-thumbnail", args=[trackfile.pk]), {"geometry": "0"})
+        self.assertEqual(response["Content-Type"], "image/png")
+
+
+class GpxExportViewTestCase(TrackfileTestCase):
+    def test_export(self):
+        """Test that Trackpoints of database and archived Trackfiles are exported as one GPX, also by command"""
+        first = create_points(60)
+        second = shift_points(create_points(60), lat=1e-3, seconds=3600)
+        self.save_trackfile("first.gpx", first).archive_trackpoints()
+        self.save_trackfile("second.gpx", second)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        params = {"start": first[10].time.isoformat(), "end": second[-1].time.isoformat()}
+        response = client.get(reverse("track-export-gpx"), params)
+        self.assertEqual(response.status_code, 200)
+        gpx = gpxpy.parse(b"".join(response.streaming_content).decode())
+        segments = gpx.tracks[0].segments
+        self.assertEqual([len(segment.points) for segment in segments], [50, 60])
+        self.assertEqual(segments[1].points[0].time, second[0].time)
+        response = client.get(reverse("track-export-gpx"), dict(params, gzip="1"))
+        xml = gzip.decompress(b"".join(response.streaming_content)).decode()
+        self.assertEqual(len(gpxpy.parse(xml).tracks[0].segments), 2)
+        self.assertEqual(client.get(reverse("track-export-gpx"), {"start": params["start"]}).status_code, 400)
+        path = os.path.join(self.tmpdir, "export.gpx")
+        call_command("export_gpx", username="test", output=path, stdout=io.StringIO(), **params)
+        with open(path) as f:
+            self.assertEqual(gpxpy.parse(f).get_track_points_no(), 110)
+
+
+class ImportJournalTestCase(TrackfileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = self.write_gpx("walk.gpx", create_points(50))
+        self.options = {"username": "test", "override": False}
+
+    def create_journal(self, **kwargs) -> ImportJournal:
+        stat = os.stat(self.path)
+        return ImportJournal.objects.create(
+            user=self.user, path=self.path, filesize=stat.st_size, mtime=stat.st_mtime, **kwargs
+        )
+
+    def test_skip_finished(self):
+        """Test that a journaled file is not processed again"""
+        trackfile = handle_file(self.path, self.options)
+        self.assertEqual(trackfile.trackpoint_cnt, 50)
+        journal = ImportJournal.objects.get(user=self.user)
+        self.assertEqual((journal.status, journal.trackfile), ("DONE", trackfile))
+        self.assertIsNone(handle_file(self.path, self.options))
+        self.assertEqual(Trackfile.objects.count(), 1)
+
+    def test_skip_unknown_format(self):
+        """Test that a file of unknown format is journaled and not opened again"""
+        path = os.path.join(self.tmpdir, "notes.txt")
+        with open(path, "wt") as f:
+            f.write("not a track file")
+        self.assertIsNone(handle_file(path, self.options))
+        self.assertEqual(ImportJournal.objects.get(user=self.user, path=path).status, "SKIPPED")
+        with mock.patch("track.management.commands.parse_gpxfiles.detect_datatype") as detect:
+            self.assertIsNone(handle_file(path, self.options))
+        detect.assert_not_called()
+        self.assertEqual(Trackfile.objects.count(), 0)
+
+    def test_retry_failed(self):
+        """Test that a failed file leaves no Trackfile behind and is processed on the next run"""
+        with mock.patch.object(Trackfile, "parse_trackfile", side_effect=ValueError("broken file")):
+            self.assertIsNone(handle_file(self.path, self.options))
+        journal = ImportJournal.objects.get(user=self.user)
+        self.assertEqual(journal.status, "FAILED")
+        self.assertIn("broken file", journal.error)
+        self.assertEqual(Trackfile.objects.count(), 0)
+        trackfile = handle_file(self.path, self.options)
+        self.assertEqual(trackfile.trackpoint_cnt, 50)
+        self.assertEqual(ImportJournal.objects.get(user=self.user).status, "DONE")
+
+    def test_resume_interrupted(self):
+        """Test that a Trackfile left by an interrupted run is replaced, whether it was journaled or not"""
+        for journaled in [True, False]:
+            Trackfile.objects.all().delete()
+            ImportJournal.objects.all().delete()
+            journal = self.create_journal(status="STARTED", started_at=timezone.now())
+            orphan = Trackfile(user=self.user, datatype="GPX_FILE")
+            orphan.set_file(self.path, self.path)
+            if journaled:
+                journal.trackfile = orphan
+                journal.save()
+            trackfile = handle_file(self.path, self.options)
+            self.assertEqual(trackfile.trackpoint_cnt, 50)
+            self.assertFalse(Trackfile.objects.filter(pk=orphan.pk).exists())
+            self.assertEqual(Trackfile.objects.count(), 1)
+            journal.refresh_from_db()
+            self.assertEqual((journal.status, journal.trackfile), ("DONE", trackfile))
+
+
+class DeleteTrackfileTestCase(TrackfileTestMixin, TransactionTestCase):
+    # Not run in a test transaction, because background deletion uses its own database connection
+
+    def setUp(self):
+        super().setUp()
+        self.kept = self.save_trackfile("kept.gpx", create_points(40))
+        self.deleted = self.save_trackfile("deleted.gpx", shift_points(create_points(60), seconds=86400))
+
+    def assert_deleted(self):
+        self.assertFalse(Trackfile.objects.filter(pk=self.deleted.pk).exists())
+        self.assertEqual(Trackpoint.objects.filter(trackfile_id=self.deleted.pk).count(), 0)
+        self.assertEqual(Trackseg.objects.filter(trackfile_id=self.deleted.pk).count(), 0)
+        self.assertEqual(Trackstats.objects.count(), 2)  # Kept Trackfile and its Trackseg
+        self.assertEqual(self.kept.trackpoints.count(), 40)
+        cells = HeatmapCell.objects.filter(user=self.user, zoom=8)
+        self.assertEqual(sum(cell.count for cell in cells), 40)
+        self.assertEqual(list(DailySummary.objects.values_list("date", flat=True)), [datetime.date(2021, 4, 1)])
+
+    def test_delete_command(self):
+        """Test that the command deletes Trackpoints, Tracksegs and stats in chunks and decrements the heatmap"""
+        self.assertEqual(Trackstats.objects.count(), 4)
+        self.assertEqual(DailySummary.objects.count(), 2)
+        out = io.StringIO()
+        call_command("delete_trackfiles", self.deleted.pk, chunk_size=7, stdout=out)
+        self.assertIn("Deleted 1 track files", out.getvalue())
+        self.assert_deleted()
+
+    def test_admin_action(self):
+        """Test that the admin action deletes selected Trackfiles in a background thread"""
+        modeladmin = mock.Mock()
+        delete_in_background(modeladmin, None, Trackfile.objects.filter(pk=self.deleted.pk))
+        for thread in threading.enumerate():
+            if thread.name == "delete-trackfiles":
+                thread.join()
+        modeladmin.message_user.assert_called_once()
+        self.assert_deleted()
+
+    def test_resume_pending(self):
+        """Test that an interrupted background deletion is resumed without subtracting the heatmap twice"""
+        Trackfile.objects.filter(pk=self.deleted.pk).update(deleting_at=timezone.now())
+        with mock.patch("track.models.delete_rows_in_chunks", side_effect=RuntimeError("Stopped")):
+            with self.assertRaises(RuntimeError):
+                delete_trackfile(self.deleted, chunk_size=7)
+        self.assertTrue(Trackfile.objects.filter(pk=self.deleted.pk).exists())
+        out = io.StringIO()
+        call_command("delete_trackfiles", pending=True, stdout=out)
+        self.assertIn("Deleted 1 track files", out.getvalue())
+        self.assert_deleted()
+
+
+class TrackpointIngestTestCase(TrackfileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.buffer = TrackpointBuffer(size=100, seconds=3600)
+        # Buffer is flushed explicitly in tests, because its thread wouldn't see the test transaction
+        patchers = [mock.patch.object(self.buffer, "run"), mock.patch("track.views.trackpoint_buffer", self.buffer)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, points: list, compress: bool = False):
+        data = json.dumps(point_dicts(points)).encode()
+        headers = {}
+        if compress:
+            data = gzip.compress(data)
+            headers["HTTP_CONTENT_ENCODING"] = "gzip"
+        return self.client.post(reverse("track-ingest"), data, content_type="application/json", **headers)
+
+    def test_ingest(self):
+        """Test that posts are buffered, flushed outside the request and appended to the live Trackfile"""
+        points = create_points(150)
+        response = self.post(points[:60])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"received": 60})
+        self.assertFalse(self.buffer.full.is_set())
+        self.assertEqual(self.post(points[60:120], compress=True).status_code, 202)
+        self.assertTrue(self.buffer.full.is_set())
+        self.assertEqual(Trackpoint.objects.count(), 0)  # The request didn't save the full buffer
+        self.assertEqual(self.buffer.flush(), 120)
+        trackfile = Trackfile.objects.get(user=self.user)
+        self.assertEqual(trackfile.filename, "live-2021-04-01.json")
+        self.assertEqual(trackfile.datatype, "HTTP_POST_TRACKPOINTS")
+        self.assertEqual((trackfile.trackpoint_cnt, trackfile.tracksegs.count()), (120, 1))
+        self.post(points[120:] + points[:10])  # Re-posted points are duplicates
+        self.buffer.flush()
+        trackfile = Trackfile.objects.get(user=self.user)
+        self.assertEqual((trackfile.trackpoint_cnt, trackfile.duplicate_cnt), (150, 10))
+        self.assertEqual(trackfile.trackpoints.count(), 150)
+        self.assertEqual(trackfile.endtime, points[-1].time)
+        self.assertEqual(len(trackfile.get_file_content().split(b"\n")), 3)
+        self.assertEqual(trackfile.filesize, len(trackfile.get_file_content()))
+        self.assertEqual(trackfile.sha1, live_trackfile_sha1("live-2021-04-01.json"))
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_identical_content(self):
+        """Test that posted points are saved even if a Trackfile with identical content or live sha1 exists"""
+        points = create_points(20)
+        data = point_dicts(points[:10])
+        payload = json.dumps(data).encode()
+        upload = Trackfile(user=self.user, datatype="JSON_FILE")
+        upload.set_file("upload.json", io.BytesIO(payload))
+        trackfile = save_posted_trackpoints(self.user, [(payload, data)])[0]
+        self.assertNotEqual(trackfile.pk, upload.pk)
+        self.assertEqual(trackfile.trackpoint_cnt, 10)
+        trackfile.datatype = "JSON_FILE"  # Live Trackfile isn't found by name anymore, but by its sha1
+        trackfile.save()
+        data = point_dicts(points[10:])
+        self.assertEqual(save_posted_trackpoints(self.user, [(json.dumps(data).encode(), data)])[0].pk, trackfile.pk)
+        trackfile.refresh_from_db()
+        self.assertEqual(trackfile.trackpoint_cnt, 20)
+
+    def test_invalid_data(self):
+        """Test that invalid posts are rejected"""
+        response = self.client.post(reverse("track-ingest"), [{"lat": 60}], format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            reverse("track-ingest"), b"not gzip", content_type="application/json", HTTP_CONTENT_ENCODING="gzip"
+        )
+        self.assertEqual(response.status_code, 400)
+        point = point_dicts(create_points(1))[0]
+        for invalid in [{"ele": "abc"}, {"sat": "x"}, {"vel": [36]}]:
+            response = self.client.post(reverse("track-ingest"), dict(point, **invalid), format="json")
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.buffer.count, 0)
+
+
+class AppendTracksegmentsTestCase(TrackfileTestCase):
+    def save(self, points: list) -> Trackfile:
+        data = point_dicts(points)
+        trackfiles = save_posted_trackpoints(self.user, [(json.dumps(data).encode(), data)])
+        self.assertEqual(len(trackfiles), 1)
+        return trackfiles[0]
+
+    def assert_heatmap_count(self, count: int):
+        self.assertEqual(sum(HeatmapCell.objects.filter(user=self.user, zoom=8).values_list("count", flat=True)), count)
+
+    def test_append_within_maxtime(self):
+        """Test that appended points continuing the track within TRACKSEG_MAXTIME extend the last Trackseg"""
+        points = create_points(120)
+        trackfile = self.save(points[:60])
+        trackseg = trackfile.tracksegs.get()
+        self.assertEqual(trackseg.trackpoint_cnt, 60)
+        trackfile = self.save(points[60:])
+        trackseg = trackfile.tracksegs.get()
+        self.assertEqual((trackseg.starttime, trackseg.endtime), (points[0].time, points[-1].time))
+        self.assertEqual(trackseg.trackpoint_cnt, 120)
+        self.assertAlmostEqual(trackseg.stats.distance, 119 * 1.11, delta=5)
+        trackfile.refresh_from_db()
+        self.assertEqual((trackfile.trackpoint_cnt, trackfile.endtime), (120, points[-1].time))
+        self.assertEqual(trackfile.geometry.num_geom, 1)
+        self.assertAlmostEqual(trackfile.stats.distance, trackseg.stats.distance)
+        self.assert_heatmap_count(120)
+
+    def test_append_after_gap(self):
+        """Test that appended points after a gap longer than TRACKSEG_MAXTIME start a new Trackseg"""
+        points = create_points(60)
+        later = shift_points(create_points(60), lat=1e-3, seconds=3600)
+        self.save(points)
+        trackfile = self.save(later)
+        tracksegs = list(trackfile.tracksegs.order_by("starttime"))
+        self.assertEqual([trackseg.trackpoint_cnt for trackseg in tracksegs], [60, 60])
+        self.assertEqual(tracksegs[1].starttime, later[0].time)
+        self.assertTrue(all(trackseg.stats for trackseg in tracksegs))
+        trackfile.refresh_from_db()
+        self.assertEqual((trackfile.trackpoint_cnt, trackfile.geometry.num_geom), (120, 2))
+        self.assert_heatmap_count(120)
+        # Points older than endtime are not appended, but the whole Trackfile is processed again
+        trackfile = self.save(shift_points(create_points(10), seconds=1800))
+        self.assertEqual(trackfile.tracksegs.count(), 3)
+        self.assertEqual(trackfile.trackpoint_cnt, 130)
+        self.assert_heatmap_count(130)
@@ -1,9 +1,49 @@
+import datetime
+import io
+import json
 import logging
-from typing import Optional, List
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+import zlib
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, Optional, List, TextIO, Union
+from xml.sax.saxutils import escape as xml_escape
 
 import gpxpy
+import numpy as np
+from django.conf import settings
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from django.contrib.gis.geos import GEOSGeometry
+from django.utils.dateparse import parse_datetime
+from PIL import Image, ImageDraw
+
+EARTH_RADIUS = 6371008.8  # meters
+
+# Alternative key names used by various GPS logger apps, mapped to Trackpoint fields.
+# OwnTracks: https://owntracks.org/booklet/tech/json/
+# GPSLogger: custom URL body, e.g. {"lat": %LAT, "lon": %LON, "time": "%TIME", "ele": %ALT}
+trackpoint_keys_map = {
+    "latitude": "lat",
+    "longitude": "lon",
+    "lng": "lon",
+    "timestamp": "time",
+    "tst": "time",
+    "alt": "ele",
+    "altitude": "ele",
+    "elevation": "ele",
+    "acc": "hacc",
+    "accuracy": "hacc",
+    "vac": "vacc",
+    "cog": "course",
+    "bearing": "course",
+    "direction": "course",
+    "satellites": "sat",
+}
+
+# Optional numeric fields of posted trackpoints, "vel" is OwnTracks' velocity in km/h
+trackpoint_float_fields = ["ele", "speed", "course", "hacc", "vacc", "hdop", "vdop", "pdop", "tdop", "vel"]
+trackpoint_int_fields = ["sat", "satavail"]
 
 
 def simplify(geom: GEOSGeometry, tolerance: float = 10.0) -> GEOSGeometry:
@@ -39,3 +79,1016 @@ def read_gpxfile(fname: str) -> Optional[gpxpy.gpx.GPX]:
     except (UnicodeDecodeError, gpxpy.gpx.GPXXMLSyntaxException) as err:
         logging.warning(f"Failed to parse {fname}, probably not a GPX file")
         return None
+
+
+def parse_timestamp(val: Union[str, int, float]) -> datetime.datetime:
+    """Parse ISO 8601 string or UNIX epoch (in seconds or milliseconds) into aware datetime."""
+    if isinstance(val, (int, float)) or (isinstance(val, str) and val.replace(".", "", 1).isdigit()):
+        val = float(val)
+        if val > 1e11:  # Milliseconds
+            val = val / 1000
+        return datetime.datetime.fromtimestamp(val, tz=datetime.timezone.utc)
+    timestamp = parse_datetime(val)
+    if timestamp is None:
+        raise ValueError(f"Invalid timestamp {val}")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
+def parse_trackpoint_json(data: Union[dict, list]) -> List[dict]:
+    """
+    Convert posted JSON trackpoint data into a list of dicts suitable for Trackpoint.set_data().
+    'data' may be a single point, a list of points or a dict having a list of points
+    in "locations" or "points" key. OwnTracks messages which are not locations are ignored.
+    Raise ValueError, if some point doesn't have valid lat, lon and time or has non-numeric optional fields.
+    """
+    if isinstance(data, dict):
+        data = data.get("locations", data.get("points", [data]))
+    if not isinstance(data, list):
+        raise ValueError("Expecting a point object or a list of point objects")
+    points = []
+    for item in data:
+        if not isinstance(item, dict):
+            raise ValueError(f"Expecting a point object, got {item}")
+        if item.get("_type", "location") != "location":
+            continue
+        point = {trackpoint_keys_map.get(key, key): val for key, val in item.items()}
+        try:
+            point["lat"], point["lon"] = float(point["lat"]), float(point["lon"])
+            point["time"] = parse_timestamp(point["time"])
+        except (KeyError, TypeError, ValueError) as err:
+            raise ValueError(f"Point must have valid lat, lon and time: {err}")
+        try:
+            for fields, convert in [(trackpoint_float_fields, float), (trackpoint_int_fields, int)]:
+                for field in fields:
+                    if point.get(field) is not None:
+                        point[field] = convert(point[field])
+        except (OverflowError, TypeError, ValueError) as err:
+            raise ValueError(f"Point has invalid {field}: {err}")
+        if point.get("vel") is not None and "speed" not in point:  # OwnTracks reports velocity in km/h
+            point["speed"] = point["vel"] / 3.6
+        points.append(point)
+    return points
+
+
+def haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Return great-circle distances in meters between coordinate arrays (in degrees)."""
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class TrackpointFilter:
+    """
+    Drop noisy and redundant GPS points before they are saved.
+
+    * Points without time, points having hdop over max_hdop and
+      speed spikes (speed from the previous and to the next point exceed max_speed) are rejected.
+    * Stationary clusters and oversampled stretches are thinned by keeping only one point
+      per min_interval seconds and per min_distance meters (straight-line distance from the previous kept point).
+
+    Filtering state is preserved between calls, so a long track can be filtered in
+    time ordered batches. When max_speed is set, the last point of a batch is held back
+    until the next point is known, so finish() must be called after the last batch.
+    Number of dropped points is collected to 'stats'.
+    """
+
+    # Number of points, which are compared at once to the previous kept point when thinning
+    THIN_WINDOW = 256
+
+    def __init__(self, max_speed=None, max_hdop=None, min_interval=None, min_distance=None):
+        self.max_speed = max_speed  # m/s
+        self.max_hdop = max_hdop
+        self.min_interval = min_interval  # seconds
+        self.min_distance = min_distance  # meters
+        self.previous = None  # (time, lat, lon) of the last point, which was not a speed spike
+        self.last = None  # (time, lat, lon) of the last accepted point
+        self.pending = []  # The last point of previous batch, if it wasn't checked for spike yet
+        self.stats = {"received": 0, "no_time": 0, "hdop": 0, "speed": 0, "thinned": 0}
+
+    @classmethod
+    def from_settings(cls) -> "TrackpointFilter":
+        conf = settings.TRACK.get("INGEST_FILTER", {})
+        return cls(
+            max_speed=conf.get("MAX_SPEED"),
+            max_hdop=conf.get("MAX_HDOP"),
+            min_interval=conf.get("MIN_INTERVAL"),
+            min_distance=conf.get("MIN_DISTANCE"),
+        )
+
+    def __call__(self, points: List[gpxpy.gpx.GPXTrackPoint]) -> List[gpxpy.gpx.GPXTrackPoint]:
+        self.stats["received"] += len(points)
+        valid = [p for p in points if p.time is not None]
+        self.stats["no_time"] += len(points) - len(valid)
+        if self.max_hdop is not None:
+            accepted = [p for p in valid if p.horizontal_dilution is None or p.horizontal_dilution <= self.max_hdop]
+            self.stats["hdop"] += len(valid) - len(accepted)
+            valid = accepted
+        return self._filter(self.pending + valid, final=False)
+
+    def finish(self) -> List[gpxpy.gpx.GPXTrackPoint]:
+        """Return the accepted points of those, which were held back from the last batch."""
+        return self._filter(self.pending, final=True)
+
+    def _filter(self, points: List[gpxpy.gpx.GPXTrackPoint], final: bool) -> List[gpxpy.gpx.GPXTrackPoint]:
+        self.pending = []
+        if self.max_speed is not None and not final:
+            # The last point is a spike only if speed to the next point is too high
+            points, self.pending = points[:-1], points[-1:]
+        if not points:
+            return []
+        t = np.array([p.time.timestamp() for p in points])
+        lat = np.array([p.latitude for p in points], dtype=float)
+        lon = np.array([p.longitude for p in points], dtype=float)
+
+        if self.max_speed is not None:
+            # Points are checked against the previous non-spike point and the held back point
+            before = [] if self.previous is None else [self.previous]
+            after = [(p.time.timestamp(), p.latitude, p.longitude) for p in self.pending]
+            t_, lat_, lon_ = [
+                np.concatenate([[b[k] for b in before], a, [n[k] for n in after]]) for k, a in enumerate((t, lat, lon))
+            ]
+            dist = haversine(lat_[:-1], lon_[:-1], lat_[1:], lon_[1:])  # Distance from point i to i+1
+            dt = np.diff(t_)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                speed = np.where(dt > 0, dist / dt, np.where(dist > 0, np.inf, 0.0))
+            too_fast = speed > self.max_speed
+            # Point is a spike if both incoming and outgoing speed are too high
+            spike = np.concatenate([[False], too_fast]) & np.concatenate([too_fast, [False]])
+            spike = spike[len(before): len(before) + len(points)]
+            self.stats["speed"] += int(spike.sum())
+            points = [p for p, is_spike in zip(points, spike) if not is_spike]
+            t, lat, lon = t[~spike], lat[~spike], lon[~spike]
+            if points:
+                self.previous = (t[-1], lat[-1], lon[-1])
+
+        if self.min_interval or self.min_distance:
+            # Keep greedily the next point, which is at least min_interval seconds and
+            # min_distance meters away from the previous kept point
+            selected = []
+            i = 0
+            while i < len(points):
+                if self.last is not None:
+                    hi = min(i + self.THIN_WINDOW, len(points))
+                    far_enough = np.ones(hi - i, dtype=bool)
+                    if self.min_interval:
+                        far_enough &= t[i:hi] - self.last[0] >= self.min_interval
+                    if self.min_distance:
+                        far_enough &= haversine(self.last[1], self.last[2], lat[i:hi], lon[i:hi]) >= self.min_distance
+                    if not far_enough.any():
+                        i = hi
+                        continue
+                    i += int(np.argmax(far_enough))
+                selected.append(i)
+                self.last = (t[i], lat[i], lon[i])
+                i += 1
+            self.stats["thinned"] += len(points) - len(selected)
+            points = [points[i] for i in selected]
+        return points
+
+
+def iter_json_array(f: TextIO, key: str, chunk_size: int = 1 << 20) -> Iterator:
+    """
+    Yield items of a JSON array, which is the value of 'key' in a JSON object,
+    reading the file in chunks, so even multi-GB files are parsed in constant memory.
+    Array items must be JSON objects or arrays.
+    """
+    decoder = json.JSONDecoder()
+    start_re = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    separator_re = re.compile(r"[\s,]*")
+    buf = ""
+    while True:  # Find the beginning of the array
+        m = start_re.search(buf)
+        if m:
+            buf = buf[m.end():]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buf = buf[-len(key) - 100:] + chunk  # Keep the tail, key may be split between chunks
+    pos = 0
+    while True:
+        pos = separator_re.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:  # Item is incomplete, read more data
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if pos >= len(buf):
+                    return
+                raise
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+def nan_to_none(values: np.ndarray) -> list:
+    """Convert a numpy array into a list, where NaNs are replaced with None."""
+    return [None if v != v else v for v in values.tolist()]
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+# Trackpoint fields saved in archive files, see Trackfile.archive_trackpoints()
+ARCHIVE_FIELDS = [
+    "id",
+    "status",
+    "time",
+    "lat",
+    "lon",
+    "ele",
+    "speed",
+    "course",
+    "hacc",
+    "vacc",
+    "hdop",
+    "vdop",
+    "pdop",
+    "tdop",
+    "sat",
+    "satavail",
+    "created_at",
+]
+ARCHIVE_INT_FIELDS = ["id", "status"]
+ARCHIVE_TIME_FIELDS = ["time", "created_at"]  # UTC microseconds since epoch
+
+
+def to_microseconds(dt: datetime.datetime) -> int:
+    return (dt - EPOCH) // MICROSECOND
+
+
+def from_microseconds(values: np.ndarray) -> List[datetime.datetime]:
+    return [EPOCH + datetime.timedelta(microseconds=v) for v in values.tolist()]
+
+
+def trackpoint_rows_to_arrays(rows: Iterable[tuple], fields: List[str] = ARCHIVE_FIELDS) -> Dict[str, np.ndarray]:
+    """
+    Convert rows of Trackpoint.objects.values_list(*fields) into a column per field.
+    Missing values are saved as NaN, so all but id, status and timestamps are float arrays.
+    """
+    columns = list(zip(*rows)) or [() for _ in fields]
+    arrays = {}
+    for field, values in zip(fields, columns):
+        if field in ARCHIVE_TIME_FIELDS:
+            arrays[field] = np.array([to_microseconds(v) for v in values], dtype=np.int64)
+        elif field in ARCHIVE_INT_FIELDS:
+            arrays[field] = np.array(values, dtype=np.int64)
+        else:
+            arrays[field] = np.array(values, dtype=np.float64)
+    return arrays
+
+
+def filter_trackpoint_arrays(
+    arrays: Dict[str, np.ndarray],
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    bbox: Optional[List[float]] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Return archived trackpoints between start and end (inclusive)
+    and inside bbox (min lon, min lat, max lon, max lat).
+    """
+    mask = np.ones(len(arrays["time"]), dtype=bool)
+    if start is not None:
+        mask &= arrays["time"] >= to_microseconds(start)
+    if end is not None:
+        mask &= arrays["time"] <= to_microseconds(end)
+    if bbox is not None:
+        lat, lon = arrays["lat"], arrays["lon"]
+        mask &= (lon >= bbox[0]) & (lat >= bbox[1]) & (lon <= bbox[2]) & (lat <= bbox[3])
+    return {field: values[mask] for field, values in arrays.items()}
+
+
+def track_statistics(
+    times: np.ndarray,
+    lat: np.ndarray,
+    lon: np.ndarray,
+    ele: np.ndarray,
+    moving_speed: float = 0.5,
+    speed_interval: float = 10.0,
+    profile_points: int = 100,
+) -> dict:
+    """
+    Compute statistics of a continuous track from coordinate arrays ordered by time (times in seconds).
+
+    * moving_time is the time of steps, where speed is at least moving_speed m/s
+    * max_speed is the highest average speed over at least speed_interval seconds, to ignore GPS jitter
+    * ascent and descent are summed from elevations smoothed with 5 point moving average
+    * elevation_profile is a list of [distance (m), elevation (m)] pairs, max profile_points pairs
+    """
+    stats = {
+        "distance": 0.0,
+        "duration": 0.0,
+        "moving_time": 0.0,
+        "avg_speed": None,
+        "max_speed": None,
+        "ascent": None,
+        "descent": None,
+        "min_ele": None,
+        "max_ele": None,
+        "elevation_profile": [],
+    }
+    n = len(times)
+    if n == 0:
+        return stats
+    cumdist = np.zeros(n)
+    if n > 1:
+        dt = np.diff(times)
+        dist = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        cumdist[1:] = np.cumsum(dist)
+        speed = np.divide(dist, dt, out=np.zeros_like(dist), where=dt > 0)
+        moving = speed >= moving_speed
+        stats["distance"] = float(cumdist[-1])
+        stats["duration"] = float(times[-1] - times[0])
+        stats["moving_time"] = float(dt[moving].sum())
+        if stats["moving_time"] > 0:
+            stats["avg_speed"] = float(dist[moving].sum() / stats["moving_time"])
+        # Index of the first point at least speed_interval seconds after each point
+        end = np.searchsorted(times, times + speed_interval)
+        start = np.nonzero(end < n)[0]
+        if len(start) > 0:
+            end = end[start]
+            stats["max_speed"] = float(np.max((cumdist[end] - cumdist[start]) / (times[end] - times[start])))
+        elif stats["duration"] > 0:
+            stats["max_speed"] = stats["distance"] / stats["duration"]
+    has_ele = ~np.isnan(ele)
+    if has_ele.any():
+        elevations = ele[has_ele]
+        stats["min_ele"] = float(elevations.min())
+        stats["max_ele"] = float(elevations.max())
+        window = min(5, len(elevations))
+        smoothed = np.convolve(elevations, np.ones(window) / window, mode="valid")
+        diff = np.diff(smoothed)
+        stats["ascent"] = float(diff[diff > 0].sum())
+        stats["descent"] = float(-diff[diff < 0].sum())
+        distances = cumdist[has_ele]
+        profile_x = np.linspace(distances[0], distances[-1], min(profile_points, len(elevations)))
+        profile_y = np.interp(profile_x, distances, elevations)
+        profile = zip(profile_x.tolist(), profile_y.tolist())
+        stats["elevation_profile"] = [[round(x, 1), round(y, 1)] for x, y in profile]
+    return stats
+
+
+def merge_track_statistics(stats_list: List[dict], profile_points: int = 100) -> dict:
+    """
+    Combine statistics of consecutive tracks (e.g. Tracksegs of a Trackfile) into statistics of the whole.
+    Distance and durations don't include gaps between tracks.
+    """
+
+    def values(key):
+        return [s[key] for s in stats_list if s[key] is not None]
+
+    stats = {key: float(sum(values(key))) for key in ["distance", "duration", "moving_time"]}
+    stats["avg_speed"] = None
+    if stats["moving_time"] > 0:
+        moving_distance = sum(s["avg_speed"] * s["moving_time"] for s in stats_list if s["avg_speed"] is not None)
+        stats["avg_speed"] = moving_distance / stats["moving_time"]
+    for key in ["ascent", "descent"]:
+        stats[key] = float(sum(values(key))) if values(key) else None
+    stats["max_speed"] = max(values("max_speed"), default=None)
+    stats["min_ele"] = min(values("min_ele"), default=None)
+    stats["max_ele"] = max(values("max_ele"), default=None)
+    profile = []
+    offset = 0.0
+    for s in stats_list:
+        profile += [[round(x + offset, 1), y] for x, y in s["elevation_profile"]]
+        offset += s["distance"]
+    if len(profile) > profile_points:
+        profile = [profile[i] for i in np.linspace(0, len(profile) - 1, profile_points).round().astype(int)]
+    stats["elevation_profile"] = profile
+    return stats
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Downsample a series to n points using Largest-Triangle-Three-Buckets algorithm
+    and return indices of selected points. First and last points are always selected.
+    See https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+    """
+    length = len(x)
+    if n >= length or n < 3:
+        return np.arange(length)
+    # n - 2 buckets between the first and the last point
+    edges = np.linspace(1, length - 1, n - 1).astype(int)
+    indices = np.empty(n, dtype=int)
+    indices[0], indices[-1] = 0, length - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = (edges[i + 1], edges[i + 2]) if i < n - 3 else (length - 1, length)
+        # Average point of the next bucket is the third vertex of the triangle
+        cx, cy = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def interpolate_positions(
+    track_times: np.ndarray, lat: np.ndarray, lon: np.ndarray, times: np.ndarray, max_gap: float
+) -> np.ndarray:
+    """
+    Return positions (an array of [lat, lon] rows) at given times (sorted, seconds)
+    from a track (sorted by time, seconds). Position is interpolated between the previous
+    and the next track point, if they are max max_gap seconds apart, otherwise the nearer
+    point is used, if it is within max_gap seconds. Unresolved positions are NaN.
+    """
+    positions = np.full((len(times), 2), np.nan)
+    if len(track_times) == 0 or len(times) == 0:
+        return positions
+    # Index of the first track point at or after each time
+    nxt = np.searchsorted(track_times, times, side="left")
+    prev = np.clip(nxt - 1, 0, len(track_times) - 1)
+    nxt = np.clip(nxt, 0, len(track_times) - 1)
+    prev_gap = np.where(track_times[prev] <= times, times - track_times[prev], np.inf)
+    next_gap = np.where(track_times[nxt] >= times, track_times[nxt] - times, np.inf)
+    span = track_times[nxt] - track_times[prev]
+    between = (prev_gap + next_gap <= max_gap) & (span > 0)
+    weight = np.divide(prev_gap, span, out=np.zeros_like(prev_gap), where=between)
+    positions[between, 0] = lat[prev][between] + (lat[nxt][between] - lat[prev][between]) * weight[between]
+    positions[between, 1] = lon[prev][between] + (lon[nxt][between] - lon[prev][between]) * weight[between]
+    nearest = np.where(prev_gap <= next_gap, prev, nxt)
+    near = ~between & (np.minimum(prev_gap, next_gap) <= max_gap)
+    positions[near, 0] = lat[nearest][near]
+    positions[near, 1] = lon[nearest][near]
+    return positions
+
+
+def detect_stay_points(
+    times: np.ndarray, lat: np.ndarray, lon: np.ndarray, max_distance: float = 200, min_duration: float = 600
+) -> List[tuple]:
+    """
+    Detect stay points from a track ordered by time (times in seconds).
+    A stay point is a sequence of points staying within max_distance meters from its first point
+    for at least min_duration seconds. Return a list of (first index, last index + 1) pairs.
+    """
+    chunk_size = 1000  # Distances are computed in chunks, because stays are usually short
+    n = len(times)
+    stays = []
+    i = 0
+    while i < n - 1:
+        end = n
+        for k in range(i + 1, n, chunk_size):
+            distances = haversine(lat[i], lon[i], lat[k: k + chunk_size], lon[k: k + chunk_size])
+            far = np.nonzero(distances > max_distance)[0]
+            if len(far) > 0:
+                end = k + int(far[0])
+                break
+        if times[end - 1] - times[i] >= min_duration:
+            stays.append((i, end))
+            i = end
+        else:
+            i += 1
+    return stays
+
+
+def runs_within_radius(lat: np.ndarray, lon: np.ndarray, lat0: float, lon0: float, radius: float) -> List[tuple]:
+    """
+    Find runs of consecutive points within radius meters from (lat0, lon0).
+    Return a list of (first index, last index + 1, min distance in meters) tuples.
+    """
+    if len(lat) == 0:
+        return []
+    distances = haversine(lat0, lon0, lat, lon)
+    within = np.concatenate([[False], distances <= radius, [False]])
+    edges = np.nonzero(np.diff(within.astype(np.int8)))[0]
+    return [(int(lo), int(hi), float(distances[lo:hi].min())) for lo, hi in zip(edges[::2], edges[1::2])]
+
+
+def project_coordinates(lat: np.ndarray, lon: np.ndarray, lat0: float, lon0: float) -> np.ndarray:
+    """Project coordinates into local (x, y) meters around (lat0, lon0) using equirectangular projection."""
+    x = EARTH_RADIUS * np.radians(np.asarray(lon) - lon0) * np.cos(np.radians(lat0))
+    y = EARTH_RADIUS * np.radians(np.asarray(lat) - lat0)
+    return np.column_stack([x, y])
+
+
+def discrete_frechet(p: np.ndarray, q: np.ndarray) -> float:
+    """
+    Return discrete Fréchet distance between polylines p and q (arrays of (x, y) rows).
+    Dynamic programming table is filled one anti-diagonal at a time,
+    because all cells of an anti-diagonal depend only on the previous ones.
+    """
+    n, m = len(p), len(q)
+    if n == 0 or m == 0:
+        return float("inf")
+    dist = np.sqrt(((p[:, None, :] - q[None, :, :]) ** 2).sum(axis=2))
+    ca = np.full((n, m), np.inf)
+    ca[0, 0] = dist[0, 0]
+    for k in range(1, n + m - 1):
+        i = np.arange(max(0, k - m + 1), min(k, n - 1) + 1)
+        j = k - i
+        prev = np.full(len(i), np.inf)
+        has_i, has_j = i > 0, j > 0
+        prev[has_i] = ca[i[has_i] - 1, j[has_i]]
+        prev[has_j] = np.minimum(prev[has_j], ca[i[has_j], j[has_j] - 1])
+        both = has_i & has_j
+        prev[both] = np.minimum(prev[both], ca[i[both] - 1, j[both] - 1])
+        ca[i, j] = np.maximum(prev, dist[i, j])
+    return float(ca[-1, -1])
+
+
+def downsample_coordinates(coords: np.ndarray, max_points: int) -> np.ndarray:
+    """Return max max_points evenly spaced rows of coords, including the first and the last one."""
+    if len(coords) <= max_points:
+        return coords
+    return coords[np.linspace(0, len(coords) - 1, max_points).round().astype(int)]
+
+
+def tile_indices(lat: np.ndarray, lon: np.ndarray, zoom: int) -> tuple:
+    """Return x and y index arrays of Web Mercator (slippy map) tiles containing given coordinates."""
+    n = 1 << zoom
+    lat_rad = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = np.floor((np.asarray(lon) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def heatmap_cells(lat: np.ndarray, lon: np.ndarray, zooms: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Bin coordinates into tiles at every zoom level and count them.
+    Return columns zoom, x, y and count of non-empty cells.
+    """
+    columns = {"zoom": [], "x": [], "y": [], "count": []}
+    for zoom in zooms:
+        x, y = tile_indices(lat, lon, zoom)
+        cells, counts = np.unique(np.column_stack([x, y]), axis=0, return_counts=True)
+        columns["zoom"].append(np.full(len(cells), zoom))
+        columns["x"].append(cells[:, 0])
+        columns["y"].append(cells[:, 1])
+        columns["count"].append(counts)
+    return {key: np.concatenate(values).astype(np.int64) for key, values in columns.items()}
+
+
+GPX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx version="1.1" creator="MyData" xmlns="http://www.topografix.com/GPX/1/1">\n'
+)
+# Optional <trkpt> child elements in the order of GPX 1.1 schema
+GPX_TRKPT_FIELDS = ["ele", "time", "sat", "hdop", "vdop", "pdop"]
+
+
+def format_gpx_time(dt: datetime.datetime) -> str:
+    return dt.astimezone(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def iter_gpx(rows: Iterable[tuple], name: str = "", maxtime: float = 120, chunk_size: int = 1000) -> Iterator[str]:
+    """
+    Generate GPX document incrementally from trackpoint rows ordered by time.
+    Rows are (lat, lon, ele, time, sat, hdop, vdop, pdop) tuples, see GPX_TRKPT_FIELDS.
+    A new <trkseg> is started when there are more than maxtime seconds between points.
+    XML is yielded in chunks of chunk_size trackpoints, so the whole document is never in memory.
+    """
+    yield GPX_HEADER + "<trk>\n"
+    if name:
+        yield f"<name>{xml_escape(name)}</name>\n"
+    parts = []
+    previous = None
+    for lat, lon, *values in rows:
+        time = values[1]
+        if previous is None or (time - previous).total_seconds() > maxtime:
+            if previous is not None:
+                parts.append("</trkseg>\n")
+            parts.append("<trkseg>\n")
+        previous = time
+        parts.append(f'<trkpt lat="{lat}" lon="{lon}">')
+        for field, value in zip(GPX_TRKPT_FIELDS, values):
+            if value is None:
+                continue
+            if field == "time":
+                value = format_gpx_time(value)
+            parts.append(f"<{field}>{value}</{field}>")
+        parts.append("</trkpt>\n")
+        if len(parts) >= chunk_size * 3:
+            yield "".join(parts)
+            parts = []
+    if previous is not None:
+        parts.append("</trkseg>\n")
+    parts.append("</trk>\n</gpx>\n")
+    yield "".join(parts)
+
+
+def gzip_stream(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Compress a stream of text chunks into a gzip stream."""
+    compressor = zlib.compressobj(wbits=31)  # 16 + 15 = gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def render_track_thumbnail(
+    lines: List[List[tuple]], size: int = 128, color: tuple = (220, 40, 40, 255), width: int = 2, padding: int = 4
+) -> bytes:
+    """
+    Render lines (lists of (lon, lat) coordinates) into a square transparent PNG image in Web Mercator projection.
+    Image is drawn in double size and scaled down to get smooth lines.
+    """
+    scale = 2
+    canvas = size * scale
+    projected = []
+    for line in lines:
+        coords = np.asarray(line, dtype=float).reshape(-1, 2)
+        lat_rad = np.radians(np.clip(coords[:, 1], -85.0511, 85.0511))
+        projected.append(np.column_stack([np.radians(coords[:, 0]), -np.log(np.tan(np.pi / 4 + lat_rad / 2))]))
+    image = Image.new("RGBA", (canvas, canvas), (0, 0, 0, 0))
+    if projected:
+        xy = np.concatenate(projected)
+        low, high = xy.min(axis=0), xy.max(axis=0)
+        extent = max((high - low).max(), 1e-9)
+        ratio = (canvas - 2 * padding * scale) / extent
+        offset = (canvas - (high - low) * ratio) / 2  # Center the track
+        draw = ImageDraw.Draw(image)
+        for coords in projected:
+            pixels = [tuple(p) for p in ((coords - low) * ratio + offset).tolist()]
+            if len(pixels) == 1:
+                pixels.append(pixels[0])
+            draw.line(pixels, fill=color, width=width * scale, joint="curve")
+    image = image.resize((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+def takeout_records_to_points(records: List[dict]) -> List[gpxpy.gpx.GPXTrackPoint]:
+    """
+    Convert a batch of Google Takeout Location History records into GPXTrackPoints.
+    Records without valid coordinates or timestamp are ignored.
+    """
+
+    def column(key: str, scale: float = 1.0) -> np.ndarray:
+        return np.array([r.get(key) for r in records], dtype=float) * scale
+
+    lat, lon = column("latitudeE7", 1e-7), column("longitudeE7", 1e-7)
+    # Some exports contain E7 values which have overflown signed 32-bit integer
+    lat = np.where(lat > 90, lat - 2 ** 32 * 1e-7, lat)
+    lon = np.where(lon > 180, lon - 2 ** 32 * 1e-7, lon)
+    # Older exports have "timestampMs", newer ISO 8601 "timestamp" (mostly in UTC, e.g. 2021-04-01T12:00:00.123Z)
+    is_epoch = np.array(["timestampMs" in r for r in records], dtype=bool)
+    iso = [r.get("timestamp", "") for r in records]
+    times = np.empty(len(records), dtype="datetime64[ms]")
+    times[is_epoch] = np.array([int(r["timestampMs"]) for r in records if "timestampMs" in r], dtype="datetime64[ms]")
+    times[~is_epoch] = np.array(
+        [t[:-1] if t.endswith("Z") else "NaT" for t, epoch in zip(iso, is_epoch) if not epoch], dtype="datetime64[ms]"
+    )
+    for i in np.flatnonzero(np.isnat(times)):  # Timestamps having other time zone than Z, if any
+        if iso[i]:
+            times[i] = np.datetime64(parse_timestamp(iso[i]).astimezone(datetime.timezone.utc).replace(tzinfo=None))
+    valid = ~(np.isnan(lat) | np.isnan(lon) | np.isnat(times))
+    columns = [
+        lat[valid].tolist(),
+        lon[valid].tolist(),
+        [t.replace(tzinfo=datetime.timezone.utc) for t in times[valid].astype(datetime.datetime)],
+        nan_to_none(column("altitude")[valid]),
+        nan_to_none(column("velocity")[valid]),
+        nan_to_none(column("heading")[valid]),
+    ]
+    points = []
+    for latitude, longitude, time, elevation, speed, course in zip(*columns):
+        p = gpxpy.gpx.GPXTrackPoint(latitude, longitude, elevation=elevation, time=time, speed=speed)
+        p.course = course
+        points.append(p)
+    return points
+
+
+def parse_takeout_records(f: TextIO, batch_size: int = 10000) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """Stream-parse Google Takeout Location History (Records.json) and yield trackpoints in batches."""
+    records = []
+    for record in iter_json_array(f, "locations"):
+        records.append(record)
+        if len(records) >= batch_size:
+            yield takeout_records_to_points(records)
+            records = []
+    if records:
+        yield takeout_records_to_points(records)
+
+
+# Parser registry. Parsers read a binary file handle and yield lists of GPXTrackPoints
+# in batches, so that files of any size are parsed in constant memory.
+# datatype -> {"parse": function, "extensions": list, "sniff": function returning True if file head matches}
+parsers = {}
+
+
+def register_parser(datatype: str, extensions: List[str], sniff: Callable[[bytes], bool]):
+    """Decorator to register a parser function for given datatype (e.g. GPX_FILE)."""
+
+    def decorator(func):
+        parsers[datatype] = {"parse": func, "extensions": extensions, "sniff": sniff}
+        return func
+
+    return decorator
+
+
+def detect_datatype(filename: str, head: bytes) -> Optional[str]:
+    """
+    Return the datatype of a file based on the first few kilobytes of its content,
+    or its filename extension, if content is not recognized. Return None for unknown files.
+    """
+    for datatype, parser in parsers.items():
+        if parser["sniff"](head):
+            return datatype
+    ext = os.path.splitext(filename.lower())[1]
+    for datatype, parser in parsers.items():
+        if ext in parser["extensions"]:
+            return datatype
+    return None
+
+
+def parse_trackpoint_batches(f: BinaryIO, datatype: str, batch_size: int = 10000) -> Iterator[
+        List[gpxpy.gpx.GPXTrackPoint]]:
+    """Parse a file of given datatype and yield its trackpoints in batches."""
+    if datatype not in parsers:
+        raise ValueError(f"No parser for datatype {datatype}")
+    yield from parsers[datatype]["parse"](f, batch_size)
+
+
+def batched(points: Iterator[gpxpy.gpx.GPXTrackPoint], batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """Collect points into lists of batch_size points."""
+    batch = []
+    for p in points:
+        batch.append(p)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_xml_elements(f: BinaryIO, tag: str) -> Iterator[ET.Element]:
+    """
+    Yield all elements having (namespace-less) name 'tag' from an XML file.
+    Yielded elements are removed from the tree after use to keep memory usage constant.
+    """
+    stack = []
+    for event, elem in ET.iterparse(f, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag.rsplit("}", 1)[-1] == tag:
+            yield elem
+            if stack:
+                del stack[-1][-1]  # Just ended element is always the parent's last child
+
+
+def xml_children(elem: ET.Element) -> dict:
+    """Return texts of element's descendants (also inside extensions) by their namespace-less name."""
+    return {child.tag.rsplit("}", 1)[-1]: child.text for child in elem.iter() if child.text and child.text.strip()}
+
+
+def to_float(val: Optional[str]) -> Optional[float]:
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+@register_parser("GPX_FILE", [".gpx"], lambda head: b"<gpx" in head)
+def parse_gpx(f: BinaryIO, batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """Stream-parse <trkpt> elements of a GPX file."""
+
+    def to_point(elem: ET.Element) -> gpxpy.gpx.GPXTrackPoint:
+        data = xml_children(elem)
+        p = gpxpy.gpx.GPXTrackPoint(
+            float(elem.get("lat")),
+            float(elem.get("lon")),
+            elevation=to_float(data.get("ele")),
+            time=parse_timestamp(data["time"]) if "time" in data else None,
+            horizontal_dilution=to_float(data.get("hdop")),
+            vertical_dilution=to_float(data.get("vdop")),
+            position_dilution=to_float(data.get("pdop")),
+            speed=to_float(data.get("speed")),
+        )
+        p.course = to_float(data.get("course"))
+        p.satellites = int(data["sat"]) if data.get("sat", "").isdigit() else None
+        return p
+
+    yield from batched((to_point(elem) for elem in iter_xml_elements(f, "trkpt")), batch_size)
+
+
+@register_parser("TCX_FILE", [".tcx"], lambda head: b"<TrainingCenterDatabase" in head)
+def parse_tcx(f: BinaryIO, batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """Stream-parse <Trackpoint> elements of a Garmin Training Center XML file."""
+
+    def to_points(elements: Iterator[ET.Element]) -> Iterator[gpxpy.gpx.GPXTrackPoint]:
+        for elem in elements:
+            data = xml_children(elem)
+            if "LatitudeDegrees" not in data or "LongitudeDegrees" not in data or "Time" not in data:
+                continue  # E.g. indoor activities have trackpoints without position
+            yield gpxpy.gpx.GPXTrackPoint(
+                float(data["LatitudeDegrees"]),
+                float(data["LongitudeDegrees"]),
+                elevation=to_float(data.get("AltitudeMeters")),
+                time=parse_timestamp(data["Time"]),
+                speed=to_float(data.get("Speed")),
+            )
+
+    yield from batched(to_points(iter_xml_elements(f, "Trackpoint")), batch_size)
+
+
+@register_parser("GOOGLE_TAKEOUT_JSON", [".json"], lambda head: re.search(rb'"locations"\s*:\s*\[', head) is not None)
+def parse_takeout(f: BinaryIO, batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    yield from parse_takeout_records(io.TextIOWrapper(f, encoding="utf-8"), batch_size)
+
+
+@register_parser("GEOJSON_FILE", [".geojson"], lambda head: b'"FeatureCollection"' in head)
+def parse_geojson(f: BinaryIO, batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """
+    Stream-parse features of a GeoJSON FeatureCollection.
+    Point features must have "time" (or "timestamp") property and LineString features
+    a "coordTimes" (or "times") property containing a timestamp for each coordinate.
+    """
+
+    def to_point(coords: list, time: Union[str, int, float]) -> gpxpy.gpx.GPXTrackPoint:
+        return gpxpy.gpx.GPXTrackPoint(
+            coords[1], coords[0], elevation=coords[2] if len(coords) > 2 else None, time=parse_timestamp(time)
+        )
+
+    def to_points(features: Iterator[dict]) -> Iterator[gpxpy.gpx.GPXTrackPoint]:
+        for feature in features:
+            geometry = feature.get("geometry") or {}
+            props = feature.get("properties") or {}
+            if geometry.get("type") == "Point":
+                time = props.get("time", props.get("timestamp"))
+                if time is not None:
+                    yield to_point(geometry["coordinates"], time)
+            elif geometry.get("type") in ["LineString", "MultiLineString"]:
+                lines = geometry["coordinates"] if geometry["type"] == "MultiLineString" else [geometry["coordinates"]]
+                times = props.get("coordTimes", props.get("times"))
+                if not times:
+                    continue
+                if geometry["type"] == "LineString":
+                    times = [times]
+                for line, line_times in zip(lines, times):
+                    for coords, time in zip(line, line_times):
+                        yield to_point(coords, time)
+
+    yield from batched(to_points(iter_json_array(io.TextIOWrapper(f, encoding="utf-8"), "features")), batch_size)
+
+
+def nmea_checksum_ok(sentence: str) -> bool:
+    """Validate the checksum (XOR of characters between $ and *) of a NMEA sentence, if it has one."""
+    if "*" not in sentence:
+        return True
+    data, checksum = sentence[1:].rsplit("*", 1)
+    calculated = 0
+    for c in data:
+        calculated ^= ord(c)
+    return checksum[:2].upper() == "{:02X}".format(calculated)
+
+
+def nmea_coordinate(val: str, hemisphere: str) -> Optional[float]:
+    """Convert NMEA (d)ddmm.mmmm coordinate into decimal degrees."""
+    if not val:
+        return None
+    dot = val.index(".") if "." in val else len(val)
+    degrees = float(val[: dot - 2]) + float(val[dot - 2:]) / 60
+    return -degrees if hemisphere in ["S", "W"] else degrees
+
+
+@register_parser("NMEA_FILE", [".nmea", ".nma"], lambda head: re.match(rb"\s*\$G[PLNAB]", head) is not None)
+def parse_nmea(f: BinaryIO, batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """
+    Parse NMEA 0183 log. A point is created from every valid RMC sentence, and
+    elevation, satellites and hdop are added from a GGA sentence having the same time.
+    """
+
+    def to_points(lines: Iterator[bytes]) -> Iterator[gpxpy.gpx.GPXTrackPoint]:
+        gga = {}
+        for line in lines:
+            sentence = line.decode("ascii", errors="ignore").strip()
+            if len(sentence) < 7 or not sentence.startswith("$") or not nmea_checksum_ok(sentence):
+                continue
+            fields = sentence.split("*")[0].split(",")
+            kind = fields[0][3:]
+            try:
+                if kind == "GGA" and len(fields) > 9:
+                    gga = {"time": fields[1], "sat": fields[7], "hdop": fields[8], "ele": fields[9]}
+                elif kind == "RMC" and len(fields) > 9 and fields[2] == "A":
+                    hhmmss, ddmmyy = fields[1], fields[9]
+                    time = datetime.datetime.strptime(ddmmyy + hhmmss.split(".")[0], "%d%m%y%H%M%S").replace(
+                        tzinfo=datetime.timezone.utc
+                    )
+                    if "." in hhmmss:
+                        time += datetime.timedelta(seconds=float("0." + hhmmss.split(".")[1]))
+                    p = gpxpy.gpx.GPXTrackPoint(
+                        nmea_coordinate(fields[3], fields[4]),
+                        nmea_coordinate(fields[5], fields[6]),
+                        time=time,
+                        speed=to_float(fields[7]) * 0.514444 if to_float(fields[7]) is not None else None,  # knots
+                    )
+                    p.course = to_float(fields[8])
+                    if gga.get("time") == hhmmss:
+                        p.elevation = to_float(gga["ele"])
+                        p.horizontal_dilution = to_float(gga["hdop"])
+                        p.satellites = int(gga["sat"]) if gga["sat"].isdigit() else None
+                    yield p
+            except ValueError as err:
+                logging.debug(f"Invalid NMEA sentence {sentence}: {err}")
+
+    yield from batched(to_points(f), batch_size)
+
+
+FIT_EPOCH = 631065600  # FIT timestamps are seconds since 1989-12-31T00:00:00Z
+FIT_RECORD = 20  # Global message number of record messages
+# Record message's field number -> (name, struct format, scale, offset), value = raw / scale - offset
+FIT_RECORD_FIELDS = {
+    253: ("timestamp", "I", 1, 0),
+    0: ("lat", "i", 2 ** 31 / 180, 0),  # semicircles
+    1: ("lon", "i", 2 ** 31 / 180, 0),
+    2: ("ele", "H", 5, 500),
+    6: ("speed", "H", 1000, 0),
+    78: ("ele", "I", 5, 500),  # enhanced_altitude
+    73: ("speed", "I", 1000, 0),  # enhanced_speed
+}
+FIT_INVALID = {"i": 0x7FFFFFFF, "I": 0xFFFFFFFF, "H": 0xFFFF}
+
+
+def fit_sniff(head: bytes) -> bool:
+    return len(head) >= 12 and head[8:12] == b".FIT"
+
+
+@register_parser("FIT_FILE", [".fit"], fit_sniff)
+def parse_fit(f: BinaryIO, batch_size: int) -> Iterator[List[gpxpy.gpx.GPXTrackPoint]]:
+    """
+    Stream-decode record messages of a Garmin FIT file.
+    Only the fields needed for trackpoints are decoded, other fields and messages are skipped.
+    """
+
+    def read(n: int) -> bytes:
+        data = f.read(n)
+        if len(data) < n:
+            raise ValueError("Unexpected end of FIT file")
+        return data
+
+    def to_points() -> Iterator[gpxpy.gpx.GPXTrackPoint]:
+        header_size = read(1)[0]
+        header = read(header_size - 1)
+        data_size = struct.unpack("<I", header[3:7])[0]
+        definitions = {}  # local message type -> (global message number, struct, field names)
+        timestamp = 0
+        consumed = 0
+        while consumed < data_size:
+            record_header = read(1)[0]
+            consumed += 1
+            if record_header & 0x80:  # Compressed timestamp header
+                local_type = (record_header >> 5) & 0x03
+                offset = record_header & 0x1F
+                timestamp = (timestamp & ~0x1F) + offset + (0x20 if offset < (timestamp & 0x1F) else 0)
+            elif record_header & 0x40:  # Definition message
+                local_type = record_header & 0x0F
+                data = read(5)
+                endian = ">" if data[1] == 1 else "<"
+                global_number = struct.unpack(endian + "H", data[2:4])[0]
+                field_data = read(3 * data[4])
+                consumed += 5 + len(field_data)
+                fmt, names = endian, []
+                for i in range(data[4]):
+                    number, size = field_data[3 * i], field_data[3 * i + 1]
+                    field = FIT_RECORD_FIELDS.get(number) if global_number == FIT_RECORD or number == 253 else None
+                    if field and struct.calcsize(field[1]) == size:
+                        fmt += field[1]
+                        names.append(number)
+                    else:
+                        fmt += f"{size}x"
+                if record_header & 0x20:  # Developer fields
+                    dev_count = read(1)[0]
+                    dev_data = read(3 * dev_count)
+                    consumed += 1 + len(dev_data)
+                    fmt += "{}x".format(sum(dev_data[3 * i + 1] for i in range(dev_count)))
+                definitions[local_type] = (global_number, struct.Struct(fmt), names)
+                continue
+            else:
+                local_type = record_header & 0x0F
+            if local_type not in definitions:
+                raise ValueError(f"FIT data message of undefined local type {local_type}")
+            global_number, message_struct, names = definitions[local_type]
+            values = dict(zip(names, message_struct.unpack(read(message_struct.size))))
+            consumed += message_struct.size
+            if values.get(253, FIT_INVALID["I"]) != FIT_INVALID["I"]:
+                timestamp = values[253]
+            if global_number != FIT_RECORD:
+                continue
+            data = {}
+            for number, raw in values.items():
+                name, fmt, scale, offset = FIT_RECORD_FIELDS[number]
+                if raw != FIT_INVALID[fmt]:
+                    data[name] = raw / scale - offset
+            if "lat" in data and "lon" in data:
+                yield gpxpy.gpx.GPXTrackPoint(
+                    data["lat"],
+                    data["lon"],
+                    elevation=data.get("ele"),
+                    time=datetime.datetime.fromtimestamp(FIT_EPOCH + timestamp, tz=datetime.timezone.utc),
+                    speed=data.get("speed"),
+                )
+
+    yield from batched(to_points(), batch_size)
@@ -1,43 +1,213 @@
-from django.contrib.gis.geos import Polygon
+import datetime
+import gzip
+import heapq
+import itertools
+import json
+from typing import List, Optional, Tuple
+
+import numpy as np
+from django.contrib.gis.geos import Point, Polygon
+from django.conf import settings
+from django.contrib.gis.measure import D
+from django.db.models import Avg, BooleanField, Count, ExpressionWrapper, Max, Min, Q
+from django.db.models.functions import Trunc
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework import filters
+from rest_framework import status
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.exceptions import ParseError
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from track.models import (
+    DailySummary,
+    HeatmapCell,
+    Trackfile,
+    Trackpoint,
+    Trackseg,
+    Visit,
+    export_gpx,
+    find_similar_trackfiles,
+    find_times_near,
+    get_user_trackpoint_arrays,
+    trackpoint_buffer,
+)
+from track.serializers import (
+    DailySummarySerializer,
+    TrackfileSerializer,
+    TrackpointBucketSerializer,
+    TrackpointSerializer,
+    TracksegSerializer,
+    VisitSerializer,
+)
+from track.utils import gzip_stream, haversine, lttb, parse_trackpoint_json
+
+
+def parse_time_range(query_params) -> Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]:
+    """Return `start` and `end` query parameters as aware datetimes (or None, if missing)."""
+    time_range = []
+    for key in ["start", "end"]:
+        value = query_params.get(key)
+        timestamp = parse_datetime(value) if value else None
+        if value and timestamp is None:
+            raise ParseError(f"{key} must be an ISO 8601 timestamp")
+        if timestamp and timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        time_range.append(timestamp)
+    return time_range[0], time_range[1]
+
+
+def parse_int_param(query_params, key: str, default: Optional[int] = None) -> Optional[int]:
+    value = query_params.get(key)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ParseError(f"{key} must be an integer")
+
+
+class MergedTrackpoints:
+    """
+    Database and archived Trackpoints ordered by time, merged lazily when a page is sliced,
+    so only Trackpoints up to the end of the requested page are read from the database.
+    """
+
+    def __init__(self, queryset, archived, start=None, end=None, bbox: Optional[List[float]] = None):
+        self.queryset = queryset
+        self.archived = list(archived)
+        self.start, self.end, self.bbox = start, end, bbox
+        self.cnt = None
 
-from track.models import Trackfile, Trackpoint, Trackseg
-from track.serializers import TrackfileSerializer, TrackpointSerializer, TracksegSerializer
+    def __len__(self) -> int:
+        if self.cnt is None:
+            self.cnt = self.queryset.count()
+            for trackfile in self.archived:
+                arrays = trackfile.get_trackpoint_arrays(self.start, self.end, self.bbox, fields=["time"])
+                self.cnt += len(arrays["time"])
+        return self.cnt
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index: index + 1][0]
+        start, stop = index.start or 0, index.stop if index.stop is not None else len(self)
+        streams = [self.queryset[:stop].iterator()]
+        for trackfile in self.archived:
+            streams.append(trackfile.get_archived_trackpoints(self.start, self.end, self.bbox))
+        merged = heapq.merge(*streams, key=lambda tp: tp.time)
+        return list(itertools.islice(merged, start, stop))
 
 
 class TrackpointViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Trackpoints to be viewed.
+
+    * Filter by `bbox=min Lon,min Lat,max Lon,max Lat`, `trackfile=id`,
+      `start` and `end` (ISO 8601 timestamps, inclusive).
+    * When `trackfile`, `start` or `end` is given, Trackpoints of archived Trackfiles are included too.
+    * Only valid Trackpoints are listed, duplicates of Trackpoints in other Trackfiles are left out.
+    * Add `bucket=minute|hour|day|week|month` to get Trackpoint count, centroid, mean speed
+      and elevation range per time bucket instead of single Trackpoints.
+      Buckets are aggregated in the database, so archived Trackpoints are not included.
     """
 
-    queryset = Trackpoint.objects.order_by("time")
+    queryset = Trackpoint.objects.filter(status=1).order_by("time")
     serializer_class = TrackpointSerializer
+    buckets = ["minute", "hour", "day", "week", "month"]
 
-    def get_queryset(self):
+    def get_bbox(self) -> Optional[List[float]]:
         """
         Bounding box filter is in standard format
         bbox = left,bottom,right,top
         bbox = min Longitude , min Latitude , max Longitude , max Latitude
         """
-        queryset = Trackpoint.objects.order_by("time")
         bbox = self.request.query_params.get("bbox")
+        if not bbox:
+            return None
+        points = bbox.split(",")
+        if len(points) != 4:
+            raise ParseError("bbox must be in format 'min Lon, min Lat, max Lon, max Lat'")
+        try:
+            return [float(p) for p in points]
+        except ValueError:
+            raise ParseError("bbox must be in format 'min Lon, min Lat, max Lon, max Lat' where all values are floats")
+
+    def get_time_range(self) -> Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]:
+        return parse_time_range(self.request.query_params)
+
+    def get_trackfile_id(self) -> Optional[int]:
+        return parse_int_param(self.request.query_params, "trackfile")
+
+    def get_queryset(self):
+        queryset = Trackpoint.objects.filter(status=1).order_by("time")
+        bbox = self.get_bbox()
         if bbox:
-            points = bbox.split(",")
-            if len(points) == 4:
-                try:
-                    points = [float(p) for p in points]
-                    poly = Polygon.from_bbox(points)
-                except ValueError:
-                    raise ParseError(
-                        "bbox must be in format 'min Lon, min Lat, max Lon, max Lat' where all values are floats"
-                    )
-            else:
-                raise ParseError("bbox must be in format 'min Lon, min Lat, max Lon, max Lat'")
-            queryset = queryset.filter(geometry__coveredby=poly)
+            queryset = queryset.filter(geometry__coveredby=Polygon.from_bbox(bbox))
+        start, end = self.get_time_range()
+        if start:
+            queryset = queryset.filter(time__gte=start)
+        if end:
+            queryset = queryset.filter(time__lte=end)
+        trackfile_id = self.get_trackfile_id()
+        if trackfile_id is not None:
+            queryset = queryset.filter(trackfile_id=trackfile_id)
         return queryset
 
+    def get_archived_trackfiles(self):
+        """Return archived Trackfiles overlapping with requested trackfile or time range."""
+        start, end = self.get_time_range()
+        trackfile_id = self.get_trackfile_id()
+        if start is None and end is None and trackfile_id is None:
+            return Trackfile.objects.none()
+        trackfiles = Trackfile.objects.filter(archived_at__isnull=False).order_by("starttime")
+        if start:
+            trackfiles = trackfiles.filter(endtime__gte=start)
+        if end:
+            trackfiles = trackfiles.filter(starttime__lte=end)
+        if trackfile_id is not None:
+            trackfiles = trackfiles.filter(pk=trackfile_id)
+        return trackfiles
+
+    def list(self, request, *args, **kwargs):
+        bucket = request.query_params.get("bucket")
+        if bucket:
+            return self.list_buckets(bucket)
+        archived = self.get_archived_trackfiles()
+        if not archived.exists():
+            return super().list(request, *args, **kwargs)
+        # Merge database and archived Trackpoints, the range is limited by trackfile, start or end
+        start, end = self.get_time_range()
+        trackpoints = MergedTrackpoints(self.get_queryset(), archived, start, end, self.get_bbox())
+        page = self.paginate_queryset(trackpoints)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def list_buckets(self, bucket: str):
+        if bucket not in self.buckets:
+            raise ParseError(f"bucket must be one of {', '.join(self.buckets)}")
+        queryset = (
+            self.get_queryset()
+            .annotate(bucket=Trunc("time", bucket))
+            .values("bucket")
+            .annotate(
+                count=Count("id"),
+                lat=Avg("lat"),
+                lon=Avg("lon"),
+                speed=Avg("speed"),
+                min_ele=Min("ele"),
+                max_ele=Max("ele"),
+            )
+            .order_by("bucket")
+        )
+        page = self.paginate_queryset(queryset)
+        serializer = TrackpointBucketSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
 
 class TracksegViewSet(viewsets.ReadOnlyModelViewSet):
     """
@@ -55,9 +225,291 @@ class TracksegViewSet(viewsets.ReadOnlyModelViewSet):
 class TrackfileViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows Trackfiles to be viewed.
+
+    * Add `geometry=0` to leave out full geometries and use `thumbnail` preview images instead.
     """
 
-    queryset = Trackfile.objects.all().order_by("starttime")
+    queryset = Trackfile.objects.select_related("stats").order_by("starttime")
     serializer_class = TrackfileSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ["filename"]
+    thumbnail_sizes = [64, 128, 256]
+
+    def get_queryset(self):
+        queryset = super().get_queryset().annotate(
+            has_geometry=ExpressionWrapper(Q(geometry__isnull=False), output_field=BooleanField())
+        )
+        if self.request.query_params.get("geometry") == "0":
+            queryset = queryset.defer("geometry")
+        return queryset
+
+    @action(detail=True)
+    def thumbnail(self, request, pk=None):
+        """Return a PNG preview image of Trackfile's geometry. Add `size` (64, 128 or 256 pixels) to change size."""
+        size = parse_int_param(request.query_params, "size", 128)
+        if size not in self.thumbnail_sizes:
+            raise ParseError(f"size must be one of {', '.join(str(s) for s in self.thumbnail_sizes)}")
+        path = self.get_object().get_thumbnail(size)
+        if path is None:
+            raise Http404("Trackfile has no geometry")
+        response = FileResponse(open(path, "rb"), content_type="image/png")
+        response["Cache-Control"] = "max-age=86400"
+        return response
+
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        """
+        Return user's other Trackfiles following the same route, ordered by similarity.
+
+        * `tolerance` is the max distance in meters between start and end points (default 200).
+        * `max_distance` is the max discrete Fréchet distance in meters between routes (default 500).
+        """
+        trackfile = self.get_object()
+        results = find_similar_trackfiles(
+            trackfile,
+            tolerance=parse_int_param(request.query_params, "tolerance"),
+            max_distance=parse_int_param(request.query_params, "max_distance"),
+            limit=parse_int_param(request.query_params, "limit", 20),
+        )
+        data = []
+        for candidate, distance in results:
+            item = self.get_serializer(candidate).data
+            item["frechet_distance"] = round(distance, 1)
+            data.append(item)
+        return Response({"count": len(data), "results": data})
+
+
+class VisitViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that allows user's Visits (places where user stayed for a while) to be viewed.
+
+    * Filter by time range `start` and `end` (ISO 8601).
+    * Add `near=lat,lon` to get Visits within `radius` meters (default 200) of a place.
+    """
+
+    queryset = Visit.objects.order_by("arrival")
+    serializer_class = VisitSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = Visit.objects.filter(user=self.request.user).order_by("arrival")
+        start, end = parse_time_range(self.request.query_params)
+        if start:
+            queryset = queryset.filter(departure__gte=start)
+        if end:
+            queryset = queryset.filter(arrival__lte=end)
+        near = self.request.query_params.get("near")
+        if near:
+            try:
+                lat, lon = [float(x) for x in near.split(",")]
+            except ValueError:
+                raise ParseError("near must be in format 'lat,lon' where both values are floats")
+            radius = parse_int_param(self.request.query_params, "radius", 200)
+            queryset = queryset.filter(geometry__dwithin=(Point(lon, lat, srid=4326), D(m=radius)))
+        return queryset
+
+
+class DailySummaryViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that allows user's daily summaries to be viewed.
+
+    * Add `month=YYYY-MM` to get one month, e.g. for a calendar view,
+      or filter by dates with `start` and `end` (YYYY-MM-DD, inclusive).
+    * Add `geometry=0` to leave out simplified day geometries.
+    """
+
+    queryset = DailySummary.objects.order_by("date")
+    serializer_class = DailySummarySerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = DailySummary.objects.filter(user=self.request.user).order_by("date")
+        params = self.request.query_params
+        month = params.get("month")
+        if month:
+            first = parse_date(f"{month}-01") if len(month) == 7 else None
+            if first is None:
+                raise ParseError("month must be in format YYYY-MM")
+            queryset = queryset.filter(date__year=first.year, date__month=first.month)
+        for key, lookup in [("start", "date__gte"), ("end", "date__lte")]:
+            if params.get(key):
+                date = parse_date(params[key])
+                if date is None:
+                    raise ParseError(f"{key} must be in format YYYY-MM-DD")
+                queryset = queryset.filter(**{lookup: date})
+        if params.get("geometry") == "0":
+            queryset = queryset.defer("geometry")
+        return queryset
+
+
+class TrackpointIngestView(APIView):
+    """
+    API endpoint for live GPS loggers (e.g. GPSLogger, OwnTracks) to post trackpoints.
+
+    * Request body is a single point or a list of points in JSON format,
+      optionally gzip compressed (add header `Content-Encoding: gzip`).
+    * Every point must have `lat`, `lon` and `time` (ISO 8601 or UNIX epoch).
+    * Points are buffered and saved in bulk, so they may appear with a small delay.
+      User's points of a day are collected into one live Trackfile, whose Tracksegs are extended incrementally.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, format=None):
+        payload = request.body
+        if request.headers.get("Content-Encoding", "").lower() == "gzip":
+            try:
+                payload = gzip.decompress(payload)
+            except (OSError, EOFError) as err:
+                raise ParseError(f"Invalid gzip data: {err}")
+        try:
+            points = parse_trackpoint_json(json.loads(payload))
+        except ValueError as err:
+            raise ParseError(f"Invalid trackpoint data: {err}")
+        if points:
+            trackpoint_buffer.add(request.user, payload, points)
+        return Response({"received": len(points)}, status=status.HTTP_202_ACCEPTED)
+
+
+class TrackpointSeriesView(APIView):
+    """
+    API endpoint returning elevation and speed series of Trackpoints downsampled for charts.
+
+    * Select Trackpoints with `trackfile=id` or time range `start` and `end` (ISO 8601).
+    * `fields` is a comma-separated list of series, default `ele,speed`.
+      Missing speeds are computed from the distance and time between consecutive points.
+    * Every series is downsampled to max `n` points (default 500) using Largest-Triangle-Three-Buckets
+      and returned as a list of `[time in epoch milliseconds, value]` pairs.
+    """
+
+    permission_classes = [IsAuthenticated]
+    series_fields = ["ele", "speed", "hdop", "course"]
+    max_points = 10000
+
+    def get(self, request, format=None):
+        fields = request.query_params.get("fields", "ele,speed").split(",")
+        invalid = set(fields) - set(self.series_fields)
+        if invalid:
+            choices = ", ".join(self.series_fields)
+            raise ParseError(f"Invalid fields {', '.join(sorted(invalid))}, choose from {choices}")
+        n = parse_int_param(request.query_params, "n", 500)
+        if not 3 <= n <= self.max_points:
+            raise ParseError(f"n must be between 3 and {self.max_points}")
+        columns = list(dict.fromkeys(["time", "lat", "lon"] + fields))
+        trackfile_id = parse_int_param(request.query_params, "trackfile")
+        start, end = parse_time_range(request.query_params)
+        if trackfile_id is not None:
+            trackfile = get_object_or_404(Trackfile, pk=trackfile_id, user=request.user)
+            arrays = trackfile.get_trackpoint_arrays(start, end, fields=columns)
+        elif start and end:
+            arrays = get_user_trackpoint_arrays(request.user, start, end, fields=columns)
+        else:
+            raise ParseError("Give trackfile or both start and end")
+        times = arrays["time"] / 1e6
+        if "speed" in fields and len(times) > 1:
+            dist = haversine(arrays["lat"][:-1], arrays["lon"][:-1], arrays["lat"][1:], arrays["lon"][1:])
+            dt = np.diff(times)
+            computed = np.full(len(times), np.nan)
+            computed[1:] = np.divide(dist, dt, out=np.full_like(dist, np.nan), where=dt > 0)
+            arrays["speed"] = np.where(np.isnan(arrays["speed"]), computed, arrays["speed"])
+        series = {}
+        for field in fields:
+            valid = ~np.isnan(arrays[field])
+            x, y = times[valid], arrays[field][valid]
+            indices = lttb(x, y, n)
+            points = zip(x[indices].tolist(), y[indices].tolist())
+            series[field] = [[int(t * 1000), round(v, 2)] for t, v in points]
+        return Response({"trackpoint_cnt": len(times), "series": series})
+
+
+class TrackNearView(APIView):
+    """
+    API endpoint answering "when was I near this place".
+
+    * Give place with `lat` and `lon` and distance with `radius` in meters (default 100).
+    * Optionally limit the search with time range `start` and `end` (ISO 8601).
+    * Returns time intervals ordered by time, when user's Trackpoints were within radius from the place.
+    """
+
+    permission_classes = [IsAuthenticated]
+    max_radius = 10000
+
+    def get(self, request, format=None):
+        try:
+            lat = float(request.query_params["lat"])
+            lon = float(request.query_params["lon"])
+        except (KeyError, ValueError):
+            raise ParseError("lat and lon are required and they must be floats")
+        radius = parse_int_param(request.query_params, "radius", 100)
+        if not 0 < radius <= self.max_radius:
+            raise ParseError(f"radius must be between 1 and {self.max_radius}")
+        start, end = parse_time_range(request.query_params)
+        intervals = find_times_near(request.user, lat, lon, radius, start, end)
+        for interval in intervals:
+            interval["duration"] = (interval["end"] - interval["start"]).total_seconds()
+            interval["min_distance"] = round(interval["min_distance"], 1)
+        return Response({"count": len(intervals), "results": intervals})
+
+
+class HeatmapTileView(APIView):
+    """
+    API endpoint returning user's Trackpoint density heatmap for a Web Mercator tile z/x/y.
+
+    Counts come from precomputed HeatmapCells at the first zoom level in TRACK["HEATMAP_ZOOMS"],
+    which is at least 6 levels deeper than z (max 64 x 64 cells per tile).
+    Response contains `cell_zoom` and a list of `[column, row, count]` cells inside the tile.
+    """
+
+    permission_classes = [IsAuthenticated]
+    resolution = 6  # Zoom levels between tile and cells
+
+    def get(self, request, z, x, y, format=None):
+        if not (0 <= x < 1 << z and 0 <= y < 1 << z):
+            raise ParseError("Tile x and y must be between 0 and 2^z - 1")
+        zooms = sorted(settings.TRACK.get("HEATMAP_ZOOMS", [8, 10, 12, 14, 16, 18]))
+        cell_zoom = next((zoom for zoom in zooms if zoom >= z + self.resolution), zooms[-1])
+        if cell_zoom < z:
+            raise ParseError(f"Max zoom level is {zooms[-1]}")
+        scale = 1 << (cell_zoom - z)
+        cells = HeatmapCell.objects.filter(
+            user=request.user,
+            zoom=cell_zoom,
+            x__gte=x * scale,
+            x__lt=(x + 1) * scale,
+            y__gte=y * scale,
+            y__lt=(y + 1) * scale,
+        ).values_list("x", "y", "count")
+        return Response(
+            {
+                "zoom": z,
+                "cell_zoom": cell_zoom,
+                "size": scale,
+                "cells": [[cx - x * scale, cy - y * scale, count] for cx, cy, count in cells],
+            }
+        )
+
+
+class GpxExportView(APIView):
+    """
+    API endpoint exporting user's Trackpoints between `start` and `end` (ISO 8601) as one GPX file,
+    regardless of the Trackfiles they came from. Add `gzip=1` to get a gzip compressed file.
+    The file is generated while it is streamed, so also long time ranges can be exported.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        start, end = parse_time_range(request.query_params)
+        if start is None or end is None:
+            raise ParseError("start and end are required")
+        chunks = export_gpx(request.user, start, end)
+        filename = "track-{}-{}.gpx".format(start.strftime("%Y%m%d"), end.strftime("%Y%m%d"))
+        if request.query_params.get("gzip") == "1":
+            response = StreamingHttpResponse(gzip_stream(chunks), content_type="application/gzip")
+            filename += ".gz"
+        else:
+            response = StreamingHttpResponse(
+                (chunk.encode("utf-8") for chunk in chunks), content_type="application/gpx+xml"
+            )
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response